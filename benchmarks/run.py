@@ -0,0 +1,278 @@
+"""
+Benchmarks of the sendwithus client against a local mock API
+
+Every scenario runs in its own process against `server.py`, so peak
+RSS is measured per scenario. Reports throughput, p50/p99 latency per
+operation, peak memory allocated by one operation (tracemalloc) and
+peak RSS of the process. Usage:
+
+    python benchmarks/run.py
+    python benchmarks/run.py send batch_1k --latency 5
+    python benchmarks/run.py --output base.json
+    python benchmarks/run.py --compare base.json --threshold 0.15
+"""
+
+import argparse
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import sendwithus  # noqa: E402
+
+from server import start_server  # noqa: E402
+
+RECIPIENT = {'name': 'Bench', 'address': 'bench@example.com'}
+EMAIL_DATA = {
+    'first_name': 'Bench',
+    'items': [{'sku': 'sku_%s' % i, 'price': i * 1.5} for i in range(10)],
+}
+
+
+def _attachment(size_mb):
+    f = io.BytesIO(os.urandom(int(size_mb * 1024 * 1024)))
+    f.name = 'attachment.bin'
+    return f
+
+
+def send(swu, args):
+    swu.send('tem_bench', RECIPIENT, email_data=EMAIL_DATA)
+
+
+def send_attachment(swu, args):
+    args.attachment.seek(0)
+    swu.send(
+        'tem_bench',
+        RECIPIENT,
+        email_data=EMAIL_DATA,
+        files=[args.attachment]
+    )
+
+
+def render(swu, args):
+    swu.render('tem_bench', EMAIL_DATA)
+
+
+def templates(swu, args):
+    swu.get_template('tem_bench')
+
+
+def _batch(size):
+    def run_batch(swu, args):
+        batch = swu.start_batch()
+        for _ in range(size):
+            batch.send('tem_bench', RECIPIENT, email_data=EMAIL_DATA)
+        result = batch.execute()
+        assert result.ok and len(result) == size
+    return run_batch
+
+
+# name: (operation, default number of operations, items per operation)
+SCENARIOS = OrderedDict([
+    ('send', (send, 500, 1)),
+    ('send_attachment', (send_attachment, 5, 1)),
+    ('render', (render, 500, 1)),
+    ('templates', (templates, 500, 1)),
+    ('batch_1k', (_batch(1000), 10, 1000)),
+    ('batch_10k', (_batch(10000), 3, 10000)),
+])
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def run_scenario(name, args):
+    """Run one scenario in this process and return its measurements"""
+    operation, operations, items = SCENARIOS[name]
+    operations = args.operations or operations
+    if name == 'send_attachment':
+        args.attachment = _attachment(args.attachment_mb)
+
+    swu = sendwithus.api(
+        'BENCH_API_KEY',
+        API_PROTO='http',
+        API_HOST='127.0.0.1',
+        API_PORT=str(args.port),
+        json_backend=args.json_backend,
+        stream_payloads=args.stream_payloads,
+        compression=args.compression
+    )
+
+    operation(swu, args)  # warm up the connection pool and caches
+
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(operations):
+        start = time.perf_counter()
+        operation(swu, args)
+        latencies.append(time.perf_counter() - start)
+    elapsed = time.perf_counter() - started
+
+    tracemalloc.start()
+    operation(swu, args)
+    alloc_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        max_rss *= 1024  # kilobytes everywhere but macOS
+
+    swu.close()
+    return {
+        'scenario': name,
+        'operations': operations,
+        'items_per_second': operations * items / elapsed,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'alloc_peak_mb': alloc_peak / 1048576.0,
+        'max_rss_mb': max_rss / 1048576.0,
+    }
+
+
+def run_isolated(name, args):
+    command = [
+        sys.executable,
+        os.path.abspath(__file__),
+        name,
+        '--child',
+        '--port', str(args.port),
+        '--operations', str(args.operations or 0),
+        '--attachment-mb', str(args.attachment_mb),
+    ]
+    if args.json_backend:
+        command += ['--json-backend', args.json_backend]
+    if args.stream_payloads:
+        command.append('--stream-payloads')
+    if args.compression:
+        command += ['--compression', args.compression]
+    output = subprocess.check_output(command)
+    return json.loads(output.decode('utf-8'))
+
+
+COLUMNS = (
+    ('scenario', 'scenario', '%-16s'),
+    ('ops', 'operations', '%6d'),
+    ('items/s', 'items_per_second', '%10.1f'),
+    ('p50 ms', 'p50_ms', '%9.2f'),
+    ('p99 ms', 'p99_ms', '%9.2f'),
+    ('alloc MB', 'alloc_peak_mb', '%9.2f'),
+    ('RSS MB', 'max_rss_mb', '%8.1f'),
+)
+
+
+def print_table(results):
+    widths = [len(fmt % 0) if 'd' in fmt or 'f' in fmt else 16
+              for _, _, fmt in COLUMNS]
+    print('  '.join(
+        title.rjust(width) if index else title.ljust(width)
+        for index, ((title, _, _), width) in enumerate(zip(COLUMNS, widths))
+    ))
+    for result in results:
+        print('  '.join(fmt % result[key] for _, key, fmt in COLUMNS))
+
+
+def compare(results, baseline, threshold):
+    """Print changes against `baseline`; returns the regressed scenarios"""
+    baseline = dict((r['scenario'], r) for r in baseline)
+    regressions = []
+    for result in results:
+        base = baseline.get(result['scenario'])
+        if base is None:
+            continue
+        changes = []
+        for key, higher_is_better in (
+            ('items_per_second', True),
+            ('p50_ms', False),
+            ('p99_ms', False),
+            ('alloc_peak_mb', False),
+            ('max_rss_mb', False),
+        ):
+            if not base[key]:
+                continue
+            change = result[key] / base[key] - 1
+            changes.append('%s %+.1f%%' % (key, change * 100))
+            if (-change if higher_is_better else change) > threshold:
+                regressions.append('%s %s' % (result['scenario'], key))
+        print('%-16s %s' % (result['scenario'], ', '.join(changes)))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n')[1],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog='scenarios: %s' % ', '.join(SCENARIOS)
+    )
+    parser.add_argument('scenarios', nargs='*', default=list(SCENARIOS))
+    parser.add_argument(
+        '--latency',
+        type=float,
+        default=0,
+        help='milliseconds the mock API waits before answering'
+    )
+    parser.add_argument(
+        '--operations',
+        type=int,
+        default=0,
+        help='operations per scenario instead of the scenario default'
+    )
+    parser.add_argument('--attachment-mb', type=float, default=10)
+    parser.add_argument('--json-backend', default=None)
+    parser.add_argument('--stream-payloads', action='store_true')
+    parser.add_argument(
+        '--compression',
+        choices=['gzip', 'deflate'],
+        help='compress request bodies'
+    )
+    parser.add_argument('--output', help='write the results as JSON')
+    parser.add_argument('--compare', help='JSON results to compare with')
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=0.1,
+        help='relative change counted as a regression (default 0.1)'
+    )
+    parser.add_argument('--port', type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error('unknown scenarios: %s' % ', '.join(sorted(unknown)))
+
+    if args.child:
+        name, = args.scenarios
+        print(json.dumps(run_scenario(name, args)))
+        return
+
+    server = start_server(latency=args.latency / 1000.0)
+    args.port = server.server_port
+    results = [run_isolated(name, args) for name in args.scenarios]
+    server.shutdown()
+
+    print_table(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print('')
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('\nRegressed: %s' % ', '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""
+Local stand-in for the Sendwithus API used by the benchmarks
+
+Answers `send`, `batch`, `render` and `templates` requests under
+`/api/v1/` with canned responses after an optional latency, without
+checking the API key. Run on its own with:
+
+    python benchmarks/server.py --port 8080 --latency 20
+"""
+
+import argparse
+import json
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+PREFIX = '/api/v1/'
+
+# zlib window bits of the request Content-Encodings understood
+ENCODINGS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+TEMPLATE = {
+    'id': 'tem_bench',
+    'name': 'Benchmark template',
+    'versions': [
+        {
+            'id': 'ver_bench',
+            'name': 'Default',
+            'created': 1500000000,
+            'modified': 1500000000,
+        }
+    ],
+}
+
+RESPONSES = {
+    'send': {
+        'success': True,
+        'status': 'OK',
+        'receipt_id': 'log_bench',
+        'email': {'name': 'Benchmark template', 'version_name': 'Default'},
+    },
+    'render': {
+        'success': True,
+        'status': 'OK',
+        'template': {'id': 'tem_bench', 'name': 'Benchmark template'},
+        'subject': 'Benchmark',
+        'html': '<html><body>%s</body></html>' % ('<p>Hello</p>' * 200),
+        'text': 'Hello\n' * 200,
+    },
+    'templates': [TEMPLATE] * 20,
+}
+
+
+class BenchHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # buffer writes so headers and body leave in one packet, and no time
+    # is lost to Nagle's algorithm and delayed ACKs
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+                if not size:
+                    return b''.join(chunks)
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _decode(self, body):
+        encoding = self.headers.get('Content-Encoding')
+        if encoding in ENCODINGS and body:
+            return zlib.decompress(body, ENCODINGS[encoding])
+        return body
+
+    def _content(self, path, body):
+        if path == 'batch':
+            return [
+                {
+                    'status_code': 200,
+                    'body': self._content(
+                        command['path'].split(PREFIX, 1)[-1],
+                        None
+                    ),
+                    'path': command['path'],
+                    'method': command['method'],
+                }
+                for command in json.loads(body.decode('utf-8'))
+            ]
+        if path.startswith('templates/'):
+            return TEMPLATE
+        return RESPONSES.get(path, {'success': True})
+
+    def _handle(self):
+        body = self._read_body()
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        if not self.path.startswith(PREFIX):
+            status, content = 404, {'error': 'not found'}
+        else:
+            status = 200
+            content = self._content(
+                self.path[len(PREFIX):],
+                self._decode(body)
+            )
+        content = json.dumps(content).encode('utf-8')
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+        with self.server.lock:
+            self.server.request_count += 1
+            self.server.bytes_received += len(body)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+    def log_message(self, *args):
+        pass
+
+
+class BenchServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, latency=0):
+        HTTPServer.__init__(self, address, BenchHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.bytes_received = 0
+
+
+def start_server(host='127.0.0.1', port=0, latency=0):
+    """Serve in a daemon thread; returns the running `BenchServer`"""
+    server = BenchServer((host, port), latency)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument(
+        '--latency',
+        type=float,
+        default=0,
+        help='milliseconds to wait before answering each request'
+    )
+    args = parser.parse_args()
+
+    server = BenchServer((args.host, args.port), args.latency / 1000.0)
+    print('Serving on http://%s:%s%s' % (args.host, args.port, PREFIX))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,17 @@
+import json
+import os
+import sys
+import threading
+import time
+
 import pytest
+from six.moves import BaseHTTPServer, socketserver
+
 import sendwithus
-import os
+
+# the asyncio client uses async generators
+if sys.version_info < (3, 6):
+    collect_ignore = ['test_aio.py']
 
 
 @pytest.fixture
@@ -104,3 +115,107 @@ def translation_file_test():
 @pytest.fixture
 def translation_tag_test():
     return 'translate'
+
+
+class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Records requests and answers with the server's queued responses"""
+
+    protocol_version = 'HTTP/1.1'
+    # send headers and body together, avoiding delayed ACK stalls
+    wbufsize = -1
+
+    def _read_chunked(self):
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().strip(), 16)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+            if not size:
+                return b''.join(chunks)
+
+    def _handle(self):
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            body = self._read_chunked()
+        else:
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else b''
+        with self.server.lock:
+            self.server.requests.append({
+                'method': self.command,
+                'path': self.path,
+                'headers': dict(self.headers),
+                'body': body,
+                'port': self.client_address[1],
+            })
+
+            headers = {}
+            if self.server.responses:
+                response = self.server.responses.pop(0)
+                status, content = response[:2]
+                if len(response) > 2:
+                    headers = response[2]
+            elif self.path.endswith('/batch'):
+                status, content = 200, [
+                    {
+                        'status_code': 200,
+                        'body': {'success': True},
+                        'path': command['path'],
+                        'method': command['method'],
+                    }
+                    for command in json.loads(body.decode('utf-8'))
+                ]
+            else:
+                status, content = 200, {'success': True}
+        if status in (204, 304):
+            content = b''
+        else:
+            content = json.dumps(content).encode('utf-8')
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+    def log_message(self, *args):
+        pass
+
+
+class MockServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def mock_server():
+    server = MockServer(('127.0.0.1', 0), MockHandler)
+    server.lock = threading.Lock()
+    server.requests = []
+    server.responses = []
+    server.delay = 0
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def mock_api_options(mock_server):
+    return {
+        'API_PROTO': 'http',
+        'API_HOST': '127.0.0.1',
+        'API_PORT': str(mock_server.server_port),
+    }
+
+
+@pytest.fixture
+def mock_api(mock_api_options):
+    with sendwithus.api('TEST_API_KEY', **mock_api_options) as swu_api:
+        yield swu_api
@@ -3,17 +3,29 @@ sendwithus - Python Client
 For more information, visit http://www.sendwithus.com
 """
 
-import base64
-import json
 import logging
+import re
+import threading
+import time
 import warnings
+from itertools import islice
 
 import requests
-import six
+from requests.packages.urllib3.exceptions import NewConnectionError
 from six import string_types
+from six.moves.urllib.parse import urlencode
 
+from .compression import check_encoding, compress
 from .encoder import SendwithusJSONEncoder
+from .events import RequestEvent, body_size
 from .exceptions import APIError, AuthenticationError, ServerError
+from .idempotency import new_key
+from .jsonlib import get_backend
+from .parallel import imap_bounded, iter_prefetched
+from .prepared import PreparedSend
+from .results import BatchCommandResult, BatchResult, BulkResult, SendResult
+from .streaming import (Base64File, IterJSONBody, JSONArrayBody, JSONBody,
+                        attachment_encoder, iter_json_array)
 from .version import version
 
 LOGGER_FORMAT = '%(asctime)-15s %(message)s'
@@ -21,6 +33,27 @@ logger = logging.getLogger('sendwithus')
 logger.propagate = False
 
 
+class _LogBody(object):
+    """Request or response body as shown in debug logs
+
+    Only formatted when a record is actually emitted, and cut to `limit`
+    characters unless `limit` is None.
+    """
+
+    def __init__(self, body, limit):
+        self.body = body
+        self.limit = limit
+
+    def __str__(self):
+        body = self.body
+        if isinstance(body, bytes):
+            body = body.decode('utf-8', 'replace')
+        text = '%s' % (body,)
+        if self.limit is not None and len(text) > self.limit:
+            return '%s... (%s characters)' % (text[:self.limit], len(text))
+        return text
+
+
 class api:
     API_PROTO = 'https'
     API_PORT = '443'
@@ -28,6 +61,9 @@ class api:
     API_VERSION = '1'
     API_HEADER_KEY = 'X-SWU-API-KEY'
     API_HEADER_CLIENT = 'X-SWU-API-CLIENT'
+    API_HEADER_IDEMPOTENCY = 'Idempotency-Key'
+    # longest request or response body logged in debug mode, None for all
+    DEBUG_BODY_LIMIT = 1000
 
     HTTP_GET = 'GET'
     HTTP_POST = 'POST'
@@ -68,6 +104,9 @@ class api:
 
     DEBUG = False
     DEFAULT_TIMEOUT = None
+    DEFAULT_POOL_CONNECTIONS = 10
+    DEFAULT_POOL_MAXSIZE = 10
+    RESPONSE_CHUNK_SIZE = 64 * 1024
 
     def __init__(
         self,
@@ -75,9 +114,57 @@ class api:
         json_encoder=SendwithusJSONEncoder,
         raise_errors=False,
         default_timeout=None,
+        pool_connections=DEFAULT_POOL_CONNECTIONS,
+        pool_maxsize=DEFAULT_POOL_MAXSIZE,
+        max_retries=0,
+        keep_alive=True,
+        session=None,
+        retry_policy=None,
+        rate_limiter=None,
+        cache=None,
+        stream_payloads=False,
+        json_backend=None,
+        on_request=None,
+        on_response=None,
+        tracing=False,
+        transport=None,
+        outbox=None,
+        outbox_worker=True,
+        idempotency_keys=False,
+        dedupe_window=None,
+        compression=None,
+        compression_threshold=1024,
+        compression_level=6,
         **kwargs
     ):
-        """Constructor, expects api key"""
+        """Constructor, expects api key
+
+        api_key: sendwithus API key
+        json_encoder: JSONEncoder class used to encode payloads
+        raise_errors: raise `sendwithus.exceptions` errors for failures
+        default_timeout: timeout of requests made without one
+        pool_connections, pool_maxsize: size of the connection pool
+        max_retries: retries of the underlying HTTP adapter
+        keep_alive: keep connections open between requests
+        session: `requests.Session` to share, left open by `close()`
+        retry_policy: `sendwithus.retry.RetryPolicy` for failed requests
+        rate_limiter: `sendwithus.ratelimit.TokenBucket` throttling requests
+        cache: `sendwithus.cache.ResponseCache` for template lookups
+        stream_payloads: encode request bodies while they are sent
+        json_backend: `'json'`, `'orjson'`, `'ujson'` or `'auto'`
+        on_request, on_response: hooks called with a `RequestEvent`
+        tracing: record OpenTelemetry spans, see `sendwithus.tracing`
+        transport: object making requests instead of the HTTP session
+        outbox: `sendwithus.outbox.SQLiteOutbox` queueing sends
+        outbox_worker: start an `OutboxWorker` on the first queued send
+        idempotency_keys: give every send a random idempotency key
+        dedupe_window: `sendwithus.idempotency.DedupeWindow` of sent keys
+        compression: `'gzip'` or `'deflate'` to compress request bodies
+        compression_threshold: smallest body size compressed, in bytes
+        compression_level: zlib compression level
+
+        See the README for details on each option.
+        """
 
         if not api_key:
             raise Exception("You must specify an api key")
@@ -86,6 +173,44 @@ class api:
         self.DEFAULT_TIMEOUT = default_timeout
         self._json_encoder = json_encoder
         self._raise_errors = raise_errors
+        self._retry_policy = retry_policy
+        self._rate_limiter = rate_limiter
+        self._cache = cache
+        self._stream_payloads = stream_payloads
+        self._json = get_backend(json_backend)
+        self._on_request = on_request
+        self._on_response = on_response
+        self._idempotency_keys = idempotency_keys
+        self._dedupe_window = dedupe_window
+        self._compression = None
+        if compression is not None:
+            self._compression = check_encoding(compression)
+        self._compression_threshold = compression_threshold
+        self._compression_level = compression_level
+        self._tracing = None
+        if tracing:
+            from .tracing import get_tracing
+            self._tracing = get_tracing(tracing)
+
+        if transport is not None:
+            session = transport
+        if session is None:
+            session = self._build_session(
+                pool_connections,
+                pool_maxsize,
+                max_retries,
+                keep_alive
+            )
+            self._owns_session = True
+        else:
+            self._owns_session = False
+        self._session = session
+
+        self._outbox = outbox
+        self._outbox_worker = None
+        self._start_outbox_worker = outbox_worker
+        if outbox is not None:
+            self._outbox_lock = threading.Lock()
 
         if 'API_HOST' in kwargs:
             self.API_HOST = kwargs['API_HOST']
@@ -97,12 +222,53 @@ class api:
             self.API_VERSION = kwargs['API_VERSION']
         if 'DEBUG' in kwargs:
             self.DEBUG = kwargs['DEBUG']
+        if 'DEBUG_BODY_LIMIT' in kwargs:
+            self.DEBUG_BODY_LIMIT = kwargs['DEBUG_BODY_LIMIT']
 
         if self.DEBUG:
             logging.basicConfig(format=LOGGER_FORMAT, level=logging.DEBUG)
             logger.debug('Debug enabled')
             logger.propagate = True
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Release the pooled connections held by this client
+
+        Also stops the outbox worker; emails still queued stay in the
+        outbox and are sent by the next worker.
+        """
+        if self._outbox_worker is not None:
+            self._outbox_worker.stop()
+            self._outbox_worker = None
+        if self._owns_session:
+            self._session.close()
+
+    def _build_session(
+        self,
+        pool_connections,
+        pool_maxsize,
+        max_retries,
+        keep_alive
+    ):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            max_retries=max_retries
+        )
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+        if not keep_alive:
+            session.headers['Connection'] = 'close'
+
+        return session
+
     def _build_http_auth(self):
         return (self.API_KEY, '')
 
@@ -117,14 +283,18 @@ class api:
             'Content-type': 'application/json',
             'Accept': 'text/plain'
         }
+        if self._compression is not None:
+            headers['Accept-Encoding'] = 'gzip, deflate'
 
         if custom_headers:
             headers.update(custom_headers)
 
         return headers
 
-    def _build_request_path(self, endpoint, absolute=True):
+    def _build_request_path(self, endpoint, absolute=True, params=None):
         path = '/api/v%s/%s' % (self.API_VERSION, endpoint)
+        if params:
+            path = '%s?%s' % (path, urlencode(sorted(params.items())))
         if absolute:
             path = "%s://%s:%s%s" % (
                 self.API_PROTO,
@@ -134,10 +304,49 @@ class api:
             )
         return path
 
+    def _encode_json(self, data):
+        """Encode `data` as JSON, reading any attachments in full"""
+        encoder = attachment_encoder(self._json_encoder)()
+        return self._json.dumps(data, encoder)
+
+    def _log_body(self, body):
+        return _LogBody(body, self.DEBUG_BODY_LIMIT)
+
     def _build_payload(self, data):
+        """Encode a request payload
+
+        Payloads with attachments become a `JSONBody` which streams the
+        base64 encoded files into the request as it is sent. In streaming
+        mode the whole payload is encoded while it is sent.
+        """
         if not data:
             return None
-        return json.dumps(data, cls=self._json_encoder)
+        if self._stream_payloads:
+            return IterJSONBody(data, self._json_encoder)
+        encoder = attachment_encoder(self._json_encoder)(stream=True)
+        text = self._json.dumps(data, encoder)
+        if encoder.files:
+            return JSONBody(text, encoder.files, encoder.nonce)
+        return text
+
+    def _compress_body(self, data, headers):
+        """Compress a JSON request body if compression is enabled
+
+        Sets the Content-Encoding header when the body was compressed.
+        """
+        if self._compression is None or not data or \
+                headers.get('Content-type') != 'application/json':
+            return data
+        compressed = compress(
+            data,
+            self._compression,
+            self._compression_level,
+            self._compression_threshold
+        )
+        if compressed is None:
+            return data
+        headers['Content-Encoding'] = self._compression
+        return compressed
 
     def _parse_response(self, response):
         """Parses the API response and raises appropriate errors if
@@ -145,7 +354,10 @@ class api:
         """
         if not self._raise_errors:
             return response
+        return self._raise_for_status(response)
 
+    def _raise_for_status(self, response):
+        """Raise the error matching a failed response"""
         is_4xx_error = str(response.status_code)[0] == '4'
         is_5xx_error = str(response.status_code)[0] == '5'
         content = response.content
@@ -159,22 +371,272 @@ class api:
 
         return response
 
+    def _is_transport_error(self, error):
+        return isinstance(error, (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout
+        ))
+
+    def _is_connect_error(self, error):
+        """Whether `error` happened before the request was sent"""
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return True
+        if isinstance(error, requests.exceptions.ConnectionError):
+            reason = getattr(error.args[0], 'reason', None) \
+                if error.args else None
+            return isinstance(reason, NewConnectionError)
+        return False
+
+    def _throttle(self, event=None):
+        if self._rate_limiter is not None:
+            wait = self._rate_limiter.acquire()
+            if wait:
+                logger.debug('\tthrottled for %.3fs', wait)
+                if event is not None:
+                    event.add_timing('throttle', wait)
+
+    def _timed(self, send, event):
+        def timed_send():
+            start = time.time()
+            try:
+                return send()
+            finally:
+                event.add_timing('request', time.time() - start)
+        return timed_send
+
+    def _send_with_retries(self, send, idempotent=False, event=None):
+        """Call `send` until it succeeds or the retry policy gives up
+
+        `send` makes a single attempt and returns its response. Only
+        idempotent requests are retried once they may have reached the
+        server. Attempts, waits and retries are recorded on `event`.
+        """
+        if event is not None:
+            send = self._timed(send, event)
+
+        policy = self._retry_policy
+        if policy is None:
+            self._throttle(event)
+            return send()
+
+        start = time.time()
+        attempt = 0
+        while True:
+            attempt += 1
+            self._throttle(event)
+            try:
+                r = send()
+            except Exception as e:
+                if not self._is_transport_error(e):
+                    raise
+                delay = policy.get_retry_delay(
+                    attempt,
+                    time.time() - start,
+                    idempotent,
+                    sent=not self._is_connect_error(e)
+                )
+                if delay is None:
+                    raise
+                logger.debug('\tretrying in %.2fs after %r', delay, e)
+            else:
+                delay = policy.get_retry_delay(
+                    attempt,
+                    time.time() - start,
+                    idempotent,
+                    status_code=r.status_code,
+                    retry_after=r.headers.get('Retry-After')
+                )
+                if delay is None:
+                    return r
+                logger.debug(
+                    '\tretrying in %.2fs after response code:%s',
+                    delay,
+                    r.status_code
+                )
+                r.close()
+
+            if event is not None:
+                event.retries = attempt
+                event.add_timing('backoff', delay)
+            policy.sleep(delay)
+
+    def _new_event(self, endpoint, http_method, path=None, commands=None):
+        """A `RequestEvent` for the hooks, or None if there are none"""
+        if self._on_request is None and self._on_response is None and \
+                self._tracing is None:
+            return None
+        return RequestEvent(
+            self._endpoint_name(endpoint, http_method),
+            http_method,
+            path,
+            commands
+        )
+
+    def _call_hook(self, hook, event):
+        if hook is None:
+            return
+        try:
+            hook(event)
+        except Exception:
+            logger.exception('Request hook %r failed', hook)
+
+    def _request_started(self, event, body, headers=None):
+        if event is not None:
+            event.request_bytes = body_size(body)
+            event.headers = headers
+            if self._tracing is not None:
+                self._call_hook(self._tracing.on_request, event)
+            self._call_hook(self._on_request, event)
+
+    def _request_finished(self, event, response=None, error=None):
+        if event is not None:
+            event.finish(response, error)
+            self._call_hook(self._on_response, event)
+            if self._tracing is not None:
+                self._call_hook(self._tracing.on_response, event)
+
+    def _template_id(self, endpoint, payload):
+        """Template a request is about, for metrics and tracing"""
+        if isinstance(payload, dict):
+            template_id = payload.get('email_id') or \
+                payload.get('template_id')
+            if template_id:
+                return template_id
+        if endpoint.startswith(self.TEMPLATES_ENDPOINT + '/'):
+            return endpoint.split('/')[1]
+        return None
+
+    @classmethod
+    def _endpoint_patterns(cls):
+        patterns = cls.__dict__.get('_compiled_endpoint_patterns')
+        if patterns is None:
+            patterns = []
+            for name in dir(cls):
+                value = getattr(cls, name)
+                if not name.endswith('_ENDPOINT') or \
+                        not isinstance(value, string_types):
+                    continue
+                regex = '[^/]+'.join(re.escape(p) for p in value.split('%s'))
+                patterns.append((re.compile('^%s$' % regex), name))
+            cls._compiled_endpoint_patterns = patterns
+        return patterns
+
+    def _endpoint_name(self, endpoint, http_method):
+        """Name of the endpoint constant `endpoint` was built from
+
+        e.g. 'TEMPLATES_SPECIFIC_ENDPOINT' for 'templates/tem_123'.
+        Constants sharing a path are told apart by the HTTP method.
+        """
+        names = [
+            name for pattern, name in self._endpoint_patterns()
+            if pattern.match(endpoint)
+        ]
+        if not names:
+            return None
+        names.sort(key=lambda n: (http_method not in n, 'DELETE' in n))
+        return names[0]
+
+    def _uses_cache(self, http_method, params=None):
+        # responses of requests with query parameters are not cached
+        return (self._cache is not None and
+                http_method == self.HTTP_GET and not params)
+
+    def _get_cached(self, endpoint, http_method, params=None):
+        if not self._uses_cache(http_method, params):
+            return None
+        r = self._cache.get(endpoint)
+        if r is not None:
+            logger.debug('\tserved from cache')
+        return r
+
+    def _conditional_headers(self, endpoint, http_method, params=None):
+        if not self._uses_cache(http_method, params):
+            return {}
+        return self._cache.get_validators(endpoint)
+
+    def _update_cache(self, endpoint, http_method, response, params=None):
+        """Cache a fresh lookup, or invalidate what a change affected
+
+        Returns the response to hand to the caller, which for a 304 Not
+        Modified is the stored response that was revalidated.
+        """
+        if self._cache is None:
+            return response
+        if http_method != self.HTTP_GET:
+            self._cache.invalidate(endpoint)
+            return response
+        if not self._uses_cache(http_method, params):
+            return response
+
+        endpoint_name = self._endpoint_name(endpoint, http_method)
+        if response.status_code == 304:
+            stored = self._cache.revalidated(endpoint, endpoint_name, response)
+            if stored is not None:
+                logger.debug('\tnot modified, served from cache')
+                return stored
+        elif response.status_code == 200:
+            self._cache.set(endpoint, endpoint_name, response)
+        return response
+
     def _api_request(self, endpoint, http_method, *args, **kwargs):
-        """Private method for api requests"""
-        logger.debug(' > Sending API request to endpoint: %s' % endpoint)
+        """Private method for api requests
 
-        auth = self._build_http_auth()
+        GET requests are idempotent and may be retried; other requests
+        only when called with `idempotent=True`. Requests with an
+        `idempotency_key` go through the dedupe window, if any.
+        """
+        key = kwargs.get('idempotency_key')
+        if key is None or self._dedupe_window is None:
+            return self._request(endpoint, http_method, **kwargs)
+
+        previous, claimed = self._dedupe_window.acquire(key)
+        if not claimed:
+            logger.debug('\tidempotency key %s was already sent', key)
+            return self._parse_response(previous)
+        r = None
+        try:
+            r = self._request(endpoint, http_method, **kwargs)
+            return r
+        finally:
+            self._dedupe_window.release(key, r)
 
-        headers = self._build_request_headers(kwargs.get('headers'))
-        logger.debug('\theaders: %s' % headers)
+    def _request(self, endpoint, http_method, **kwargs):
+        logger.debug(' > Sending API request to endpoint: %s', endpoint)
+
+        cached = self._get_cached(
+            endpoint,
+            http_method,
+            kwargs.get('params')
+        )
+        if cached is not None:
+            event = self._new_event(endpoint, http_method)
+            if event is not None:
+                event.template_id = self._template_id(endpoint, None)
+                event.cached = True
+                self._request_finished(event, cached)
+            return cached
 
-        path = self._build_request_path(endpoint)
-        logger.debug('\tpath: %s' % path)
+        auth = self._build_http_auth()
 
+        headers = self._build_request_headers(kwargs.get('headers'))
+        headers.update(self._conditional_headers(
+            endpoint,
+            http_method,
+            kwargs.get('params')
+        ))
+        if kwargs.get('idempotency_key') is not None:
+            headers[self.API_HEADER_IDEMPOTENCY] = kwargs['idempotency_key']
+        path = self._build_request_path(endpoint, params=kwargs.get('params'))
+        started = time.time()
         data = self._build_payload(kwargs.get('payload'))
         if not data:
-            data = kwargs.get('data')
-        logger.debug('\tdata: %s' % data)
+            data = kwargs.get('encoded_payload') or kwargs.get('data')
+
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug('\theaders: %s', headers)
+            logger.debug('\tpath: %s', path)
+            logger.debug('\tdata: %s', self._log_body(data))
 
         req_kw = dict(
             auth=auth,
@@ -182,27 +644,43 @@ class api:
             timeout=kwargs.get('timeout', self.DEFAULT_TIMEOUT)
         )
 
-        # do some error handling
-        if (http_method == self.HTTP_POST):
-            if (data):
-                r = requests.post(path, data=data, **req_kw)
-            else:
-                r = requests.post(path, **req_kw)
-        elif http_method == self.HTTP_PUT:
-            if (data):
-                r = requests.put(path, data=data, **req_kw)
-            else:
-                r = requests.put(path, **req_kw)
-        elif http_method == self.HTTP_DELETE:
-            r = requests.delete(path, **req_kw)
-        else:
-            r = requests.get(path, **req_kw)
+        # only POST and PUT carry a request body
+        if http_method not in (self.HTTP_POST, self.HTTP_PUT):
+            data = None
+        if http_method not in (self.HTTP_POST, self.HTTP_PUT,
+                               self.HTTP_DELETE):
+            http_method = self.HTTP_GET
+        data = self._compress_body(data, headers)
+
+        event = self._new_event(endpoint, http_method, path)
+        if event is not None:
+            event.template_id = kwargs.get('template_id') or \
+                self._template_id(endpoint, kwargs.get('payload'))
+            event.add_timing('encode', time.time() - started)
+        self._request_started(event, data, headers)
 
-        logger.debug('\tresponse code:%s' % r.status_code)
         try:
-            logger.debug('\tresponse: %s' % r.json())
-        except Exception:
-            logger.debug('\tresponse: %s' % r.content)
+            r = self._send_with_retries(
+                lambda: self._session.request(
+                    http_method,
+                    path,
+                    data=data,
+                    **req_kw
+                ),
+                kwargs.get('idempotent', http_method == self.HTTP_GET),
+                event
+            )
+        except Exception as e:
+            self._request_finished(event, error=e)
+            raise
+        r = self._update_cache(endpoint, http_method, r, kwargs.get('params'))
+        if event is not None:
+            event.response_bytes = len(r.content)
+        self._request_finished(event, r)
+
+        if debug:
+            logger.debug('\tresponse code:%s', r.status_code)
+            logger.debug('\tresponse: %s', self._log_body(r.content))
 
         return self._parse_response(r)
 
@@ -489,7 +967,11 @@ class api:
         )
 
     def _make_file_dict(self, f):
-        """Make a dictionary with filename and base64 file data"""
+        """Make a dictionary with filename and base64 file data
+
+        The data is a `Base64File`, which is only read, in chunks, while
+        the request is being sent.
+        """
         if isinstance(f, dict):
             file_obj = f['file']
             if 'filename' in f:
@@ -500,64 +982,46 @@ class api:
             file_obj = f
             file_name = f.name
 
-        b64_data = base64.b64encode(file_obj.read())
         return {
             'id': file_name,
-            'data': b64_data.decode() if six.PY3 else b64_data,
+            'data': Base64File(file_obj),
         }
 
-    def send(
+    def _send_options(
         self,
-        email_id,
-        recipient,
-        email_data=None,
         sender=None,
         cc=None,
         bcc=None,
-        tags=[],
-        headers={},
+        tags=None,
+        headers=None,
         esp_account=None,
         locale=None,
         email_version_name=None,
         inline=None,
-        files=[],
-        timeout=None
+        files=None
     ):
-        """ API call to send an email """
-        if not email_data:
-            email_data = {}
-
-        # for backwards compatibility, will be removed
-        if isinstance(recipient, string_types):
-            warnings.warn(
-                "Passing email directly for recipient is deprecated",
-                DeprecationWarning)
-            recipient = {'address': recipient}
-
-        payload = {
-            'email_id': email_id,
-            'recipient': recipient,
-            'email_data': email_data
-        }
-
+        """Validate the optional fields of a send or drip campaign
+        payload, returning the ones that were given
+        """
+        options = {}
         if sender:
-            payload['sender'] = sender
+            options['sender'] = sender
         if cc:
             if not isinstance(cc, list):
                 logger.error(
                     'kwarg cc must be type(list), got %s' % type(cc))
-            payload['cc'] = cc
+            options['cc'] = cc
         if bcc:
-            if not isinstance(cc, list):
+            if not isinstance(bcc, list):
                 logger.error(
                     'kwarg bcc must be type(list), got %s' % type(bcc))
-            payload['bcc'] = bcc
+            options['bcc'] = bcc
 
         if tags:
-            if not isinstance(cc, list):
+            if not isinstance(tags, list):
                 logger.error(
                     'kwarg tags must be type(list), got %s' % (type(tags)))
-            payload['tags'] = tags
+            options['tags'] = tags
 
         if headers:
             if not type(headers) is dict:
@@ -566,7 +1030,7 @@ class api:
                         type(headers)
                     )
                 )
-            payload['headers'] = headers
+            options['headers'] = headers
 
         if esp_account:
             if not isinstance(esp_account, string_types):
@@ -575,33 +1039,200 @@ class api:
                         type(esp_account)
                     )
                 )
-            payload['esp_account'] = esp_account
+            options['esp_account'] = esp_account
 
         if locale:
             if not isinstance(locale, string_types):
                 logger.error(
                     'kwarg locale must be a string, got %s' % (type(locale))
                 )
-            payload['locale'] = locale
+            options['locale'] = locale
 
         if email_version_name:
             if not isinstance(email_version_name, string_types):
                 logger.error(
                     'kwarg email_version_name must be a string, got %s' % (
                         type(email_version_name)))
-            payload['version_name'] = email_version_name
+            options['version_name'] = email_version_name
 
         if inline:
-            payload['inline'] = self._make_file_dict(inline)
+            options['inline'] = self._make_file_dict(inline)
 
         if files:
-            payload['files'] = [self._make_file_dict(f) for f in files]
+            options['files'] = [self._make_file_dict(f) for f in files]
+
+        return options
+
+    def send(
+        self,
+        email_id,
+        recipient,
+        email_data=None,
+        sender=None,
+        cc=None,
+        bcc=None,
+        tags=[],
+        headers={},
+        esp_account=None,
+        locale=None,
+        email_version_name=None,
+        inline=None,
+        files=[],
+        timeout=None,
+        idempotent=False,
+        idempotency_key=None
+    ):
+        """ API call to send an email
+
+        Pass `idempotent=True` if the send may safely be repeated, to let
+        the retry policy retry it after server errors and timeouts. An
+        `idempotency_key` identifies the send to the API, so repeats of
+        it are safe and it is retried like an idempotent send.
+        """
+        if not email_data:
+            email_data = {}
+
+        payload = {
+            'email_id': email_id,
+            'recipient': self._send_recipient(recipient),
+            'email_data': email_data
+        }
+
+        payload.update(self._send_options(
+            sender=sender,
+            cc=cc,
+            bcc=bcc,
+            tags=tags,
+            headers=headers,
+            esp_account=esp_account,
+            locale=locale,
+            email_version_name=email_version_name,
+            inline=inline,
+            files=files
+        ))
+
+        if idempotency_key is None and self._idempotency_keys:
+            idempotency_key = new_key()
+
+        if self._outbox is not None:
+            return self._queue_send(payload, idempotency_key)
 
         return self._api_request(
             self.SEND_ENDPOINT,
             self.HTTP_POST,
             payload=payload,
-            timeout=timeout
+            timeout=timeout,
+            idempotent=idempotent or idempotency_key is not None,
+            idempotency_key=idempotency_key
+        )
+
+    def _send_recipient(self, recipient):
+        """`recipient` of a send as the API expects it"""
+        # for backwards compatibility, will be removed
+        if isinstance(recipient, string_types):
+            warnings.warn(
+                "Passing email directly for recipient is deprecated",
+                DeprecationWarning,
+                stacklevel=3)
+            recipient = {'address': recipient}
+        return recipient
+
+    def _queue_send(self, payload, idempotency_key=None):
+        """Store a send in the outbox as a batch command
+
+        Queued sends always get an idempotency key, so a batch sent
+        again after its response was lost is recognised by the API.
+        """
+        from .outbox import OutboxWorker, queued_response
+
+        outbox_id = self._outbox.put(self._encode_json({
+            'path': self._build_request_path(
+                self.SEND_ENDPOINT,
+                absolute=False
+            ),
+            'method': self.HTTP_POST,
+            'headers': {
+                self.API_HEADER_IDEMPOTENCY: idempotency_key or new_key()
+            },
+            'body': payload,
+        }))
+        logger.debug('\tqueued in outbox as %s', outbox_id)
+
+        if self._start_outbox_worker:
+            with self._outbox_lock:
+                worker = self._outbox_worker
+                if worker is None:
+                    worker = OutboxWorker(self, self._outbox)
+                    worker.start()
+                    self._outbox_worker = worker
+            worker.notify()
+        return queued_response(outbox_id)
+
+    def flush_outbox(self):
+        """Send every due email of the outbox now, in this thread"""
+        from .outbox import OutboxWorker
+
+        worker = OutboxWorker(self, self._outbox)
+        while worker.drain_once():
+            pass
+
+    def prepare_send(
+        self,
+        email_id,
+        sender=None,
+        cc=None,
+        bcc=None,
+        tags=None,
+        headers=None,
+        esp_account=None,
+        locale=None,
+        email_version_name=None,
+        inline=None,
+        files=None
+    ):
+        """Validate and encode the fixed parts of a send once
+
+        Returns a `sendwithus.prepared.PreparedSend` whose
+        `send(recipient, email_data)` only encodes the recipient and
+        data, for sending the same template many times. Attachments are
+        read when the send is prepared.
+        """
+        fields = {'email_id': email_id}
+        fields.update(self._send_options(
+            sender=sender,
+            cc=cc,
+            bcc=bcc,
+            tags=tags,
+            headers=headers,
+            esp_account=esp_account,
+            locale=locale,
+            email_version_name=email_version_name,
+            inline=inline,
+            files=files
+        ))
+        return PreparedSend(self, fields)
+
+    def _send_one(self, item):
+        index, kwargs = item
+        try:
+            return SendResult(index, kwargs, response=self.send(**kwargs))
+        except Exception as e:
+            return SendResult(index, kwargs, error=e)
+
+    def send_many(self, sends, concurrency=10, ordered=True):
+        """Send many emails concurrently
+
+        `sends` is any iterable of dicts of `send()` keyword arguments; it
+        is consumed lazily. At most `concurrency` sends are in flight at
+        once, so size `pool_maxsize` to match. Yields a `SendResult` per
+        send, in input order or, with `ordered=False`, as they complete.
+        Errors are captured on the result and never abort the run.
+        """
+        return imap_bounded(
+            self._send_one,
+            enumerate(sends),
+            concurrency,
+            ordered=ordered
         )
 
     def customer_create(self, email, data=None, locale=None, timeout=None):
@@ -641,6 +1272,229 @@ class api:
             timeout=timeout
         )
 
+    def _queue_customer_upsert(self, batch, customer):
+        if isinstance(customer, string_types):
+            return batch.customer_create(customer)
+        return batch.customer_create(
+            customer['email'],
+            data=customer.get('data'),
+            locale=customer.get('locale')
+        )
+
+    def _queue_customer_delete(self, batch, email):
+        return batch.customer_delete(email)
+
+    def _drip_recipient(self, row, email_data):
+        """Recipient and email data of a row of `drip_enroll_many`"""
+        if isinstance(row, string_types):
+            return {'address': row}, email_data
+        if not isinstance(row, dict):
+            raise ValueError('Invalid drip campaign recipient: %r' % (row,))
+        if 'recipient' not in row:
+            return row, email_data
+        recipient = row['recipient']
+        if isinstance(recipient, string_types):
+            recipient = {'address': recipient}
+        if row.get('email_data'):
+            email_data = dict(email_data, **row['email_data'])
+        return recipient, email_data
+
+    def _bulk_chunks(self, rows, batch_size):
+        """Yield `(offset, rows)` for every `batch_size` rows"""
+        if batch_size < 1:
+            raise ValueError('batch_size must be at least 1')
+        rows = iter(rows)
+        offset = 0
+        while True:
+            chunk = list(islice(rows, batch_size))
+            if not chunk:
+                return
+            yield offset, chunk
+            offset += len(chunk)
+
+    def _failed_batch_results(self, batch, error):
+        # a failed sub-batch stays queued on the batch
+        return [
+            BatchCommandResult(
+                {'status_code': None, 'body': None},
+                command,
+                error=error
+            )
+            for commands in batch._batches
+            for command in commands
+        ]
+
+    def _queue_rows(self, batch, queue, rows):
+        """Queue every row on `batch`, returning the errors of the rows
+        that could not be queued by their position in `rows`
+        """
+        errors = {}
+        for index, row in enumerate(rows):
+            try:
+                queue(batch, row)
+            except Exception as e:
+                logger.warning('Bulk row could not be queued: %r', e)
+                errors[index] = e
+        return errors
+
+    def _with_row_errors(self, results, errors):
+        """Slot failed results for the rows that could not be queued in
+        between the results of the queued ones, so they line up with
+        the rows again
+        """
+        if not errors:
+            return results
+        queued = iter(results)
+        return [
+            BatchCommandResult(
+                {'status_code': None, 'body': None},
+                None,
+                error=errors[index]
+            ) if index in errors else next(queued)
+            for index in range(len(results) + len(errors))
+        ]
+
+    def _bulk_batch(self, queue, timeout, idempotent, chunk):
+        offset, rows = chunk
+        batch = self.start_batch(auto_flush=False)
+        errors = self._queue_rows(batch, queue, rows)
+        if not batch.command_length():
+            return offset, self._with_row_errors([], errors), None
+        try:
+            result = batch.execute(timeout=timeout, idempotent=idempotent)
+        except Exception as e:
+            logger.warning('Bulk batch of %s rows failed: %r', len(rows), e)
+            results = self._failed_batch_results(batch, e)
+            return offset, self._with_row_errors(results, errors), e
+        return offset, self._with_row_errors(result.results, errors), None
+
+    def _bulk_outcomes(
+        self,
+        rows,
+        queue,
+        batch_size,
+        parallel,
+        timeout,
+        idempotent,
+        ordered=False
+    ):
+        """Yield `(offset, results, error)` for every batch of `rows`
+
+        Every `batch_size` rows are queued with `queue(batch, row)` on a
+        `BatchAPI` of their own and executed, `parallel` at a time. Each
+        batch request goes through the rate limiter and retry policy.
+        """
+        return imap_bounded(
+            lambda chunk: self._bulk_batch(queue, timeout, idempotent, chunk),
+            self._bulk_chunks(rows, batch_size),
+            parallel,
+            ordered=ordered
+        )
+
+    def _bulk(
+        self,
+        rows,
+        queue,
+        batch_size,
+        parallel,
+        on_progress,
+        max_failures,
+        timeout
+    ):
+        result = BulkResult(max_failures)
+        # customer upserts and deletes are safe to repeat
+        outcomes = self._bulk_outcomes(
+            rows,
+            queue,
+            batch_size,
+            parallel,
+            timeout,
+            idempotent=True
+        )
+        for offset, results, error in outcomes:
+            result.add(offset, results, error)
+            if on_progress is not None:
+                on_progress(result)
+        return result
+
+    def _iter_bulk(
+        self,
+        rows,
+        queue,
+        batch_size,
+        parallel,
+        timeout,
+        idempotent,
+        ordered
+    ):
+        """Yield a `BatchCommandResult` per row, indexed by its position"""
+        outcomes = self._bulk_outcomes(
+            rows,
+            queue,
+            batch_size,
+            parallel,
+            timeout,
+            idempotent,
+            ordered
+        )
+        for offset, results, error in outcomes:
+            for index, result in enumerate(results):
+                result.index = offset + index
+                yield result
+
+    def customers_bulk_upsert(
+        self,
+        customers,
+        batch_size=500,
+        parallel=4,
+        on_progress=None,
+        max_failures=1000,
+        timeout=None
+    ):
+        """Create or update many customers through the batch endpoint
+
+        `customers` is any iterable, e.g. a generator over database rows,
+        of email addresses or of dicts with an `email` and optionally
+        `data` and `locale`. It is consumed lazily, `batch_size` rows per
+        batch request with `parallel` requests in flight, so memory
+        stays flat however many rows there are. `on_progress` is called
+        with the `BulkResult` after every batch. Returns the
+        `BulkResult`, listing the rows that failed.
+        """
+        return self._bulk(
+            customers,
+            self._queue_customer_upsert,
+            batch_size,
+            parallel,
+            on_progress,
+            max_failures,
+            timeout
+        )
+
+    def customers_bulk_delete(
+        self,
+        emails,
+        batch_size=500,
+        parallel=4,
+        on_progress=None,
+        max_failures=1000,
+        timeout=None
+    ):
+        """Delete many customers through the batch endpoint
+
+        `emails` is any iterable of email addresses, consumed lazily like
+        the rows of `customers_bulk_upsert`. Returns a `BulkResult`.
+        """
+        return self._bulk(
+            emails,
+            self._queue_customer_delete,
+            batch_size,
+            parallel,
+            on_progress,
+            max_failures,
+            timeout
+        )
+
     def list_drip_campaigns(self, timeout=None):
         return self._api_request(
             self.DRIP_CAMPAIGN_LIST_ENDPOINT,
@@ -668,44 +1522,14 @@ class api:
             'email_data': email_data
         }
 
-        # Optional params
-
-        if sender:
-            payload['sender'] = sender
-
-        if cc:
-            if not isinstance(cc, list):
-                logger.error(
-                    'kwarg cc must be type(list), got %s' % type(cc))
-            payload['cc'] = cc
-
-        if bcc:
-            if not isinstance(cc, list):
-                logger.error(
-                    'kwarg bcc must be type(list), got %s' % type(bcc))
-            payload['bcc'] = bcc
-
-        if tags:
-            if not isinstance(cc, list):
-                logger.error(
-                    'kwarg tags must be type(list), got %s' % (type(tags)))
-            payload['tags'] = tags
-
-        if esp_account:
-            if not isinstance(esp_account, string_types):
-                logger.error(
-                    'kwarg esp_account must be a string, got %s' % (
-                        type(esp_account)
-                    )
-                )
-            payload['esp_account'] = esp_account
-
-        if locale:
-            if not isinstance(locale, string_types):
-                logger.error(
-                    'kwarg locale must be a string, got %s' % (type(locale))
-                )
-            payload['locale'] = locale
+        payload.update(self._send_options(
+            sender=sender,
+            cc=cc,
+            bcc=bcc,
+            tags=tags,
+            esp_account=esp_account,
+            locale=locale
+        ))
 
         return self._api_request(
             endpoint,
@@ -714,6 +1538,96 @@ class api:
             timeout=timeout
         )
 
+    def drip_enroll_many(
+        self,
+        drip_campaign_id,
+        recipients,
+        email_data=None,
+        sender=None,
+        cc=None,
+        bcc=None,
+        tags=None,
+        esp_account=None,
+        locale=None,
+        batch_size=500,
+        parallel=4,
+        ordered=True,
+        timeout=None
+    ):
+        """Start many recipients on a drip campaign in batches
+
+        `recipients` is any iterable of email addresses, recipient dicts
+        or dicts with a `recipient` and its own `email_data`, which is
+        merged over the shared `email_data`. The other options are those
+        of `start_on_drip_campaign`, validated once and used for every
+        recipient. Recipients are consumed lazily and sent
+        `batch_size` per batch request, `parallel` requests at a time.
+
+        Returns an iterator of `BatchCommandResult`, one per recipient
+        with `index` set to its position in `recipients`, in input order
+        or, with `ordered=False`, as batches complete. Nothing is sent
+        until it is iterated.
+        """
+        endpoint = self.DRIP_CAMPAIGN_ACTIVATE_ENDPOINT % drip_campaign_id
+        options = self._send_options(
+            sender=sender,
+            cc=cc,
+            bcc=bcc,
+            tags=tags,
+            esp_account=esp_account,
+            locale=locale
+        )
+        shared_data = email_data or {}
+
+        def queue(batch, row):
+            recipient, data = self._drip_recipient(row, shared_data)
+            payload = {'recipient': recipient, 'email_data': data}
+            payload.update(options)
+            batch._api_request(endpoint, self.HTTP_POST, payload=payload)
+
+        return self._iter_bulk(
+            recipients,
+            queue,
+            batch_size,
+            parallel,
+            timeout,
+            False,
+            ordered
+        )
+
+    def drip_remove_many(
+        self,
+        drip_campaign_id,
+        recipient_addresses,
+        batch_size=500,
+        parallel=4,
+        ordered=True,
+        timeout=None
+    ):
+        """Remove many recipients from a drip campaign in batches
+
+        `recipient_addresses` is any iterable of email addresses,
+        consumed lazily like the recipients of `drip_enroll_many`.
+        Returns an iterator of `BatchCommandResult`, one per address.
+        """
+        def queue(batch, address):
+            if not isinstance(address, string_types):
+                raise ValueError(
+                    'Invalid recipient address: %r' % (address,)
+                )
+            batch.remove_from_drip_campaign(address, drip_campaign_id)
+
+        # removing a recipient twice leaves it removed
+        return self._iter_bulk(
+            recipient_addresses,
+            queue,
+            batch_size,
+            parallel,
+            timeout,
+            True,
+            ordered
+        )
+
     def remove_from_drip_campaign(
         self,
         recipient_address,
@@ -741,15 +1655,123 @@ class api:
             timeout=timeout
         )
 
-    def start_batch(self):
-        return BatchAPI(
+    def _page_items(self, body):
+        # pages are a list, or an object listing them under 'customers'
+        if isinstance(body, dict):
+            return body.get('customers') or []
+        return body or []
+
+    def _fetch_page(self, endpoint, page_size, timeout, offset):
+        r = self._api_request(
+            endpoint,
+            self.HTTP_GET,
+            params={'count': page_size, 'offset': offset},
+            timeout=timeout
+        )
+        self._raise_for_status(r)
+        items = self._page_items(r.json())
+        # a page of another size is the last, also when the server
+        # ignored the parameters and sent the whole listing
+        if len(items) != page_size:
+            return items, None
+        return items, offset + len(items)
+
+    def _iter_pages(self, endpoint, page_size, prefetch, timeout):
+        """Iterate over the items of a listing fetched `page_size` at a
+        time with `count` and `offset` parameters
+
+        Assumes the endpoint pages with those parameters; the listing
+        ends at the first page with fewer or more than `page_size` items.
+        """
+        if page_size < 1:
+            raise ValueError('page_size must be at least 1')
+        return iter_prefetched(
+            lambda offset: self._fetch_page(
+                endpoint,
+                page_size,
+                timeout,
+                offset
+            ),
+            0,
+            prefetch
+        )
+
+    def iter_drip_campaign_customers(
+        self,
+        drip_campaign_id,
+        page_size=100,
+        prefetch=True,
+        timeout=None
+    ):
+        """Iterate over the customers on a drip campaign
+
+        Customers are fetched lazily, `page_size` per request. With
+        `prefetch` the next page is requested in the background while
+        the current one is consumed. Failed requests raise the matching
+        `sendwithus.exceptions` error.
+        """
+        return self._iter_pages(
+            self.DRIP_CAMPAIGN_CUSTOMERS_ENDPOINT % drip_campaign_id,
+            page_size,
+            prefetch,
+            timeout
+        )
+
+    def iter_drip_step_customers(
+        self,
+        drip_campaign_id,
+        drip_step_id,
+        page_size=100,
+        prefetch=True,
+        timeout=None
+    ):
+        """Iterate over the customers on a step of a drip campaign, like
+        `iter_drip_campaign_customers`
+        """
+        return self._iter_pages(
+            self.DRIP_CAMPAIGN_STEP_CUSTOMERS_ENDPOINT % (
+                drip_campaign_id,
+                drip_step_id
+            ),
+            page_size,
+            prefetch,
+            timeout
+        )
+
+    def _client_options(self):
+        """Options shared with clients derived from this one"""
+        return dict(
             api_key=self.API_KEY,
             API_HOST=self.API_HOST,
             API_PROTO=self.API_PROTO,
             API_PORT=self.API_PORT,
             API_VERSION=self.API_VERSION,
             DEBUG=self.DEBUG,
-            json_encoder=self._json_encoder
+            DEBUG_BODY_LIMIT=self.DEBUG_BODY_LIMIT,
+            json_encoder=self._json_encoder,
+            default_timeout=self.DEFAULT_TIMEOUT,
+            retry_policy=self._retry_policy,
+            rate_limiter=self._rate_limiter,
+            cache=self._cache,
+            stream_payloads=self._stream_payloads,
+            json_backend=self._json,
+            on_request=self._on_request,
+            on_response=self._on_response,
+            tracing=self._tracing,
+            idempotency_keys=self._idempotency_keys,
+            dedupe_window=self._dedupe_window,
+            compression=self._compression,
+            compression_threshold=self._compression_threshold,
+            compression_level=self._compression_level,
+            session=self._session
+        )
+
+    def start_batch(self, max_commands=None, max_bytes=None, auto_flush=True):
+        return BatchAPI(
+            max_commands=max_commands,
+            max_bytes=max_bytes,
+            auto_flush=auto_flush,
+            **self._client_options()
         )
 
     def render(
@@ -789,63 +1811,259 @@ class api:
 
 
 class BatchAPI(api):
+    """Queues API calls and sends them through the batch endpoint
+
+    Commands are encoded as they are queued. Once the current sub-batch
+    reaches `max_commands` commands or `max_bytes` encoded bytes it is
+    closed and, with `auto_flush` (the default), sent right away, so
+    memory stays flat however many commands are queued. `execute()`
+    sends whatever is left and returns a `BatchResult` covering every
+    sub-batch.
+    """
 
     def __init__(self, *args, **kwargs):
+        self._max_commands = kwargs.pop('max_commands', None)
+        self._max_bytes = kwargs.pop('max_bytes', None)
+        self._auto_flush = kwargs.pop('auto_flush', True)
         api.__init__(self, *args, **kwargs)
+        self._batches = []
+        self._responses = []
+        self._results = []
+        self._mutated_endpoints = set()
+        self._reset_commands()
+
+    def _reset_commands(self):
         self._commands = []
+        # account for the enclosing brackets of the JSON array
+        self._commands_bytes = 2
 
     def _api_request(self, endpoint, http_method, *args, **kwargs):
         """Private method for api requests"""
-        logger.debug(' > Queing batch api request for endpoint: %s' % endpoint)
+        logger.debug(' > Queing batch api request for endpoint: %s', endpoint)
 
         path = self._build_request_path(endpoint, absolute=False)
-        logger.debug('\tpath: %s' % path)
-
         data = None
         if 'payload' in kwargs:
             data = kwargs['payload']
-        logger.debug('\tdata: %s' % data)
+        # a body already encoded as JSON, see PreparedSend
+        encoded_payload = kwargs.get('encoded_payload')
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('\tpath: %s', path)
+            logger.debug('\tdata: %s', self._log_body(data or encoded_payload))
 
         command = {
             "path": path,
             "method": http_method
         }
+        if kwargs.get('idempotency_key') is not None:
+            command['headers'] = {
+                self.API_HEADER_IDEMPOTENCY: kwargs['idempotency_key']
+            }
         if data:
             command['body'] = data
 
-        self._commands.append(command)
+        if self._cache is not None and http_method != self.HTTP_GET:
+            self._mutated_endpoints.add(endpoint)
+            self._cache.invalidate(endpoint)
+
+        encoded = self._encode_json(command)
+        if encoded_payload:
+            encoded = '%s,"body":%s}' % (encoded[:-1], encoded_payload)
+        self._queue_command(encoded)
+
+    def _queue_command(self, encoded):
+        # kept as UTF-8, so sizes are bytes whatever the encoder output
+        if not isinstance(encoded, bytes):
+            encoded = encoded.encode('utf-8')
+        size = len(encoded)
+        if self._commands:
+            # a comma separates the command from the previous one
+            size += 1
+            if (self._max_bytes is not None and
+                    self._commands_bytes + size > self._max_bytes):
+                self._close_batch()
+                size -= 1
+
+        self._commands.append(encoded)
+        self._commands_bytes += size
+
+        if (self._max_commands is not None and
+                len(self._commands) >= self._max_commands):
+            self._close_batch()
+
+    def _close_batch(self):
+        logger.debug(
+            '\tclosing sub-batch (%s commands, %s bytes)',
+            len(self._commands),
+            self._commands_bytes
+        )
+        self._batches.append(self._commands)
+        self._reset_commands()
+
+        if self._auto_flush:
+            self._flush()
+
+    def _flush(self, timeout=None, parallel=1, idempotent=False):
+        """Send every closed sub-batch, `parallel` of them at a time
+
+        Responses are kept in queue order. Sub-batches that could not be
+        sent stay queued and the first error is raised once the others
+        have been attempted.
+        """
+        batches, self._batches = self._batches, []
 
-    def execute(self, timeout=None):
-        """Execute all currently queued batch commands"""
-        logger.debug(' > Batch API request (length %s)' % len(self._commands))
+        def post(commands):
+            event = self._new_event(
+                self.BATCH_ENDPOINT,
+                self.HTTP_POST,
+                commands=len(commands)
+            )
+            try:
+                r = self._post_batch(commands, timeout, idempotent, event)
+            except Exception as e:
+                self._request_finished(event, error=e)
+                return None, e
+
+            chunks = r.iter_content(self.RESPONSE_CHUNK_SIZE)
+            if event is not None:
+                chunks = event.count_response(chunks)
+            started = time.time()
+            try:
+                return (r, self._collect_batch(
+                    commands,
+                    r.status_code,
+                    chunks
+                )), None
+            finally:
+                r.close()
+                if event is not None:
+                    event.add_timing('parse', time.time() - started)
+                self._request_finished(event, r)
+
+        if parallel > 1:
+            outcomes = imap_bounded(post, batches, parallel)
+        else:
+            outcomes = (post(commands) for commands in batches)
+
+        error = None
+        for index, (outcome, exc) in enumerate(outcomes):
+            if exc is None:
+                response, results = outcome
+                self._responses.append(response)
+                self._results.extend(results)
+                continue
+
+            error = error or exc
+            self._batches.append(batches[index])
+            if parallel <= 1:
+                # sequential sends stop at the first failure
+                self._batches.extend(batches[index + 1:])
+                break
+
+        if error is not None:
+            raise error
+
+    def _post_batch(
+        self,
+        commands,
+        timeout=None,
+        idempotent=False,
+        event=None
+    ):
+        logger.debug(' > Batch API request (length %s)', len(commands))
 
         auth = self._build_http_auth()
 
         headers = self._build_request_headers()
-        logger.debug('\tbatch headers: %s' % headers)
-
-        logger.debug('\tbatch command length: %s' % len(self._commands))
+        logger.debug('\tbatch headers: %s', headers)
 
         path = self._build_request_path(self.BATCH_ENDPOINT)
 
-        data = json.dumps(self._commands, cls=self._json_encoder)
-        r = requests.post(
-            path,
-            auth=auth,
-            headers=headers,
-            data=data,
-            timeout=(self.DEFAULT_TIMEOUT if timeout is None else timeout)
+        data = self._compress_body(JSONArrayBody(commands), headers)
+        if event is not None:
+            event.path = path
+        self._request_started(event, data, headers)
+        # the response is streamed into per-command results, see execute()
+        r = self._send_with_retries(
+            lambda: self._session.request(
+                self.HTTP_POST,
+                path,
+                auth=auth,
+                headers=headers,
+                data=data,
+                timeout=(self.DEFAULT_TIMEOUT if timeout is None else timeout),
+                stream=True
+            ),
+            idempotent,
+            event
         )
 
-        self._commands = []
+        logger.debug('\tresponse code:%s', r.status_code)
+
+        return r
+
+    def _collect_batch(self, commands, status_code, chunks):
+        """Pair every command of a sub-batch with its response entry
+
+        `chunks` yields the raw response body, which is parsed one entry
+        at a time. When the batch request itself failed, its error is
+        attributed to every command.
+        """
+        if status_code >= 400:
+            content = b''.join(chunks)
+            try:
+                body = self._json.loads(content)
+            except ValueError:
+                body = content.decode('utf-8', 'replace')
+            entry = {'status_code': status_code, 'body': body}
+            return [BatchCommandResult(entry, c) for c in commands]
+
+        entries = iter_json_array(chunks)
+        results = []
+        for command in commands:
+            try:
+                entry = next(entries, None)
+            except ValueError as e:
+                logger.error('Invalid batch response: %s', e)
+                entries = iter([])
+                entry = None
+            if entry is None:
+                entry = {'status_code': None, 'body': None}
+            results.append(BatchCommandResult(entry, command))
+        return results
+
+    def execute(self, timeout=None, parallel=1, idempotent=False):
+        """Execute all currently queued batch commands
+
+        Returns a `BatchResult` with a parsed result per command sent
+        since the last call, including sub-batches flushed automatically
+        while queueing. Pending sub-batches are sent `parallel` at a time
+        over the shared connection pool; results stay in queue order.
+        Batch requests are only retried after server errors and timeouts
+        when every queued command is safe to repeat and `idempotent=True`.
+        """
+        if self._tracing is None:
+            return self._execute(timeout, parallel, idempotent)
+        with self._tracing.batch(self.command_length()):
+            return self._execute(timeout, parallel, idempotent)
+
+    def _execute(self, timeout, parallel, idempotent):
+        if self._commands or not (self._batches or self._responses):
+            self._batches.append(self._commands)
+            self._reset_commands()
 
-        logger.debug('\tresponse code:%s' % r.status_code)
         try:
-            logger.debug('\tresponse: %s' % r.json())
-        except Exception:
-            logger.debug('\tresponse: %s' % r.content)
+            self._flush(timeout, parallel, idempotent)
+        finally:
+            # lookups made while the batch was queued may be stale now
+            for endpoint in self._mutated_endpoints:
+                self._cache.invalidate(endpoint)
+            self._mutated_endpoints.clear()
 
-        return r
+        responses, self._responses = self._responses, []
+        results, self._results = self._results, []
+        return BatchResult(responses, results)
 
     def command_length(self):
-        return len(self._commands)
+        return len(self._commands) + sum(len(b) for b in self._batches)
@@ -0,0 +1,681 @@
+"""
+sendwithus - asyncio client
+
+Requires Python 3.6+ and aiohttp (`pip install sendwithus[aio]`).
+"""
+
+import asyncio
+import base64
+import json
+import logging
+import time
+from collections import deque
+from itertools import islice
+
+import aiohttp
+from multidict import CIMultiDict
+
+from . import BatchAPI, api, logger
+from .results import BatchResult, BulkResult, SendResult
+from .streaming import JSONArrayBody, StreamingBody
+
+
+class Response(object):
+    """A fully read API response
+
+    Mirrors the parts of `requests.Response` that callers of the
+    synchronous client rely on, so code can move between the two
+    clients unchanged.
+    """
+
+    def __init__(self, status_code, headers, content, url=None):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.url = url
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def json(self, **kwargs):
+        return json.loads(self.text, **kwargs)
+
+    def close(self):
+        pass
+
+    def __repr__(self):
+        return '<Response [%s]>' % self.status_code
+
+
+class AsyncAPI(api):
+    """asyncio flavour of `sendwithus.api`
+
+    Every public method of `api` is available and returns a coroutine,
+    e.g. `await swu.send(email_id, recipient)`. Payloads are built by
+    the same code as the synchronous client. Requests go through a
+    pooled `aiohttp.ClientSession` which is created on first use, so
+    the client must be used from within a running event loop.
+    """
+
+    # seconds between checks for a duplicate send in flight elsewhere
+    DEDUPE_POLL_INTERVAL = 0.01
+
+    def __init__(self, *args, **kwargs):
+        if kwargs.get('outbox') is not None:
+            raise ValueError('The asyncio client does not support an outbox')
+        api.__init__(self, *args, **kwargs)
+
+    def _build_session(
+        self,
+        pool_connections,
+        pool_maxsize,
+        max_retries,
+        keep_alive
+    ):
+        # aiohttp sessions are bound to the running loop, so creation is
+        # deferred to the first request. max_retries has no aiohttp
+        # equivalent and is ignored.
+        self._pool_maxsize = pool_maxsize
+        self._keep_alive = keep_alive
+        return None
+
+    def _get_session(self):
+        if self._session is None:
+            connector = aiohttp.TCPConnector(
+                limit=self._pool_maxsize,
+                force_close=not self._keep_alive
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """Release the pooled connections held by this client"""
+        if self._owns_session and self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _build_timeout(self, timeout):
+        if timeout is None:
+            return aiohttp.ClientTimeout(total=None)
+        if isinstance(timeout, tuple):
+            connect, read = timeout
+            return aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+        return aiohttp.ClientTimeout(total=timeout)
+
+    def _build_http_auth(self):
+        credentials = ('%s:' % self.API_KEY).encode('utf-8')
+        return 'Basic %s' % base64.b64encode(credentials).decode('ascii')
+
+    def _is_transport_error(self, error):
+        return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+
+    def _is_connect_error(self, error):
+        return isinstance(error, aiohttp.ClientConnectorError)
+
+    async def _throttle(self, event=None):
+        if self._rate_limiter is not None:
+            wait = self._rate_limiter.reserve()
+            if wait:
+                logger.debug('\tthrottled for %.3fs', wait)
+                if event is not None:
+                    event.add_timing('throttle', wait)
+                await asyncio.sleep(wait)
+
+    def _timed(self, send, event):
+        async def timed_send():
+            start = time.time()
+            try:
+                return await send()
+            finally:
+                event.add_timing('request', time.time() - start)
+        return timed_send
+
+    async def _send_with_retries(self, send, idempotent=False, event=None):
+        """Await `send()` until it succeeds or the retry policy gives up"""
+        if event is not None:
+            send = self._timed(send, event)
+
+        policy = self._retry_policy
+        if policy is None:
+            await self._throttle(event)
+            return await send()
+
+        start = time.time()
+        attempt = 0
+        while True:
+            attempt += 1
+            await self._throttle(event)
+            try:
+                r = await send()
+            except Exception as e:
+                if not self._is_transport_error(e):
+                    raise
+                delay = policy.get_retry_delay(
+                    attempt,
+                    time.time() - start,
+                    idempotent,
+                    sent=not self._is_connect_error(e)
+                )
+                if delay is None:
+                    raise
+                logger.debug('\tretrying in %.2fs after %r', delay, e)
+            else:
+                delay = policy.get_retry_delay(
+                    attempt,
+                    time.time() - start,
+                    idempotent,
+                    status_code=r.status_code,
+                    retry_after=r.headers.get('Retry-After')
+                )
+                if delay is None:
+                    return r
+                logger.debug(
+                    '\tretrying in %.2fs after response code:%s',
+                    delay,
+                    r.status_code
+                )
+
+            if event is not None:
+                event.retries = attempt
+                event.add_timing('backoff', delay)
+            await asyncio.sleep(delay)
+
+    async def _send_request(
+        self,
+        http_method,
+        path,
+        headers,
+        data,
+        timeout,
+        idempotent=False,
+        event=None
+    ):
+        return await self._send_with_retries(
+            lambda: self._send_once(http_method, path, headers, data, timeout),
+            idempotent,
+            event
+        )
+
+    async def _stream_body(self, body):
+        for chunk in body:
+            yield chunk
+
+    async def _send_once(self, http_method, path, headers, data, timeout):
+        headers = dict(headers, Authorization=self._build_http_auth())
+        session = self._get_session()
+        if not isinstance(session, aiohttp.ClientSession):
+            # an in-process transport such as MemoryTransport, which
+            # answers synchronously
+            r = session.request(
+                http_method,
+                path,
+                data=data,
+                headers=headers,
+                timeout=timeout
+            )
+            return Response(
+                r.status_code,
+                CIMultiDict(r.headers),
+                r.content,
+                url=r.url
+            )
+
+        if isinstance(data, StreamingBody):
+            # the body is produced in chunks while the request is sent
+            if len(data):
+                headers['Content-Length'] = str(len(data))
+            data = self._stream_body(data)
+        async with session.request(
+            http_method,
+            path,
+            data=data,
+            headers=headers,
+            timeout=self._build_timeout(timeout)
+        ) as r:
+            content = await r.read()
+            return Response(
+                r.status,
+                CIMultiDict(r.headers),
+                content,
+                url=str(r.url)
+            )
+
+    async def _api_request(self, endpoint, http_method, *args, **kwargs):
+        """Private method for api requests"""
+        key = kwargs.get('idempotency_key')
+        if key is None or self._dedupe_window is None:
+            return await self._request(endpoint, http_method, **kwargs)
+
+        while True:
+            previous, claimed = self._dedupe_window.acquire(
+                key,
+                blocking=False
+            )
+            if claimed or previous is not None:
+                break
+            # in flight elsewhere; waiting on the window would block the loop
+            await asyncio.sleep(self.DEDUPE_POLL_INTERVAL)
+        if not claimed:
+            logger.debug('\tidempotency key %s was already sent', key)
+            return self._parse_response(previous)
+        r = None
+        try:
+            r = await self._request(endpoint, http_method, **kwargs)
+            return r
+        finally:
+            self._dedupe_window.release(key, r)
+
+    async def _request(self, endpoint, http_method, **kwargs):
+        logger.debug(' > Sending API request to endpoint: %s', endpoint)
+
+        cached = self._get_cached(
+            endpoint,
+            http_method,
+            kwargs.get('params')
+        )
+        if cached is not None:
+            event = self._new_event(endpoint, http_method)
+            if event is not None:
+                event.template_id = self._template_id(endpoint, None)
+                event.cached = True
+                self._request_finished(event, cached)
+            return cached
+
+        headers = self._build_request_headers(kwargs.get('headers'))
+        headers.update(self._conditional_headers(
+            endpoint,
+            http_method,
+            kwargs.get('params')
+        ))
+        if kwargs.get('idempotency_key') is not None:
+            headers[self.API_HEADER_IDEMPOTENCY] = kwargs['idempotency_key']
+        path = self._build_request_path(endpoint, params=kwargs.get('params'))
+        started = time.time()
+        data = self._build_payload(kwargs.get('payload'))
+        if not data:
+            data = kwargs.get('encoded_payload') or kwargs.get('data')
+
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug('\theaders: %s', headers)
+            logger.debug('\tpath: %s', path)
+            logger.debug('\tdata: %s', self._log_body(data))
+
+        # only POST and PUT carry a request body
+        if http_method not in (self.HTTP_POST, self.HTTP_PUT):
+            data = None
+        if http_method not in (self.HTTP_POST, self.HTTP_PUT,
+                               self.HTTP_DELETE):
+            http_method = self.HTTP_GET
+        data = self._compress_body(data, headers)
+
+        event = self._new_event(endpoint, http_method, path)
+        if event is not None:
+            event.template_id = self._template_id(
+                endpoint,
+                kwargs.get('payload')
+            )
+            event.add_timing('encode', time.time() - started)
+        self._request_started(event, data, headers)
+
+        try:
+            r = await self._send_request(
+                http_method,
+                path,
+                headers,
+                data,
+                kwargs.get('timeout', self.DEFAULT_TIMEOUT),
+                kwargs.get('idempotent', http_method == self.HTTP_GET),
+                event
+            )
+        except Exception as e:
+            self._request_finished(event, error=e)
+            raise
+        r = self._update_cache(endpoint, http_method, r, kwargs.get('params'))
+        if event is not None:
+            event.response_bytes = len(r.content)
+        self._request_finished(event, r)
+
+        if debug:
+            logger.debug('\tresponse code:%s', r.status_code)
+            logger.debug('\tresponse: %s', self._log_body(r.content))
+
+        return self._parse_response(r)
+
+    async def _send_one(self, index, kwargs):
+        try:
+            return SendResult(
+                index,
+                kwargs,
+                response=await self.send(**kwargs)
+            )
+        except Exception as e:
+            return SendResult(index, kwargs, error=e)
+
+    async def send_many(self, sends, concurrency=10, ordered=True):
+        """Send many emails concurrently
+
+        Async generator counterpart of `api.send_many`:
+        `async for result in swu.send_many(sends): ...`
+        """
+        if concurrency < 1:
+            raise ValueError('concurrency must be at least 1')
+
+        items = enumerate(sends)
+
+        def submit(batch_size):
+            return [
+                asyncio.ensure_future(self._send_one(index, kwargs))
+                for index, kwargs in islice(items, batch_size)
+            ]
+
+        if ordered:
+            pending = deque(submit(concurrency))
+            while pending:
+                result = await pending.popleft()
+                pending.extend(submit(1))
+                yield result
+        else:
+            pending = set(submit(concurrency))
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                pending.update(submit(len(done)))
+                for task in done:
+                    yield task.result()
+
+    async def _bulk_batch(self, queue, timeout, idempotent, chunk):
+        offset, rows = chunk
+        batch = self.start_batch()
+        errors = self._queue_rows(batch, queue, rows)
+        if not batch.command_length():
+            return offset, self._with_row_errors([], errors), None
+        try:
+            result = await batch.execute(
+                timeout=timeout,
+                idempotent=idempotent
+            )
+        except Exception as e:
+            logger.warning('Bulk batch of %s rows failed: %r', len(rows), e)
+            results = self._failed_batch_results(batch, e)
+            return offset, self._with_row_errors(results, errors), e
+        return offset, self._with_row_errors(result.results, errors), None
+
+    async def _bulk_outcomes(
+        self,
+        rows,
+        queue,
+        batch_size,
+        parallel,
+        timeout,
+        idempotent,
+        ordered=False
+    ):
+        if parallel < 1:
+            raise ValueError('parallel must be at least 1')
+
+        chunks = self._bulk_chunks(rows, batch_size)
+
+        def submit(count):
+            return [
+                asyncio.ensure_future(
+                    self._bulk_batch(queue, timeout, idempotent, chunk)
+                )
+                for chunk in islice(chunks, count)
+            ]
+
+        if ordered:
+            pending = deque(submit(parallel))
+            while pending:
+                outcome = await pending.popleft()
+                pending.extend(submit(1))
+                yield outcome
+        else:
+            pending = set(submit(parallel))
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                pending.update(submit(len(done)))
+                for task in done:
+                    yield task.result()
+
+    async def _bulk(
+        self,
+        rows,
+        queue,
+        batch_size,
+        parallel,
+        on_progress,
+        max_failures,
+        timeout
+    ):
+        result = BulkResult(max_failures)
+        outcomes = self._bulk_outcomes(
+            rows,
+            queue,
+            batch_size,
+            parallel,
+            timeout,
+            idempotent=True
+        )
+        async for offset, results, error in outcomes:
+            result.add(offset, results, error)
+            if on_progress is not None:
+                on_progress(result)
+        return result
+
+    async def _iter_bulk(
+        self,
+        rows,
+        queue,
+        batch_size,
+        parallel,
+        timeout,
+        idempotent,
+        ordered
+    ):
+        """Async generator counterpart of `api._iter_bulk`"""
+        outcomes = self._bulk_outcomes(
+            rows,
+            queue,
+            batch_size,
+            parallel,
+            timeout,
+            idempotent,
+            ordered
+        )
+        async for offset, results, error in outcomes:
+            for index, result in enumerate(results):
+                result.index = offset + index
+                yield result
+
+    async def _fetch_page(self, endpoint, page_size, timeout, offset):
+        r = await self._api_request(
+            endpoint,
+            self.HTTP_GET,
+            params={'count': page_size, 'offset': offset},
+            timeout=timeout
+        )
+        self._raise_for_status(r)
+        items = self._page_items(r.json())
+        # a page of another size is the last, also when the server
+        # ignored the parameters and sent the whole listing
+        if len(items) != page_size:
+            return items, None
+        return items, offset + len(items)
+
+    async def _iter_pages(self, endpoint, page_size, prefetch, timeout):
+        """Async generator counterpart of `api._iter_pages`"""
+        if page_size < 1:
+            raise ValueError('page_size must be at least 1')
+
+        def fetch(offset):
+            return asyncio.ensure_future(
+                self._fetch_page(endpoint, page_size, timeout, offset)
+            )
+
+        task = fetch(0)
+        try:
+            while task is not None:
+                items, offset = await task
+                task = None
+                if prefetch and offset is not None:
+                    task = fetch(offset)
+                for item in items:
+                    yield item
+                if task is None and offset is not None:
+                    task = fetch(offset)
+        finally:
+            if task is not None:
+                task.cancel()
+
+    def _client_options(self):
+        options = api._client_options(self)
+        options['session'] = self._get_session()
+        return options
+
+    def start_batch(self, max_commands=None, max_bytes=None):
+        return AsyncBatchAPI(
+            max_commands=max_commands,
+            max_bytes=max_bytes,
+            **self._client_options()
+        )
+
+
+class AsyncBatchAPI(BatchAPI, AsyncAPI):
+    """asyncio flavour of `sendwithus.BatchAPI`
+
+    Commands are queued synchronously exactly like `BatchAPI`, and split
+    into sub-batches by `max_commands` and `max_bytes`. Queueing cannot
+    send, so sub-batches are held until the `execute()` coroutine.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs['auto_flush'] = False
+        BatchAPI.__init__(self, *args, **kwargs)
+
+    async def _post_batch(
+        self,
+        commands,
+        timeout=None,
+        idempotent=False,
+        event=None
+    ):
+        logger.debug(' > Batch API request (length %s)', len(commands))
+
+        headers = self._build_request_headers()
+        logger.debug('\tbatch headers: %s', headers)
+
+        path = self._build_request_path(self.BATCH_ENDPOINT)
+
+        data = self._compress_body(JSONArrayBody(commands), headers)
+        if event is not None:
+            event.path = path
+        self._request_started(event, data, headers)
+        r = await self._send_request(
+            self.HTTP_POST,
+            path,
+            headers,
+            data,
+            self.DEFAULT_TIMEOUT if timeout is None else timeout,
+            idempotent,
+            event
+        )
+
+        logger.debug('\tresponse code:%s', r.status_code)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('\tresponse: %s', self._log_body(r.content))
+
+        return r
+
+    async def execute(self, timeout=None, parallel=1, idempotent=False):
+        """Execute all currently queued batch commands
+
+        Sub-batches are sent `parallel` at a time; results stay in queue
+        order. Sub-batches that could not be sent stay queued and the
+        first error is raised.
+        """
+        if self._tracing is None:
+            return await self._execute(timeout, parallel, idempotent)
+        with self._tracing.batch(self.command_length()):
+            return await self._execute(timeout, parallel, idempotent)
+
+    async def _execute(self, timeout, parallel, idempotent):
+        if self._commands or not self._batches:
+            self._batches.append(self._commands)
+            self._reset_commands()
+
+        batches, self._batches = self._batches, []
+        semaphore = asyncio.Semaphore(max(parallel, 1))
+
+        async def post(commands, event):
+            async with semaphore:
+                try:
+                    return await self._post_batch(
+                        commands,
+                        timeout,
+                        idempotent,
+                        event
+                    )
+                except Exception as e:
+                    self._request_finished(event, error=e)
+                    raise
+
+        events = [
+            self._new_event(
+                self.BATCH_ENDPOINT,
+                self.HTTP_POST,
+                commands=len(commands)
+            )
+            for commands in batches
+        ]
+
+        outcomes = await asyncio.gather(
+            *[post(c, e) for c, e in zip(batches, events)],
+            return_exceptions=True
+        )
+
+        for endpoint in self._mutated_endpoints:
+            self._cache.invalidate(endpoint)
+        self._mutated_endpoints.clear()
+
+        responses = []
+        results = []
+        error = None
+        for commands, event, outcome in zip(batches, events, outcomes):
+            if isinstance(outcome, Exception):
+                error = error or outcome
+                self._batches.append(commands)
+                continue
+
+            started = time.time()
+            responses.append(outcome)
+            results.extend(self._collect_batch(
+                commands,
+                outcome.status_code,
+                [outcome.content]
+            ))
+            if event is not None:
+                event.response_bytes = len(outcome.content)
+                event.add_timing('parse', time.time() - started)
+            self._request_finished(event, outcome)
+
+        if error is not None:
+            raise error
+
+        return BatchResult(responses, results)
@@ -0,0 +1,174 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+def _segment(path):
+    """First segment of `path`, shared by every path related to it"""
+    return path.strip('/').split('/', 1)[0]
+
+
+class ResponseCache(object):
+    """Bounded LRU cache for responses of read-only API calls
+
+    Responses of GET requests to the endpoints in `ttls`, keyed by the
+    endpoint constant name such as `'TEMPLATES_SPECIFIC_ENDPOINT'`, are
+    kept for that many seconds. By default the template, snippet and
+    drip campaign lookups are cached for `ttl` seconds. At most
+    `maxsize` responses are kept; the least recently used go first.
+
+    Mutating calls made through a client using the cache invalidate the
+    entries for the affected paths automatically, and `invalidate()` can
+    be called directly.
+
+    Responses of the endpoints in `revalidate` that carry an ETag or
+    Last-Modified validator are kept after they expire, still subject to
+    `maxsize`. The next lookup then makes a conditional request and, if
+    the server answers 304 Not Modified, reuses the stored body. Those
+    endpoints are revalidated on every call when their TTL is 0.
+    """
+
+    CACHED_ENDPOINTS = (
+        'TEMPLATES_ENDPOINT',
+        'TEMPLATES_SPECIFIC_ENDPOINT',
+        'TEMPLATES_VERSION_ENDPOINT',
+        'SNIPPETS_ENDPOINT',
+        'SNIPPET_ENDPOINT',
+        'DRIP_CAMPAIGN_LIST_ENDPOINT',
+        'DRIP_CAMPAIGN_DETAILS_ENDPOINT',
+    )
+    REVALIDATED_ENDPOINTS = (
+        'TEMPLATES_ENDPOINT',
+        'TEMPLATES_SPECIFIC_ENDPOINT',
+        'TEMPLATES_VERSION_ENDPOINT',
+        'SNIPPET_ENDPOINT',
+    )
+
+    def __init__(
+        self,
+        ttl=300,
+        maxsize=256,
+        ttls=None,
+        revalidate=REVALIDATED_ENDPOINTS
+    ):
+        self.maxsize = maxsize
+        self.ttls = dict((name, ttl) for name in self.CACHED_ENDPOINTS)
+        if ttls:
+            self.ttls.update(ttls)
+        self.revalidate = frozenset(revalidate or ())
+        self._entries = OrderedDict()
+        # paths of the entries by their first segment, so invalidating
+        # only looks at entries that can be related
+        self._segments = {}
+        self._lock = threading.Lock()
+
+    def ttl_for(self, endpoint_name):
+        """Seconds responses of `endpoint_name` are kept, None if never"""
+        return self.ttls.get(endpoint_name) or None
+
+    def _lookup(self, path):
+        entry = self._entries.get(path)
+        if entry is not None:
+            # mark as most recently used
+            del self._entries[path]
+            self._entries[path] = entry
+        return entry
+
+    def _store(self, path, entry):
+        self._entries.pop(path, None)
+        self._entries[path] = entry
+        self._segments.setdefault(_segment(path), set()).add(path)
+        while len(self._entries) > self.maxsize:
+            self._forget(next(iter(self._entries)))
+
+    def _forget(self, path):
+        del self._entries[path]
+        segment = _segment(path)
+        paths = self._segments[segment]
+        paths.discard(path)
+        if not paths:
+            del self._segments[segment]
+
+    def get(self, path):
+        """The cached response for `path` if it is still fresh"""
+        with self._lock:
+            entry = self._lookup(path)
+            if entry is None:
+                return None
+            expires, response = entry
+            if expires > time.time():
+                return response
+            if not self._has_validators(response):
+                self._forget(path)
+            return None
+
+    def get_validators(self, path):
+        """Conditional request headers for a stored, expired response"""
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry is None:
+            return {}
+
+        headers = {}
+        etag = entry[1].headers.get('ETag')
+        if etag:
+            headers['If-None-Match'] = etag
+        last_modified = entry[1].headers.get('Last-Modified')
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def _has_validators(self, response):
+        return bool(
+            response.headers.get('ETag') or
+            response.headers.get('Last-Modified')
+        )
+
+    def set(self, path, endpoint_name, response):
+        ttl = self.ttl_for(endpoint_name) or 0
+        if not ttl and not (endpoint_name in self.revalidate and
+                            self._has_validators(response)):
+            return
+        with self._lock:
+            self._store(path, (time.time() + ttl, response))
+
+    def revalidated(self, path, endpoint_name, response):
+        """Handle a 304 for `path`: renew and return the stored response
+
+        Returns None if nothing is stored for `path` any more.
+        """
+        with self._lock:
+            entry = self._lookup(path)
+            if entry is None:
+                return None
+            stored = entry[1]
+            for name in ('ETag', 'Last-Modified'):
+                if response.headers.get(name):
+                    stored.headers[name] = response.headers[name]
+            ttl = self.ttl_for(endpoint_name) or 0
+            self._entries[path] = (time.time() + ttl, stored)
+            return stored
+
+    def invalidate(self, path=None):
+        """Drop cached responses related to `path`, or everything
+
+        An entry is related when its path equals `path`, lies below it
+        or above it, so changing `templates/tem_1/versions/ver_1` also
+        drops `templates/tem_1` and `templates`.
+        """
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+                self._segments.clear()
+                return
+            path = path.strip('/')
+            for key in list(self._segments.get(_segment(path), ())):
+                if (key == path or key.startswith(path + '/') or
+                        path.startswith(key + '/')):
+                    self._forget(key)
+
+    def clear(self):
+        self.invalidate()
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,62 @@
+import zlib
+
+from six import text_type
+
+from .streaming import StreamingBody
+
+# zlib window bits selecting the container of each Content-Encoding
+ENCODINGS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+
+def check_encoding(encoding):
+    if encoding not in ENCODINGS:
+        raise ValueError('Unknown compression: %s' % encoding)
+    return encoding
+
+
+def compressor(encoding, level):
+    return zlib.compressobj(level, zlib.DEFLATED, ENCODINGS[encoding])
+
+
+class CompressedBody(StreamingBody):
+    """A `StreamingBody` compressed chunk by chunk while it is sent
+
+    The compressed size is not known up front, so it is sent chunked.
+    """
+
+    def __init__(self, body, encoding, level):
+        self.body = body
+        self.encoding = encoding
+        self.level = level
+
+    def __iter__(self):
+        c = compressor(self.encoding, self.level)
+        for chunk in self.body:
+            data = c.compress(chunk)
+            if data:
+                yield data
+        yield c.flush()
+
+
+def compress(body, encoding, level=6, threshold=0):
+    """`body` compressed with `encoding`, or None if it is not worth it
+
+    Bodies smaller than `threshold` bytes are left alone, as are bodies
+    other than strings and `StreamingBody`. Streaming bodies of unknown
+    size are always compressed.
+    """
+    if isinstance(body, StreamingBody):
+        size = len(body)
+        if size and size < threshold:
+            return None
+        return CompressedBody(body, encoding, level)
+
+    if isinstance(body, text_type):
+        body = body.encode('utf-8')
+    if not isinstance(body, bytes) or len(body) < threshold:
+        return None
+    c = compressor(encoding, level)
+    return c.compress(body) + c.flush()
@@ -0,0 +1,85 @@
+import time
+
+from six import text_type
+
+
+def body_size(body):
+    """Size in bytes of a request body, or None if it is not known"""
+    if body is None:
+        return 0
+    if isinstance(body, text_type):
+        return len(body.encode('utf-8'))
+    if isinstance(body, bytes):
+        return len(body)
+    try:
+        return len(body) or None
+    except TypeError:
+        return None
+
+
+class RequestEvent(object):
+    """One API request, as passed to the `on_request` and `on_response`
+    hooks of a client
+
+    `endpoint` is the name of the endpoint constant the request was made
+    to, e.g. `'SEND_ENDPOINT'` or `'BATCH_ENDPOINT'`, so requests can be
+    grouped without the ids in their `path`. `request_bytes` is the size
+    of the body sent, None if it was streamed with an unknown size, and
+    `commands` the number of commands of a batch request.
+    `template_id` is the template the request was about, if any, and
+    `headers` the request headers, which `on_request` may still change.
+
+    Once the request finished, `status_code`, `response_bytes`,
+    `retries` and `error` describe the outcome and `timings` holds the
+    seconds spent in each phase:
+
+    * `encode`: building the request body, before it was sent
+    * `throttle`: waiting for the rate limiter
+    * `request`: HTTP round trips, connecting and transfer included
+    * `backoff`: waiting between retries
+    * `parse`: reading and parsing a batch response
+    * `total`: the whole call
+
+    Lookups served by the response cache only reach `on_response`, with
+    `cached` set. With tracing enabled `span` is the request's span.
+    """
+
+    def __init__(self, endpoint, method, path=None, commands=None):
+        self.endpoint = endpoint
+        self.method = method
+        self.path = path
+        self.commands = commands
+        self.template_id = None
+        self.headers = None
+        self.request_bytes = None
+        self.response_bytes = None
+        self.status_code = None
+        self.retries = 0
+        self.cached = False
+        self.error = None
+        self.timings = {}
+        self.span = None
+        self.started = time.time()
+
+    def add_timing(self, phase, seconds):
+        self.timings[phase] = self.timings.get(phase, 0) + seconds
+
+    def count_response(self, chunks):
+        """Pass response body chunks through, adding up their size"""
+        self.response_bytes = 0
+        for chunk in chunks:
+            self.response_bytes += len(chunk)
+            yield chunk
+
+    def finish(self, response=None, error=None):
+        if response is not None:
+            self.status_code = response.status_code
+        self.error = error
+        self.timings['total'] = time.time() - self.started
+
+    def __repr__(self):
+        return '<RequestEvent %s %s [%s]>' % (
+            self.method,
+            self.endpoint,
+            self.status_code
+        )
@@ -0,0 +1,92 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+def new_key():
+    """A random idempotency key"""
+    return uuid.uuid4().hex
+
+
+class DedupeWindow(object):
+    """Bounded LRU of idempotency keys already sent by this process
+
+    Requests carrying an idempotency key are looked up here before they
+    are sent. The response of a key that succeeded within the last `ttl`
+    seconds is returned again instead of repeating the request, and a
+    request whose key is in flight on another thread waits for it to
+    finish. Keys whose request failed are forgotten, so the call can be
+    made again. At most `maxsize` keys are kept; the least recently used
+    go first.
+
+    The window only covers one process. The key is also sent to the API
+    in the `Idempotency-Key` header for the server to recognise repeats.
+    """
+
+    def __init__(self, maxsize=10000, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._in_flight = set()
+        self._lock = threading.Lock()
+        self._done = threading.Condition(self._lock)
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, response = entry
+        del self._entries[key]
+        if expires <= time.time():
+            return None
+        # mark as most recently used
+        self._entries[key] = entry
+        return response
+
+    def acquire(self, key, blocking=True):
+        """Claim `key` for a request about to be sent
+
+        Returns `(response, claimed)`: the stored response of a request
+        that already succeeded with `key`, or `claimed=True` when the
+        caller should send the request and `release()` the key after.
+        Without `blocking`, `(None, False)` is returned while the key
+        is in flight elsewhere instead of waiting.
+        """
+        with self._lock:
+            while True:
+                response = self._lookup(key)
+                if response is not None:
+                    return response, False
+                if key not in self._in_flight:
+                    self._in_flight.add(key)
+                    return None, True
+                if not blocking:
+                    return None, False
+                self._done.wait()
+
+    def release(self, key, response=None):
+        """Finish the request claimed for `key`
+
+        A successful `response` is remembered for `ttl` seconds.
+        """
+        with self._lock:
+            self._in_flight.discard(key)
+            if response is not None and response.status_code < 400:
+                self._entries.pop(key, None)
+                self._entries[key] = (time.time() + self.ttl, response)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+            self._done.notify_all()
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._lookup(key) is not None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,137 @@
+import json
+import re
+
+from six import string_types
+
+_NON_ASCII = re.compile(u'[^\x00-\x7f]')
+
+
+def _escape_non_ascii(match):
+    n = ord(match.group(0))
+    if n < 0x10000:
+        return '\\u%04x' % n
+    # characters outside the BMP become a surrogate pair, as in json
+    n -= 0x10000
+    return '\\u%04x\\u%04x' % (0xd800 | (n >> 10), 0xdc00 | (n & 0x3ff))
+
+
+def _to_ascii(text):
+    """Escape non-ASCII characters, like `json.dumps(ensure_ascii=True)`
+
+    Non-ASCII characters can only occur inside JSON strings, where the
+    escaped form is equivalent.
+    """
+    if _NON_ASCII.search(text) is None:
+        return text
+    return _NON_ASCII.sub(_escape_non_ascii, text)
+
+
+class StdlibJSON(object):
+    """JSON backend using the standard library `json` module"""
+
+    name = 'json'
+
+    def dumps(self, obj, encoder):
+        return encoder.encode(obj)
+
+    def loads(self, data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        return json.loads(data)
+
+
+class OrjsonJSON(object):
+    """JSON backend using orjson
+
+    Values orjson does not serialize itself, including datetimes and
+    dataclasses which it otherwise would, are passed to the encoder's
+    `default()`, so `SendwithusJSONEncoder` conversions still apply.
+    Objects orjson refuses, such as integers wider than 64 bits, are
+    encoded by the encoder itself. Output is escaped to ASCII like the
+    standard library's.
+
+    orjson also encodes some values the standard library rejects, such
+    as UUIDs and enums, as strings or their values.
+    """
+
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+        self._options = (
+            orjson.OPT_NON_STR_KEYS |
+            orjson.OPT_PASSTHROUGH_DATETIME |
+            orjson.OPT_PASSTHROUGH_DATACLASS
+        )
+
+    def dumps(self, obj, encoder):
+        try:
+            text = self._orjson.dumps(
+                obj,
+                default=encoder.default,
+                option=self._options
+            ).decode('utf-8')
+        except self._orjson.JSONEncodeError:
+            return encoder.encode(obj)
+        return _to_ascii(text)
+
+    def loads(self, data):
+        return self._orjson.loads(data)
+
+
+class UjsonJSON(object):
+    """JSON backend using ujson
+
+    ujson encodes `Decimal` as a float itself; other values it does not
+    know, such as datetimes, are passed to the encoder's `default()`.
+    """
+
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+        self._ujson = ujson
+
+    def dumps(self, obj, encoder):
+        return self._ujson.dumps(
+            obj,
+            default=encoder.default,
+            escape_forward_slashes=False
+        )
+
+    def loads(self, data):
+        return self._ujson.loads(data)
+
+
+# in order of preference for 'auto'
+BACKENDS = (
+    ('orjson', OrjsonJSON),
+    ('ujson', UjsonJSON),
+    ('json', StdlibJSON),
+)
+
+
+def get_backend(backend=None):
+    """Resolve the `json_backend` option of a client
+
+    `None` and `'json'` use the standard library, `'orjson'` and
+    `'ujson'` use that library and fail with an ImportError if it is
+    missing, and `'auto'` picks the fastest one installed. Any other
+    object is used as is and must provide `dumps(obj, encoder)` and
+    `loads(data)`.
+    """
+    if backend is None:
+        return StdlibJSON()
+    if not isinstance(backend, string_types):
+        return backend
+    if backend == 'auto':
+        for name, backend_cls in BACKENDS:
+            try:
+                return backend_cls()
+            except ImportError:
+                pass
+    for name, backend_cls in BACKENDS:
+        if name == backend:
+            return backend_cls()
+    raise ValueError('Unknown JSON backend: %s' % backend)
@@ -0,0 +1,292 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+import requests
+
+from .retry import RetryPolicy
+
+logger = logging.getLogger('sendwithus')
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        command TEXT NOT NULL,
+        created REAL NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        due REAL NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS outbox_due ON outbox (due, id)",
+    """CREATE TABLE IF NOT EXISTS outbox_failed (
+        id INTEGER PRIMARY KEY,
+        command TEXT NOT NULL,
+        created REAL NOT NULL,
+        attempts INTEGER NOT NULL,
+        failed REAL NOT NULL,
+        status_code INTEGER,
+        response TEXT
+    )""",
+)
+
+
+def queued_response(outbox_id):
+    """Response returned by `send()` for a send queued in the outbox"""
+    r = requests.Response()
+    r.status_code = 202
+    r.reason = 'Accepted'
+    r.headers['Content-Type'] = 'application/json'
+    r._content = json.dumps({
+        'success': True,
+        'status': 'queued',
+        'outbox_id': outbox_id,
+    }).encode('utf-8')
+    r.encoding = 'utf-8'
+    return r
+
+
+class OutboxEntry(object):
+    """A queued batch command claimed from an outbox"""
+
+    def __init__(self, id, command, created, attempts):
+        self.id = id
+        self.command = command
+        self.created = created
+        self.attempts = attempts
+
+    def __repr__(self):
+        return '<OutboxEntry %s (attempts: %s)>' % (self.id, self.attempts)
+
+
+class SQLiteOutbox(object):
+    """Durable queue of encoded batch commands in a SQLite database
+
+    Every `put()` is committed, and with `synchronous='FULL'` synced to
+    disk, before it returns, so queued sends survive a crash. Entries
+    are claimed for `lease` seconds while they are being sent; entries
+    of a worker that died become due again once the lease expires. The
+    file may be shared by several processes. Entries the API rejected
+    are moved to the `outbox_failed` table.
+    """
+
+    def __init__(self, path, lease=60, synchronous='FULL'):
+        self.path = path
+        self.lease = lease
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            path,
+            timeout=30,
+            isolation_level=None,
+            check_same_thread=False
+        )
+        if path != ':memory:':
+            self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=%s' % synchronous)
+        for statement in SCHEMA:
+            self._db.execute(statement)
+
+    def _transaction(self, statements):
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                result = statements(self._db)
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+            return result
+
+    def put(self, command):
+        """Queue an encoded batch command; returns its id"""
+        now = time.time()
+        with self._lock:
+            return self._db.execute(
+                'INSERT INTO outbox (command, created, due) VALUES (?, ?, ?)',
+                (command, now, now)
+            ).lastrowid
+
+    def claim(self, limit):
+        """Claim up to `limit` due entries, oldest first"""
+        now = time.time()
+
+        def claim_due(db):
+            rows = db.execute(
+                'SELECT id, command, created, attempts FROM outbox '
+                'WHERE due <= ? ORDER BY id LIMIT ?',
+                (now, limit)
+            ).fetchall()
+            db.executemany(
+                'UPDATE outbox SET due = ?, attempts = attempts + 1 '
+                'WHERE id = ?',
+                [(now + self.lease, row[0]) for row in rows]
+            )
+            return [
+                OutboxEntry(id, command, created, attempts + 1)
+                for id, command, created, attempts in rows
+            ]
+
+        return self._transaction(claim_due)
+
+    def ack(self, entries):
+        """Remove entries that were sent"""
+        self._transaction(lambda db: db.executemany(
+            'DELETE FROM outbox WHERE id = ?',
+            [(entry.id,) for entry in entries]
+        ))
+
+    def retry(self, entries, delay):
+        """Make entries due again after `delay` seconds"""
+        due = time.time() + delay
+        self._transaction(lambda db: db.executemany(
+            'UPDATE outbox SET due = ? WHERE id = ?',
+            [(due, entry.id) for entry in entries]
+        ))
+
+    def fail(self, entry, status_code=None, response=None):
+        """Move an entry that cannot be sent to `outbox_failed`"""
+        def move(db):
+            db.execute(
+                'INSERT OR REPLACE INTO outbox_failed (id, command, created, '
+                'attempts, failed, status_code, response) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (entry.id, entry.command, entry.created, entry.attempts,
+                 time.time(), status_code, response)
+            )
+            db.execute('DELETE FROM outbox WHERE id = ?', (entry.id,))
+
+        self._transaction(move)
+
+    def failed(self):
+        """Entries moved to `outbox_failed`, as dicts"""
+        with self._lock:
+            cursor = self._db.execute(
+                'SELECT id, command, created, attempts, failed, status_code, '
+                'response FROM outbox_failed ORDER BY id'
+            )
+            names = [column[0] for column in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def __len__(self):
+        with self._lock:
+            row = self._db.execute('SELECT COUNT(*) FROM outbox').fetchone()
+            return row[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class OutboxWorker(threading.Thread):
+    """Background thread sending the entries of an outbox in batches
+
+    Claims up to `batch_size` entries at a time and sends them with one
+    `BatchAPI.execute()` of `api`, so the client's retry policy and rate
+    limiter apply. Entries the API accepted are removed. Entries that
+    got a retryable status, or whose batch request failed, are tried
+    again after a backoff from `retry_policy`, and moved to the failed
+    table after its `max_retries`. Other errors fail the entry at once.
+
+    Delivery is at least once: a batch whose response was lost is sent
+    again, with the same idempotency keys.
+    """
+
+    def __init__(
+        self,
+        api,
+        outbox,
+        batch_size=100,
+        interval=1.0,
+        retry_policy=None
+    ):
+        super(OutboxWorker, self).__init__(name='sendwithus-outbox')
+        self.daemon = True
+        self.api = api
+        self.outbox = outbox
+        self.batch_size = batch_size
+        self.interval = interval
+        self.retry_policy = retry_policy or RetryPolicy(
+            max_retries=10,
+            backoff_factor=1,
+            max_backoff=300
+        )
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+
+    def notify(self):
+        """Wake the worker up to send newly queued entries"""
+        self._wakeup.set()
+
+    def _retry_or_fail(self, entries, status_code=None, response=None):
+        policy = self.retry_policy
+        retry = []
+        for entry in entries:
+            if entry.attempts > policy.max_retries:
+                logger.error(
+                    'Giving up on outbox entry %s after %s attempts',
+                    entry.id,
+                    entry.attempts
+                )
+                self.outbox.fail(entry, status_code, response)
+            else:
+                retry.append(entry)
+        if retry:
+            attempts = max(entry.attempts for entry in retry)
+            self.outbox.retry(retry, policy.get_backoff(attempts))
+
+    def drain_once(self):
+        """Send one batch of due entries; returns how many were claimed"""
+        entries = self.outbox.claim(self.batch_size)
+        if not entries:
+            return 0
+
+        batch = self.api.start_batch(auto_flush=False)
+        for entry in entries:
+            batch._queue_command(entry.command)
+        try:
+            # every queued send carries an idempotency key
+            result = batch.execute(idempotent=True)
+        except Exception as e:
+            logger.warning('Outbox batch of %s failed: %r', len(entries), e)
+            self._retry_or_fail(entries)
+            return len(entries)
+
+        sent = []
+        for entry, command in zip(entries, result):
+            status_code = command.status_code
+            if command.ok:
+                sent.append(entry)
+            elif status_code is None or \
+                    status_code in self.retry_policy.retry_statuses:
+                self._retry_or_fail([entry], status_code)
+            else:
+                logger.error(
+                    'Outbox entry %s rejected with status %s',
+                    entry.id,
+                    status_code
+                )
+                self.outbox.fail(
+                    entry,
+                    status_code,
+                    json.dumps(command.body)
+                )
+        self.outbox.ack(sent)
+        return len(entries)
+
+    def run(self):
+        while not self._stopping.is_set():
+            self._wakeup.clear()
+            try:
+                claimed = self.drain_once()
+            except Exception:
+                logger.exception('Outbox worker failed')
+                claimed = 0
+            if claimed < self.batch_size:
+                self._wakeup.wait(self.interval)
+
+    def stop(self, timeout=None):
+        """Stop after the batch in progress, waiting up to `timeout`"""
+        self._stopping.set()
+        self._wakeup.set()
+        if self.is_alive():
+            self.join(timeout)
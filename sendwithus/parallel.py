@@ -0,0 +1,81 @@
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+
+try:
+    from contextvars import copy_context
+except ImportError:  # Python < 3.7
+    copy_context = None
+
+
+def _submit(executor, func, item):
+    # run in a copy of the caller's context, so context variables such
+    # as the active tracing span carry over to the worker threads
+    if copy_context is None:
+        return executor.submit(func, item)
+    return executor.submit(copy_context().run, func, item)
+
+
+def iter_prefetched(fetch, start, prefetch=True):
+    """Yield the items of consecutive pages, fetching one page ahead
+
+    `fetch(cursor)` returns `(items, next_cursor)`, with a next cursor
+    of None for the last page. With `prefetch` the next page is fetched
+    on a background thread while the items of the current one are
+    consumed, so no more than two pages are held at once.
+    """
+    if not prefetch:
+        cursor = start
+        while cursor is not None:
+            items, cursor = fetch(cursor)
+            for item in items:
+                yield item
+        return
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = _submit(executor, fetch, start)
+        while future is not None:
+            items, cursor = future.result()
+            future = None
+            if cursor is not None:
+                future = _submit(executor, fetch, cursor)
+            for item in items:
+                yield item
+
+
+def imap_bounded(func, iterable, concurrency, ordered=True):
+    """Lazily map `func` over `iterable` on a pool of `concurrency` threads
+
+    Items are pulled from `iterable` only as workers free up, so at most
+    a small multiple of `concurrency` items is held in memory at once.
+    Results are yielded in input order when `ordered` is True, otherwise
+    as soon as they complete.
+    """
+    if concurrency < 1:
+        raise ValueError('concurrency must be at least 1')
+
+    window = concurrency * 2
+    items = iter(iterable)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        if ordered:
+            pending = deque(
+                _submit(executor, func, item)
+                for item in islice(items, window)
+            )
+            while pending:
+                result = pending.popleft().result()
+                for item in islice(items, 1):
+                    pending.append(_submit(executor, func, item))
+                yield result
+        else:
+            pending = set(
+                _submit(executor, func, item)
+                for item in islice(items, window)
+            )
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for item in islice(items, len(done)):
+                    pending.add(_submit(executor, func, item))
+                for future in done:
+                    yield future.result()
@@ -0,0 +1,60 @@
+from .idempotency import new_key
+
+
+class PreparedSend(object):
+    """A send of one template whose fixed fields are encoded up front
+
+    Created by `api.prepare_send()`. The email id and options such as
+    the sender, tags and ESP account are validated and encoded once;
+    `send()` only encodes the recipient and email data and splices them
+    into the request body. Works with every client: on a `BatchAPI`
+    `send()` queues a command, on an `AsyncAPI` it returns a coroutine.
+    """
+
+    def __init__(self, api, fields):
+        self.api = api
+        self.email_id = fields['email_id']
+        self.fields = fields
+        # the encoded object without its closing brace
+        self._head = api._encode_json(fields).rstrip()[:-1]
+
+    def send(
+        self,
+        recipient,
+        email_data=None,
+        timeout=None,
+        idempotent=False,
+        idempotency_key=None
+    ):
+        """Send the email to `recipient`, like `api.send()`"""
+        api = self.api
+        recipient = api._send_recipient(recipient)
+        if not email_data:
+            email_data = {}
+        if idempotency_key is None and api._idempotency_keys:
+            idempotency_key = new_key()
+
+        if api._outbox is not None:
+            payload = dict(
+                self.fields,
+                recipient=recipient,
+                email_data=email_data
+            )
+            return api._queue_send(payload, idempotency_key)
+
+        variable = api._encode_json({
+            'recipient': recipient,
+            'email_data': email_data,
+        })
+        return api._api_request(
+            api.SEND_ENDPOINT,
+            api.HTTP_POST,
+            encoded_payload='%s,%s' % (self._head, variable.lstrip()[1:]),
+            template_id=self.email_id,
+            timeout=timeout,
+            idempotent=idempotent or idempotency_key is not None,
+            idempotency_key=idempotency_key
+        )
+
+    def __repr__(self):
+        return '<PreparedSend %s>' % self.email_id
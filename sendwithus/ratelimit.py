@@ -0,0 +1,131 @@
+import os
+import struct
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+clock = getattr(time, 'monotonic', time.time)
+
+
+class TokenBucket(object):
+    """Client-side token bucket limiting requests to `rate` per second
+
+    Up to `capacity` requests (default: one second's worth) may burst
+    through at once. Callers that exceed the budget reserve their token
+    anyway and sleep until it is due, so waiting threads are served in
+    order. The bucket is shared by every thread using the same object.
+
+    `last_wait` and `total_wait` record the time spent throttled and
+    `wait_time()` returns how long a request made now would wait.
+    """
+
+    def __init__(self, rate, capacity=None):
+        if rate <= 0:
+            raise ValueError('rate must be positive')
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.last_wait = 0.0
+        self.total_wait = 0.0
+        self._lock = threading.Lock()
+        self._tokens = self.capacity
+        self._updated = clock()
+
+    def _refill(self, tokens, updated, now):
+        elapsed = max(now - updated, 0)
+        return min(self.capacity, tokens + elapsed * self.rate)
+
+    def _take(self, tokens):
+        """Reserve `tokens`, returning the seconds until they are due"""
+        with self._lock:
+            now = clock()
+            self._tokens = self._refill(self._tokens, self._updated, now)
+            self._updated = now
+            self._tokens -= tokens
+            return max(-self._tokens / self.rate, 0)
+
+    def _peek(self, tokens):
+        with self._lock:
+            available = self._refill(self._tokens, self._updated, clock())
+            return max((tokens - available) / self.rate, 0)
+
+    def reserve(self, tokens=1):
+        """Reserve `tokens` without blocking
+
+        Returns the seconds the caller must wait before sending; used by
+        the asyncio client, which sleeps without blocking the loop.
+        """
+        wait = self._take(tokens)
+        self.last_wait = wait
+        self.total_wait += wait
+        return wait
+
+    def acquire(self, tokens=1):
+        """Block until `tokens` may be spent; returns the time waited"""
+        wait = self.reserve(tokens)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def wait_time(self, tokens=1):
+        """Seconds a request made now would be throttled for"""
+        return self._peek(tokens)
+
+
+class FileTokenBucket(TokenBucket):
+    """Token bucket whose state lives in a file shared between processes
+
+    Every process on a host that opens the same `path` draws from one
+    budget. The file is locked with `fcntl.flock` around each update, so
+    this is only available on POSIX systems. Placing the file on a tmpfs
+    such as /dev/shm keeps it in shared memory.
+    """
+
+    STATE = struct.Struct('dd')
+
+    def __init__(self, path, rate, capacity=None):
+        if fcntl is None:
+            raise RuntimeError('FileTokenBucket requires fcntl (POSIX only)')
+        TokenBucket.__init__(self, rate, capacity)
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+    def close(self):
+        os.close(self._fd)
+
+    def _locked_update(self, update):
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                data = self._read()
+                now = time.time()
+                if len(data) == self.STATE.size:
+                    tokens, updated = self.STATE.unpack(data)
+                else:
+                    tokens, updated = self.capacity, now
+                tokens = self._refill(tokens, updated, now)
+                tokens, result = update(tokens)
+                if tokens is not None:
+                    os.lseek(self._fd, 0, os.SEEK_SET)
+                    os.write(self._fd, self.STATE.pack(tokens, now))
+                return result
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _read(self):
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        return os.read(self._fd, self.STATE.size)
+
+    def _take(self, tokens):
+        def update(available):
+            available -= tokens
+            return available, max(-available / self.rate, 0)
+        return self._locked_update(update)
+
+    def _peek(self, tokens):
+        def update(available):
+            return None, max((tokens - available) / self.rate, 0)
+        return self._locked_update(update)
@@ -0,0 +1,184 @@
+import json
+import time
+
+
+class SendResult(object):
+    """Outcome of a single send made through `api.send_many`
+
+    `index` is the position of the send in the input, `kwargs` the
+    arguments it was made with. Exactly one of `response` and `error`
+    is set.
+    """
+
+    def __init__(self, index, kwargs, response=None, error=None):
+        self.index = index
+        self.kwargs = kwargs
+        self.response = response
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None and self.response.status_code < 400
+
+    def __repr__(self):
+        if self.error is not None:
+            return '<SendResult %s error=%r>' % (self.index, self.error)
+        return '<SendResult %s [%s]>' % (
+            self.index,
+            self.response.status_code
+        )
+
+
+class BatchCommandResult(object):
+    """Outcome of one command of a batch
+
+    `response` is the per-command entry returned by the batch endpoint,
+    with at least `status_code` and `body`. `command` is the command as
+    it was queued; it is kept encoded and only decoded on access.
+    `error` is set on results made up by the bulk helpers: the
+    exception of a batch request that failed as a whole, or of a row
+    that could not be queued, which has no `command`.
+    """
+
+    def __init__(self, response, encoded_command, index=None, error=None):
+        self.response = response
+        self.index = index
+        self.error = error
+        self._encoded_command = encoded_command
+
+    @property
+    def status_code(self):
+        return self.response.get('status_code')
+
+    @property
+    def body(self):
+        return self.response.get('body')
+
+    @property
+    def ok(self):
+        return self.status_code is not None and self.status_code < 400
+
+    @property
+    def command(self):
+        command = self._encoded_command
+        if command is None:
+            return None
+        if isinstance(command, bytes):
+            command = command.decode('utf-8')
+        return json.loads(command)
+
+    def __repr__(self):
+        return '<BatchCommandResult %s [%s]>' % (self.index, self.status_code)
+
+
+class BatchResult(object):
+    """Outcome of a batch sent as one or more batch requests
+
+    Iterating yields a `BatchCommandResult` per queued command, in queue
+    order. `responses` holds the raw response of every batch request;
+    their bodies have already been consumed to build the results.
+    """
+
+    def __init__(self, responses, results):
+        self.responses = responses
+        self.results = results
+        for index, result in enumerate(results):
+            result.index = index
+
+    @property
+    def status_code(self):
+        """Status of the first failed batch request, else of the first"""
+        for response in self.responses:
+            if response.status_code >= 400:
+                return response.status_code
+        return self.responses[0].status_code if self.responses else None
+
+    @property
+    def ok(self):
+        """True when every command succeeded"""
+        return all(result.ok for result in self.results)
+
+    def failures(self):
+        """Iterate over the commands that did not succeed"""
+        return (result for result in self.results if not result.ok)
+
+    def successes(self):
+        """Iterate over the commands that succeeded"""
+        return (result for result in self.results if result.ok)
+
+    def json(self):
+        """Per-command responses of every sub-batch, in queue order"""
+        return [result.response for result in self.results]
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def __len__(self):
+        return len(self.results)
+
+    def __getitem__(self, index):
+        return self.results[index]
+
+    def __repr__(self):
+        return '<BatchResult %s commands, %s failed>' % (
+            len(self.results),
+            sum(1 for _ in self.failures())
+        )
+
+
+class BulkResult(object):
+    """Progress and outcome of a bulk customer operation
+
+    `succeeded` and `failed` count rows as their batches complete, so
+    the result can be inspected from an `on_progress` callback while
+    the operation runs. Only failed rows are kept: `failures` holds the
+    `BatchCommandResult` of up to `max_failures` of them, with `index`
+    set to the position of the row in the input. `errors` holds the
+    exceptions of batch requests that failed as a whole; their rows
+    count as failed with a `status_code` of None. So do rows that could
+    not be queued, e.g. a dict without an `email`, with the exception
+    as their `error`.
+    """
+
+    def __init__(self, max_failures=1000):
+        self.max_failures = max_failures
+        self.succeeded = 0
+        self.failed = 0
+        self.batches = 0
+        self.failures = []
+        self.errors = []
+        self.started = time.time()
+
+    def add(self, offset, results, error=None):
+        """Count the results of the batch of rows starting at `offset`"""
+        self.batches += 1
+        if error is not None:
+            self.errors.append(error)
+        for index, result in enumerate(results):
+            result.index = offset + index
+            if result.ok:
+                self.succeeded += 1
+                continue
+            self.failed += 1
+            if len(self.failures) < self.max_failures:
+                self.failures.append(result)
+
+    @property
+    def processed(self):
+        return self.succeeded + self.failed
+
+    @property
+    def elapsed(self):
+        """Seconds since the operation started"""
+        return time.time() - self.started
+
+    @property
+    def ok(self):
+        """True when every row succeeded"""
+        return not self.failed
+
+    def __repr__(self):
+        return '<BulkResult %s rows, %s failed>' % (
+            self.processed,
+            self.failed
+        )
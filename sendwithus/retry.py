@@ -0,0 +1,100 @@
+import random
+import time
+from email.utils import mktime_tz, parsedate_tz
+
+
+class RetryPolicy(object):
+    """Decides whether a failed API request is retried, and when
+
+    Waits grow exponentially, `backoff_factor * 2 ** (attempt - 1)`
+    seconds capped at `max_backoff`, with full jitter unless `jitter` is
+    False. A `Retry-After` header on the response takes precedence when
+    `respect_retry_after` is set. Each call is retried at most
+    `max_retries` times and, if `budget` is set, gives up once waiting
+    would take it past `budget` seconds since its first attempt.
+
+    Requests that may have reached the server are only retried when
+    they are idempotent. 429 responses and failures to connect are
+    always safe to retry.
+    """
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(
+        self,
+        max_retries=3,
+        backoff_factor=0.5,
+        max_backoff=30,
+        jitter=True,
+        retry_statuses=RETRY_STATUSES,
+        respect_retry_after=True,
+        budget=None
+    ):
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_statuses = retry_statuses
+        self.respect_retry_after = respect_retry_after
+        self.budget = budget
+
+    def is_retryable(self, idempotent, status_code=None, sent=True):
+        if status_code is None:
+            # transport error; safe to retry if nothing was sent
+            return idempotent or not sent
+        if status_code == 429:
+            return 429 in self.retry_statuses
+        return idempotent and status_code in self.retry_statuses
+
+    def parse_retry_after(self, value):
+        """Seconds to wait from a Retry-After header, or None"""
+        if not value:
+            return None
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            pass
+        parsed = parsedate_tz(value)
+        if parsed is None:
+            return None
+        return max(mktime_tz(parsed) - time.time(), 0)
+
+    def get_backoff(self, attempt, retry_after=None):
+        if self.respect_retry_after:
+            delay = self.parse_retry_after(retry_after)
+            if delay is not None:
+                return min(delay, self.max_backoff)
+
+        delay = min(self.backoff_factor * 2 ** (attempt - 1), self.max_backoff)
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+    def get_retry_delay(
+        self,
+        attempt,
+        elapsed,
+        idempotent,
+        status_code=None,
+        retry_after=None,
+        sent=True
+    ):
+        """Seconds to wait before retrying `attempt`, or None to give up
+
+        `attempt` counts the attempts made so far and `elapsed` the
+        seconds since the first one. `status_code` is None when the
+        attempt failed with a transport error, in which case `sent` tells
+        whether the request may have reached the server.
+        """
+        if attempt > self.max_retries:
+            return None
+        if not self.is_retryable(idempotent, status_code, sent):
+            return None
+
+        delay = self.get_backoff(attempt, retry_after)
+        if self.budget is not None and elapsed + delay > self.budget:
+            return None
+        return delay
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
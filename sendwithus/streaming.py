@@ -0,0 +1,342 @@
+import base64
+import codecs
+import json
+import uuid
+
+WHITESPACE = ' \t\n\r'
+DELIMITERS = WHITESPACE + ',]'
+
+# parser states for iter_json_array
+_START, _FIRST, _VALUE, _SEPARATOR = range(4)
+
+
+def _decode_chunks(chunks, encoding):
+    decode = codecs.getincrementaldecoder(encoding)().decode
+    for chunk in chunks:
+        text = decode(chunk)
+        if text:
+            yield text
+    tail = decode(b'', True)
+    if tail:
+        yield tail
+
+
+def iter_json_array(chunks, decoder=None, encoding='utf-8'):
+    """Yield the elements of a JSON array read from byte chunks
+
+    Elements are decoded as soon as they are complete, so a large array
+    is never held in memory both as text and as Python objects.
+    """
+    decoder = decoder or json.JSONDecoder()
+    texts = _decode_chunks(chunks, encoding)
+    buf, pos = '', 0
+    # after a failed decode, wait until the buffer has doubled before
+    # trying again so huge elements are not re-parsed for every chunk
+    retry_at = 0
+    state = _START
+
+    while True:
+        while pos < len(buf) and buf[pos] in WHITESPACE:
+            pos += 1
+
+        if pos == len(buf) or len(buf) < retry_at:
+            text = next(texts, None)
+            if text is None:
+                if pos < len(buf):
+                    retry_at = 0
+                else:
+                    raise ValueError('Unexpected end of JSON array')
+            else:
+                buf, pos = buf[pos:] + text, 0
+                continue
+
+        if state == _START:
+            if buf[pos] != '[':
+                raise ValueError('Expected a JSON array')
+            pos += 1
+            state = _FIRST
+        elif state == _SEPARATOR:
+            if buf[pos] == ']':
+                return
+            if buf[pos] != ',':
+                raise ValueError('Expected "," or "]" at %s' % pos)
+            pos += 1
+            state = _VALUE
+        elif state == _FIRST and buf[pos] == ']':
+            return
+        else:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                text = next(texts, None)
+                if text is None:
+                    raise
+                retry_at = 2 * (len(buf) - pos)
+                buf, pos = buf[pos:] + text, 0
+                continue
+
+            if (not isinstance(value, (dict, list)) and
+                    (end == len(buf) or buf[end] not in DELIMITERS)):
+                # a scalar such as 4 in '4.' may continue in the next chunk
+                text = next(texts, None)
+                if text is not None:
+                    buf, pos = buf[pos:] + text, 0
+                    continue
+
+            retry_at = 0
+            pos = end
+            state = _SEPARATOR
+            yield value
+
+
+class Base64File(object):
+    """A file that is base64 encoded lazily, `chunk_size` bytes at a time
+
+    Iterating yields the encoded text in chunks, starting from the
+    position the file was at when wrapped, so it can be iterated again
+    if the request is retried. Files that cannot seek, such as pipes,
+    are kept in memory as they are read so they can be sent again.
+    """
+
+    # a multiple of 3 so every chunk encodes without padding
+    CHUNK_SIZE = 3 * 64 * 1024
+
+    def __init__(self, file_obj, chunk_size=CHUNK_SIZE):
+        self.file_obj = file_obj
+        self.chunk_size = chunk_size - chunk_size % 3 or 3
+        try:
+            self._start = file_obj.tell()
+            file_obj.seek(self._start)
+        except (AttributeError, IOError, OSError):
+            self._start = None
+        # data read so far from a file that cannot seek
+        self._buffer = []
+        self._exhausted = False
+
+    def encoded_length(self):
+        """Length of the encoded text, or None if it cannot be known"""
+        if self._start is None:
+            return None
+        try:
+            self.file_obj.seek(0, 2)
+            size = self.file_obj.tell() - self._start
+            self.file_obj.seek(self._start)
+        except (AttributeError, IOError, OSError):
+            return None
+        return (size + 2) // 3 * 4
+
+    def _read_chunks(self):
+        if self._start is not None:
+            self.file_obj.seek(self._start)
+            while True:
+                chunk = self.file_obj.read(self.chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+        # replay what earlier iterations read, then read on
+        for chunk in list(self._buffer):
+            yield chunk
+        while not self._exhausted:
+            chunk = self.file_obj.read(self.chunk_size)
+            if not chunk:
+                self._exhausted = True
+                return
+            self._buffer.append(chunk)
+            yield chunk
+
+    def __iter__(self):
+        remainder = b''
+        for chunk in self._read_chunks():
+            chunk = remainder + chunk
+            # only encode whole 3 byte groups until the end of the file
+            cut = len(chunk) - len(chunk) % 3
+            chunk, remainder = chunk[:cut], chunk[cut:]
+            if chunk:
+                yield base64.b64encode(chunk).decode('ascii')
+        if remainder:
+            yield base64.b64encode(remainder).decode('ascii')
+
+    def read(self):
+        return ''.join(self)
+
+
+_encoders = {}
+
+
+def attachment_encoder(encoder_cls):
+    """Subclass of `encoder_cls` that understands `Base64File` values
+
+    With `stream=True` each file is replaced by a placeholder and
+    collected in `files`, for `JSONBody` to splice back in as it is
+    sent; otherwise files are read and encoded in place.
+    """
+    encoder = _encoders.get(encoder_cls)
+    if encoder is None:
+        class AttachmentEncoder(encoder_cls):
+            def __init__(self, *args, **kwargs):
+                self.stream = kwargs.pop('stream', False)
+                super(AttachmentEncoder, self).__init__(*args, **kwargs)
+                self.nonce = uuid.uuid4().hex
+                self.files = []
+
+            def default(self, obj):
+                if not isinstance(obj, Base64File):
+                    return super(AttachmentEncoder, self).default(obj)
+                if not self.stream:
+                    return obj.read()
+                self.files.append(obj)
+                return 'swu-file:%s:%s' % (self.nonce, len(self.files))
+
+        encoder = _encoders[encoder_cls] = AttachmentEncoder
+    return encoder
+
+
+class StreamingBody(object):
+    """Base class of request bodies that are produced while being sent
+
+    Iterating yields the body as bytes and may be repeated, e.g. when a
+    request is retried. `len()` is the body size in bytes, or 0 when it
+    is not known up front, in which case requests falls back to chunked
+    transfer encoding.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __len__(self):
+        return 0
+
+    def __bool__(self):
+        # a body of unknown size is still a body
+        return True
+
+    __nonzero__ = __bool__
+
+    def __iter__(self):
+        raise NotImplementedError
+
+    def getvalue(self):
+        # deliberately not `read()`: http.client would treat the body as
+        # a file and read it in blocks
+        return b''.join(self)
+
+
+def _grouped(pieces, size):
+    """Join small byte strings into chunks of about `size` bytes"""
+    buf = []
+    buffered = 0
+    for piece in pieces:
+        buf.append(piece)
+        buffered += len(piece)
+        if buffered >= size:
+            yield b''.join(buf)
+            buf = []
+            buffered = 0
+    if buf:
+        yield b''.join(buf)
+
+
+class JSONBody(StreamingBody):
+    """Request body of encoded JSON with files streamed into it
+
+    `text` is the payload encoded with `attachment_encoder(...,
+    stream=True)`, `files` and `nonce` come from that encoder. Iterating
+    reads each file in chunks, so a large attachment is never held in
+    memory as a whole.
+    """
+
+    def __init__(self, text, files, nonce):
+        self.data = text.encode('utf-8')
+        self.files = files
+        self.nonce = nonce
+
+    def _placeholder(self, index):
+        return ('"swu-file:%s:%s"' % (self.nonce, index + 1)).encode('ascii')
+
+    def __len__(self):
+        length = len(self.data)
+        for index, f in enumerate(self.files):
+            encoded = f.encoded_length()
+            if encoded is None:
+                return 0
+            length += encoded + 2 - len(self._placeholder(index))
+        return length
+
+    def __iter__(self):
+        pos = 0
+        for index, f in enumerate(self.files):
+            placeholder = self._placeholder(index)
+            at = self.data.index(placeholder, pos)
+            yield self.data[pos:at] + b'"'
+            for chunk in f:
+                yield chunk.encode('ascii')
+            yield b'"'
+            pos = at + len(placeholder)
+        yield self.data[pos:]
+
+
+class IterJSONBody(StreamingBody):
+    """Request body encoding `payload` incrementally as it is sent
+
+    Uses `iterencode` of `attachment_encoder(encoder_cls)`, so custom
+    encoders keep working and attachments are streamed as in
+    `JSONBody`, but the encoded document is never built as one string.
+    The size is unknown up front, so the body is sent chunked.
+    """
+
+    def __init__(self, payload, encoder_cls, chunk_size=None):
+        self.payload = payload
+        self.encoder_cls = attachment_encoder(encoder_cls)
+        self.chunk_size = chunk_size or self.CHUNK_SIZE
+
+    def _pieces(self):
+        encoder = self.encoder_cls(stream=True)
+        seen = 0
+        for text in encoder.iterencode(self.payload):
+            # splice in files the encoder replaced with placeholders
+            while seen < len(encoder.files):
+                f = encoder.files[seen]
+                seen += 1
+                placeholder = '"swu-file:%s:%s"' % (encoder.nonce, seen)
+                before, text = text.split(placeholder, 1)
+                yield (before + '"').encode('utf-8')
+                for chunk in f:
+                    yield chunk.encode('ascii')
+                text = '"' + text
+            yield text.encode('utf-8')
+
+    def __iter__(self):
+        return _grouped(self._pieces(), self.chunk_size)
+
+
+def _utf8(item):
+    return item if isinstance(item, bytes) else item.encode('utf-8')
+
+
+class JSONArrayBody(StreamingBody):
+    """Request body of a JSON array of already encoded items
+
+    Saves joining the items, e.g. the commands of a batch, into one
+    large string. Items should be UTF-8 encoded bytes; text is encoded
+    as it is needed. Its length is known, so it is sent with a
+    Content-Length rather than chunked.
+    """
+
+    def __init__(self, items, chunk_size=None):
+        self.items = items
+        self.chunk_size = chunk_size or self.CHUNK_SIZE
+
+    def __len__(self):
+        return sum(len(_utf8(item)) for item in self.items) + \
+            max(len(self.items) - 1, 0) + 2
+
+    def _pieces(self):
+        yield b'['
+        for index, item in enumerate(self.items):
+            if index:
+                yield b','
+            yield _utf8(item)
+        yield b']'
+
+    def __iter__(self):
+        return _grouped(self._pieces(), self.chunk_size)
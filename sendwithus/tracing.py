@@ -0,0 +1,119 @@
+"""
+sendwithus - OpenTelemetry tracing
+
+Enabled with `sendwithus.api(..., tracing=True)`. Requires the
+OpenTelemetry API (`pip install sendwithus[tracing]`); without it
+tracing stays disabled. This module is only imported when tracing is
+enabled.
+"""
+
+from contextlib import contextmanager
+
+from .version import version
+
+try:
+    from opentelemetry import propagate, trace
+except ImportError:
+    trace = None
+
+
+def get_tracing(tracing):
+    """Resolve the `tracing` option of a client
+
+    `True` traces through the global tracer provider, a `Tracing` is
+    used as is. Returns None when OpenTelemetry is not installed.
+    """
+    if trace is None:
+        return None
+    if tracing is True:
+        return Tracing()
+    return tracing
+
+
+def _span_name(endpoint):
+    # e.g. 'sendwithus.templates_specific' for TEMPLATES_SPECIFIC_ENDPOINT
+    name = (endpoint or 'unknown').lower()
+    if name.endswith('_endpoint'):
+        name = name[:-len('_endpoint')]
+    return 'sendwithus.%s' % name
+
+
+class Tracing(object):
+    """Records an OpenTelemetry client span for every API request
+
+    Spans are named after the endpoint, e.g. `sendwithus.send`, and
+    carry the endpoint, template id, batch size, status code and body
+    sizes as attributes. The trace context is propagated to the API in
+    the request headers. `BatchAPI.execute()` adds a parent span over
+    all batch requests it sends.
+
+    Uses the global tracer provider unless `tracer_provider` is given.
+    """
+
+    def __init__(self, tracer_provider=None):
+        self.tracer = trace.get_tracer(
+            'sendwithus',
+            version,
+            tracer_provider=tracer_provider
+        )
+
+    def _start_span(self, event):
+        attributes = {
+            'http.request.method': event.method,
+            'sendwithus.endpoint': event.endpoint,
+        }
+        if event.path is not None:
+            attributes['url.full'] = event.path
+        if event.template_id is not None:
+            attributes['sendwithus.template_id'] = event.template_id
+        if event.commands is not None:
+            attributes['sendwithus.batch.size'] = event.commands
+        if event.request_bytes is not None:
+            attributes['http.request.body.size'] = event.request_bytes
+
+        return self.tracer.start_span(
+            _span_name(event.endpoint),
+            kind=trace.SpanKind.CLIENT,
+            attributes=attributes,
+            start_time=int(event.started * 1e9)
+        )
+
+    def on_request(self, event):
+        event.span = self._start_span(event)
+        if event.headers is not None:
+            propagate.inject(
+                event.headers,
+                context=trace.set_span_in_context(event.span)
+            )
+
+    def on_response(self, event):
+        span = event.span
+        if span is None:
+            # served from the cache without a request
+            span = event.span = self._start_span(event)
+            span.set_attribute('sendwithus.cached', event.cached)
+
+        if event.status_code is not None:
+            span.set_attribute('http.response.status_code', event.status_code)
+        if event.response_bytes is not None:
+            span.set_attribute('http.response.body.size', event.response_bytes)
+        if event.retries:
+            span.set_attribute('http.request.resend_count', event.retries)
+
+        if event.error is not None:
+            span.record_exception(event.error)
+            span.set_attribute('error.type', type(event.error).__name__)
+            span.set_status(trace.Status(trace.StatusCode.ERROR))
+        elif event.status_code is not None and event.status_code >= 400:
+            span.set_attribute('error.type', str(event.status_code))
+            span.set_status(trace.Status(trace.StatusCode.ERROR))
+        span.end()
+
+    @contextmanager
+    def batch(self, size):
+        """Parent span over the requests of one `BatchAPI.execute()`"""
+        with self.tracer.start_as_current_span(
+            'sendwithus.batch.execute',
+            attributes={'sendwithus.batch.size': size}
+        ) as span:
+            yield span
@@ -0,0 +1,208 @@
+import datetime
+import json
+import random
+import threading
+import time
+import zlib
+from collections import deque
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from six import string_types
+from six.moves.http_client import responses as reasons
+from six.moves.urllib.parse import urlsplit
+
+from .compression import ENCODINGS
+
+clock = getattr(time, 'monotonic', time.time)
+
+
+class RecordedRequest(object):
+    """A request received by a `MemoryTransport`"""
+
+    def __init__(self, method, url, headers, body, params=None):
+        self.method = method
+        self.url = url
+        self.path = urlsplit(url).path
+        self.headers = CaseInsensitiveDict(headers or {})
+        self.body = body
+        self.params = params
+
+    def content(self):
+        """The body, decompressed according to its Content-Encoding"""
+        encoding = self.headers.get('Content-Encoding')
+        if encoding in ENCODINGS and self.body:
+            return zlib.decompress(self.body, ENCODINGS[encoding])
+        return self.body
+
+    def json(self):
+        content = self.content()
+        return json.loads(content.decode('utf-8')) if content else None
+
+    def __repr__(self):
+        return '<RecordedRequest %s %s>' % (self.method, self.path)
+
+
+def default_response(request):
+    """Answer like the API does to a successful request
+
+    Batch requests get a successful entry per command.
+    """
+    if request.path.endswith('/batch'):
+        return 200, [
+            {
+                'status_code': 200,
+                'body': {'success': True, 'status': 'OK'},
+                'path': command['path'],
+                'method': command['method'],
+            }
+            for command in request.json()
+        ]
+    return 200, {'success': True, 'status': 'OK'}
+
+
+class MemoryTransport(object):
+    """In-process stand-in for the HTTP session of a client
+
+    Pass it as `sendwithus.api(..., transport=MemoryTransport())` to run
+    the client without any network access, e.g. in tests or to profile
+    a pipeline making a large number of sends. Responses are real
+    `requests.Response` objects. They come from the `queue()` of canned
+    responses first, then from `responder`, a function taking the
+    `RecordedRequest` and returning `(status, body[, headers])`. By
+    default every request succeeds.
+
+    Requests are kept in `requests` when `record` is True; turn it off
+    for long runs. `request_count` is counted either way. Request bodies
+    are always read in full, like a server would.
+
+    `latency` (seconds, or a function of the request returning seconds)
+    delays every response. A share of `error_rate` requests fails with
+    a connection error, a share of `failure_rate` gets a 503, and
+    requests beyond `rate_limit` per second get a 429 with Retry-After.
+    `seed` makes the simulated failures repeatable.
+    """
+
+    def __init__(
+        self,
+        responder=default_response,
+        record=True,
+        latency=0,
+        error_rate=0,
+        failure_rate=0,
+        rate_limit=None,
+        seed=None
+    ):
+        self.responder = responder
+        self.record = record
+        self.latency = latency
+        self.error_rate = error_rate
+        self.failure_rate = failure_rate
+        self.rate_limit = rate_limit
+        self.requests = []
+        self.request_count = 0
+        self._responses = deque()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._tokens = rate_limit
+        self._updated = clock()
+
+    def queue(self, status, body=None, headers=None):
+        """Answer the next request with this response instead"""
+        with self._lock:
+            self._responses.append((status, body, headers))
+
+    def _read_body(self, data):
+        if data is None:
+            return b''
+        if isinstance(data, bytes):
+            return data
+        if isinstance(data, string_types):
+            return data.encode('utf-8')
+        return b''.join(data)
+
+    def _rate_limited(self):
+        if self.rate_limit is None:
+            return False
+        now = clock()
+        self._tokens = min(
+            self.rate_limit,
+            self._tokens + (now - self._updated) * self.rate_limit
+        )
+        self._updated = now
+        if self._tokens < 1:
+            return True
+        self._tokens -= 1
+        return False
+
+    def _respond(self, request):
+        with self._lock:
+            self.request_count += 1
+            if self.record:
+                self.requests.append(request)
+            if self._responses:
+                return self._responses.popleft()
+            if self._rate_limited():
+                return 429, {'error': 'rate limited'}, {'Retry-After': '1'}
+            roll = self._random.random()
+        if roll < self.error_rate:
+            raise requests.exceptions.ConnectionError(
+                'Simulated connection error'
+            )
+        if roll < self.error_rate + self.failure_rate:
+            return 503, {'error': 'service unavailable'}, None
+        return self.responder(request)
+
+    def _build_response(self, request, status, body, headers, elapsed):
+        if body is None:
+            content = b''
+        elif isinstance(body, bytes):
+            content = body
+        else:
+            content = json.dumps(body).encode('utf-8')
+
+        r = requests.Response()
+        r.status_code = status
+        r.headers = CaseInsensitiveDict({
+            'Content-Type': 'application/json',
+            'Content-Length': str(len(content)),
+        })
+        r.headers.update(headers or {})
+        r._content = content
+        # lets stream=True callers iterate the body from memory
+        r._content_consumed = True
+        r.encoding = 'utf-8'
+        r.url = request.url
+        r.reason = reasons.get(status, '')
+        r.elapsed = datetime.timedelta(seconds=elapsed)
+        return r
+
+    def request(self, method, url, data=None, headers=None, params=None,
+                **kwargs):
+        """Answer a request, accepting the arguments of `Session.request`"""
+        start = time.time()
+        request = RecordedRequest(
+            method,
+            url,
+            headers,
+            self._read_body(data),
+            params
+        )
+        response = self._respond(request)
+        status, body = response[:2]
+        headers = response[2] if len(response) > 2 else None
+
+        latency = self.latency(request) if callable(self.latency) \
+            else self.latency
+        if latency:
+            time.sleep(latency)
+        return self._build_response(
+            request,
+            status,
+            body,
+            headers,
+            time.time() - start
+        )
+
+    def close(self):
+        pass
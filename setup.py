@@ -21,12 +21,20 @@ setup(
     test_suite="sendwithus.test",
     install_requires=[
         "requests >= 2.0.0",
-        "six >= 1.9.0"
+        "six >= 1.9.0",
+        "futures >= 3.0.0; python_version < '3'"
     ],
     extras_require={
+        "aio": [
+            "aiohttp >= 3.3.0; python_version >= '3.6'"
+        ],
+        "tracing": [
+            "opentelemetry-api >= 1.0.0"
+        ],
         "test": [
             "pytest >= 3.0.5",
-            "pytest-xdist >= 1.15.0"
+            "pytest-xdist >= 1.15.0",
+            "aiohttp >= 3.3.0; python_version >= '3.7'"
         ]
     },
     classifiers=[
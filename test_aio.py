@@ -0,0 +1,320 @@
+import asyncio
+import base64
+import io
+import json
+
+import pytest
+
+aio = pytest.importorskip('sendwithus.aio')
+
+
+@pytest.fixture
+def async_api_options(mock_api_options):
+    return mock_api_options
+
+
+run = asyncio.run
+
+
+def test_async_send(async_api_options, mock_server, recipient, email_data):
+    async def main():
+        async with aio.AsyncAPI('TEST_API_KEY', **async_api_options) as swu:
+            return await swu.send('tem_123', recipient, email_data=email_data)
+
+    result = run(main())
+    assert result.status_code == 200
+    assert result.json() == {'success': True}
+
+    request, = mock_server.requests
+    assert request['method'] == 'POST'
+    assert request['path'] == '/api/v1/send'
+    assert b'"email_id": "tem_123"' in request['body']
+
+
+def test_async_get_reuses_connection(async_api_options, mock_server):
+    async def main():
+        async with aio.AsyncAPI('TEST_API_KEY', **async_api_options) as swu:
+            await swu.templates()
+            await swu.get_snippet('snp_123')
+
+    run(main())
+    first, second = mock_server.requests
+    assert second['path'] == '/api/v1/snippets/snp_123'
+    assert first['port'] == second['port']
+
+
+def test_async_raise_errors(async_api_options, mock_server):
+    from sendwithus.exceptions import APIError
+    mock_server.responses.append((400, {'error': 'bad'}))
+
+    async def main():
+        async with aio.AsyncAPI(
+            'TEST_API_KEY', raise_errors=True, **async_api_options
+        ) as swu:
+            await swu.customer_details('person@example.com')
+
+    with pytest.raises(APIError):
+        run(main())
+
+
+def test_async_batch(async_api_options, mock_server):
+    mock_server.responses.append((200, [{'status_code': 200}] * 3))
+
+    async def main():
+        async with aio.AsyncAPI('TEST_API_KEY', **async_api_options) as swu:
+            batch = swu.start_batch()
+            for x in range(3):
+                batch.customer_create('test+%s@example.com' % x)
+            assert batch.command_length() == 3
+            result = await batch.execute()
+            assert batch.command_length() == 0
+            return result
+
+    result = run(main())
+    assert len(result.json()) == 3
+    request, = mock_server.requests
+    assert request['path'] == '/api/v1/batch'
+
+
+def test_async_send_many(async_api_options, mock_server, recipient):
+    mock_server.responses.extend([(200, {}), (500, {}), (200, {})])
+
+    async def main():
+        async with aio.AsyncAPI('TEST_API_KEY', **async_api_options) as swu:
+            sends = (
+                {'email_id': 'tem_%s' % x, 'recipient': recipient}
+                for x in range(3)
+            )
+            return [r async for r in swu.send_many(sends, concurrency=1)]
+
+    results = run(main())
+    assert [r.index for r in results] == [0, 1, 2]
+    assert [r.ok for r in results] == [True, False, True]
+
+
+def test_async_batch_sub_batches(async_api_options, mock_server):
+    async def main():
+        async with aio.AsyncAPI('TEST_API_KEY', **async_api_options) as swu:
+            batch = swu.start_batch(max_commands=2)
+            for x in range(5):
+                batch.customer_create('test+%s@example.com' % x)
+            assert not mock_server.requests
+            return await batch.execute()
+
+    result = run(main())
+    assert len(result.responses) == 3
+    assert len(result.json()) == 5
+
+
+def test_async_batch_parallel_execute(async_api_options, mock_server):
+    mock_server.delay = 0.05
+
+    async def main():
+        async with aio.AsyncAPI('TEST_API_KEY', **async_api_options) as swu:
+            batch = swu.start_batch(max_commands=2)
+            for x in range(8):
+                batch.customer_details('test+%s@example.com' % x)
+            return await batch.execute(parallel=4)
+
+    result = run(main())
+    assert len(set(r['port'] for r in mock_server.requests)) > 1
+    assert [r['path'] for r in result.json()] == [
+        '/api/v1/customers/test+%s@example.com' % x for x in range(8)
+    ]
+
+
+def test_async_retry(async_api_options, mock_server):
+    from sendwithus.retry import RetryPolicy
+    mock_server.responses.extend([(503, {}), (429, {}, {'Retry-After': '0'})])
+
+    async def main():
+        async with aio.AsyncAPI(
+            'TEST_API_KEY',
+            retry_policy=RetryPolicy(backoff_factor=0),
+            **async_api_options
+        ) as swu:
+            return await swu.get_template('tem_123')
+
+    assert run(main()).status_code == 200
+    assert len(mock_server.requests) == 3
+
+
+def test_async_send_with_attachment(async_api_options, mock_server, recipient):
+    attachment = io.BytesIO(b'x' * 100000)
+    attachment.name = 'report.pdf'
+
+    async def main():
+        async with aio.AsyncAPI('TEST_API_KEY', **async_api_options) as swu:
+            return await swu.send('tem_1', recipient, files=[attachment])
+
+    assert run(main()).status_code == 200
+    body = json.loads(mock_server.requests[0]['body'].decode('utf-8'))
+    assert body['files'][0]['data'] == \
+        base64.b64encode(b'x' * 100000).decode('ascii')
+
+
+def test_async_request_hooks(async_api_options, mock_server, recipient):
+    started = []
+    finished = []
+
+    async def main():
+        async with aio.AsyncAPI(
+            'TEST_API_KEY',
+            on_request=started.append,
+            on_response=finished.append,
+            **async_api_options
+        ) as swu:
+            await swu.send('tem_1', recipient)
+            batch = swu.start_batch(max_commands=1)
+            batch.customer_create('a@example.com')
+            batch.customer_create('b@example.com')
+            await batch.execute()
+
+    run(main())
+
+    send, first, second = finished
+    assert started == finished
+    assert send.endpoint == 'SEND_ENDPOINT'
+    assert send.request_bytes == len(mock_server.requests[0]['body'])
+    assert send.status_code == 200
+    assert 'request' in send.timings
+    assert [first.endpoint, first.commands] == ['BATCH_ENDPOINT', 1]
+    assert second.response_bytes > 0 and 'parse' in second.timings
+
+
+def test_async_memory_transport(recipient):
+    from sendwithus.transport import MemoryTransport
+    transport = MemoryTransport()
+
+    async def main():
+        swu = aio.AsyncAPI('TEST_API_KEY', transport=transport)
+        result = await swu.send('tem_1', recipient)
+        batch = swu.start_batch()
+        batch.customer_create('test@example.com')
+        return result, await batch.execute()
+
+    result, batch_result = run(main())
+    assert result.json() == {'success': True, 'status': 'OK'}
+    assert batch_result.ok
+    assert [r.path for r in transport.requests] == [
+        '/api/v1/send', '/api/v1/batch']
+
+
+def test_async_outbox_unsupported():
+    with pytest.raises(ValueError):
+        aio.AsyncAPI('TEST_API_KEY', outbox=object())
+
+
+def test_async_dedupe_window(recipient):
+    from sendwithus.idempotency import DedupeWindow
+    from sendwithus.transport import MemoryTransport
+    transport = MemoryTransport()
+
+    async def main():
+        swu = aio.AsyncAPI(
+            'TEST_API_KEY',
+            transport=transport,
+            dedupe_window=DedupeWindow()
+        )
+        return await asyncio.gather(*[
+            swu.send('tem_1', recipient, idempotency_key='x')
+            for _ in range(3)
+        ])
+
+    responses = run(main())
+    assert all(r.status_code == 200 for r in responses)
+    request, = transport.requests
+    assert request.headers['Idempotency-Key'] == 'x'
+
+
+def test_async_compression(recipient):
+    import zlib
+    from sendwithus.transport import MemoryTransport
+    transport = MemoryTransport()
+
+    async def main():
+        swu = aio.AsyncAPI(
+            'TEST_API_KEY',
+            transport=transport,
+            compression='gzip',
+            compression_threshold=0
+        )
+        batch = swu.start_batch()
+        batch.send('tem_1', recipient)
+        return await batch.execute()
+
+    assert run(main()).ok
+    request, = transport.requests
+    assert request.headers['Content-Encoding'] == 'gzip'
+    command, = json.loads(zlib.decompress(request.body, 16 + zlib.MAX_WBITS))
+    assert command['body']['email_id'] == 'tem_1'
+
+
+def test_async_prepare_send(recipient):
+    from sendwithus.transport import MemoryTransport
+    transport = MemoryTransport()
+
+    async def main():
+        swu = aio.AsyncAPI('TEST_API_KEY', transport=transport)
+        prepared = swu.prepare_send('tem_1', tags=['a'])
+        return await prepared.send(recipient, {'n': 1})
+
+    assert run(main()).status_code == 200
+    request, = transport.requests
+    assert request.json()['email_data'] == {'n': 1}
+    assert request.json()['tags'] == ['a']
+
+
+def test_async_customers_bulk_upsert():
+    from sendwithus.transport import MemoryTransport
+    transport = MemoryTransport()
+
+    async def main():
+        swu = aio.AsyncAPI('TEST_API_KEY', transport=transport)
+        return await swu.customers_bulk_upsert(
+            ('user%s@example.com' % i for i in range(7)),
+            batch_size=3
+        )
+
+    result = run(main())
+    assert (result.succeeded, result.failed, result.batches) == (7, 0, 3)
+    assert len(transport.requests) == 3
+
+
+def test_async_drip_enroll_many():
+    from sendwithus.transport import MemoryTransport
+    transport = MemoryTransport()
+
+    async def main():
+        swu = aio.AsyncAPI('TEST_API_KEY', transport=transport)
+        return [
+            result async for result in swu.drip_enroll_many(
+                'dc_1',
+                ['user%s@example.com' % i for i in range(5)],
+                batch_size=2
+            )
+        ]
+
+    results = run(main())
+    assert [r.index for r in results] == list(range(5))
+    assert all(r.ok for r in results)
+    assert len(transport.requests) == 3
+
+
+def test_async_iter_drip_campaign_customers():
+    from sendwithus.transport import MemoryTransport
+    transport = MemoryTransport(
+        responder=lambda request: (200, [{'email': 'a@example.com'}] * (
+            2 if request.url.endswith('offset=0') else 1
+        ))
+    )
+
+    async def main():
+        swu = aio.AsyncAPI('TEST_API_KEY', transport=transport)
+        return [
+            customer async for customer in
+            swu.iter_drip_campaign_customers('dc_1', page_size=2)
+        ]
+
+    assert len(run(main())) == 3
+    assert transport.request_count == 2
@@ -1,8 +1,15 @@
+import base64
+import datetime
 import decimal
+import io
+import json
+import logging
+import os
 import tempfile
 import time
 
 import pytest
+import requests
 import six
 
 import sendwithus
@@ -610,3 +617,1571 @@ def test_create_template_with_template_data(api):
     assert_success(result)
 
     assert result.json()['template_data'] == expected
+
+
+def test_session_reuses_connection(mock_api, mock_server):
+    """ Test consecutive requests share one pooled connection. """
+    assert_success(mock_api.templates())
+    assert_success(mock_api.snippets())
+
+    assert len(mock_server.requests) == 2
+    first, second = mock_server.requests
+    assert first['port'] == second['port']
+
+
+def test_batch_shares_session(mock_api):
+    batch = mock_api.start_batch()
+    assert batch._session is mock_api._session
+    assert_success(mock_api.templates())
+    batch.close()
+    adapter = mock_api._session.get_adapter('http://127.0.0.1')
+    assert len(adapter.poolmanager.pools) == 1
+
+
+def test_close_releases_session(mock_api_options, mock_server):
+    with sendwithus.api(
+        'TEST_API_KEY',
+        keep_alive=False,
+        **mock_api_options
+    ) as swu_api:
+        assert_success(swu_api.templates())
+        assert mock_server.requests[0]['headers']['Connection'] == 'close'
+    adapter = swu_api._session.get_adapter('http://127.0.0.1')
+    assert len(adapter.poolmanager.pools) == 0
+
+
+def test_send_many(mock_api, mock_server, recipient):
+    mock_server.responses.extend([(200, {}), (400, {}), (200, {})])
+    sends = (
+        {'email_id': 'tem_%s' % x, 'recipient': recipient}
+        for x in range(3)
+    )
+
+    results = list(mock_api.send_many(sends, concurrency=1))
+
+    assert [r.index for r in results] == [0, 1, 2]
+    assert [r.ok for r in results] == [True, False, True]
+    assert results[2].kwargs['email_id'] == 'tem_2'
+
+
+def test_send_many_captures_errors(mock_api, mock_server, recipient):
+    sends = [
+        {'email_id': 'tem_1', 'recipient': recipient},
+        {'email_id': 'tem_2', 'recipient': recipient, 'files': '1337'},
+        {'email_id': 'tem_3', 'recipient': recipient},
+    ]
+
+    results = list(mock_api.send_many(sends, concurrency=4, ordered=False))
+
+    assert sorted(r.index for r in results) == [0, 1, 2]
+    failed, = [r for r in results if not r.ok]
+    assert failed.index == 1
+    assert isinstance(failed.error, AttributeError)
+    assert len(mock_server.requests) == 2
+
+
+def test_batch_auto_flush_by_command_count(mock_api, mock_server):
+    batch = mock_api.start_batch(max_commands=4)
+    for x in range(10):
+        batch.customer_create('test+%s@example.com' % x)
+
+    # two full sub-batches were sent while queueing
+    assert len(mock_server.requests) == 2
+    assert batch.command_length() == 2
+
+    result = batch.execute()
+    assert [len(json.loads(r['body'])) for r in mock_server.requests] == \
+        [4, 4, 2]
+    assert len(result.responses) == 3
+    assert len(result.json()) == 10
+    assert result.ok
+    assert batch.command_length() == 0
+
+
+def test_batch_auto_flush_by_bytes(mock_api, mock_server):
+    batch = mock_api.start_batch(max_bytes=500)
+    for x in range(20):
+        batch.customer_create('test+%s@example.com' % x)
+    result = batch.execute()
+
+    assert all(len(r['body']) <= 500 for r in mock_server.requests)
+    assert len(mock_server.requests) > 1
+    assert len(result.json()) == 20
+    emails = [
+        command['body']['email']
+        for request in mock_server.requests
+        for command in json.loads(request['body'])
+    ]
+    assert emails == ['test+%s@example.com' % x for x in range(20)]
+
+
+def test_batch_deferred_flush(mock_api, mock_server):
+    batch = mock_api.start_batch(max_commands=3, auto_flush=False)
+    for x in range(7):
+        batch.customer_create('test+%s@example.com' % x)
+
+    assert len(mock_server.requests) == 0
+    assert batch.command_length() == 7
+    assert len(batch.execute().responses) == 3
+
+
+def test_batch_parallel_execute(mock_api, mock_server):
+    mock_server.delay = 0.05
+    batch = mock_api.start_batch(max_commands=2, auto_flush=False)
+    for x in range(8):
+        batch.customer_details('test+%s@example.com' % x)
+
+    result = batch.execute(parallel=4)
+
+    assert len(result.responses) == 4
+    assert len(set(r['port'] for r in mock_server.requests)) > 1
+    assert [r['path'] for r in result.json()] == [
+        '/api/v1/customers/test+%s@example.com' % x for x in range(8)
+    ]
+    assert batch.command_length() == 0
+
+
+def test_batch_result_failures(mock_api, mock_server):
+    mock_server.responses.append((200, [
+        {'status_code': 200, 'body': {'success': True}},
+        {'status_code': 400, 'body': {'error': 'bad recipient'}},
+        {'status_code': 200, 'body': {'success': True}},
+    ]))
+    batch = mock_api.start_batch()
+    for x in range(3):
+        batch.customer_create('test+%s@example.com' % x)
+
+    result = batch.execute()
+
+    assert len(result) == 3
+    assert not result.ok
+    failed, = result.failures()
+    assert failed.index == 1
+    assert failed.body == {'error': 'bad recipient'}
+    assert failed.command['body']['email'] == 'test+1@example.com'
+    assert [r.index for r in result.successes()] == [0, 2]
+
+
+def test_batch_result_rejected_batch(mock_api, mock_server):
+    mock_server.responses.append((403, {'error': 'bad key'}))
+    batch = mock_api.start_batch()
+    batch.customer_create('test@example.com')
+    batch.customer_create('test+1@example.com')
+
+    result = batch.execute()
+
+    assert result.status_code == 403
+    assert [r.status_code for r in result.failures()] == [403, 403]
+    assert result[0].body == {'error': 'bad key'}
+
+
+def test_iter_json_array_chunks():
+    from sendwithus.streaming import iter_json_array
+    data = [{'status_code': 200, 'body': {'name': u'caf\xe9'}}, 1.5, None]
+    content = json.dumps(data, ensure_ascii=False).encode('utf-8')
+    chunks = [content[i:i + 3] for i in range(0, len(content), 3)]
+
+    assert list(iter_json_array(chunks)) == data
+    with pytest.raises(ValueError):
+        list(iter_json_array([b'[{"status_code": 200}']))
+
+
+@pytest.fixture
+def retry_api(mock_api_options):
+    from sendwithus.retry import RetryPolicy
+    with sendwithus.api(
+        'TEST_API_KEY',
+        retry_policy=RetryPolicy(max_retries=2, backoff_factor=0),
+        **mock_api_options
+    ) as swu_api:
+        yield swu_api
+
+
+def test_retry_get_on_server_error(retry_api, mock_server):
+    mock_server.responses.extend([(502, {}), (503, {})])
+    assert_success(retry_api.templates())
+    assert len(mock_server.requests) == 3
+
+
+def test_retry_gives_up(retry_api, mock_server):
+    mock_server.responses.extend([(503, {})] * 3)
+    assert retry_api.templates().status_code == 503
+    assert len(mock_server.requests) == 3
+
+
+def test_retry_send_only_when_idempotent(retry_api, mock_server, recipient):
+    mock_server.responses.extend([(503, {}), (503, {})])
+    assert retry_api.send('tem_1', recipient).status_code == 503
+    assert len(mock_server.requests) == 1
+
+    assert_success(retry_api.send('tem_1', recipient, idempotent=True))
+    assert len(mock_server.requests) == 3
+
+
+def test_retry_rate_limited_send(retry_api, mock_server, recipient):
+    mock_server.responses.append((429, {}, {'Retry-After': '0'}))
+    assert_success(retry_api.send('tem_1', recipient))
+    assert len(mock_server.requests) == 2
+
+
+def test_retry_batch_execute(retry_api, mock_server):
+    mock_server.responses.append((500, {}))
+    batch = retry_api.start_batch()
+    batch.customer_create('test@example.com')
+
+    assert batch.execute(idempotent=True).ok
+    assert len(mock_server.requests) == 2
+
+
+def test_retry_connect_error():
+    from sendwithus.retry import RetryPolicy
+    policy = RetryPolicy(max_retries=2, backoff_factor=0)
+    sleeps = []
+    policy.sleep = sleeps.append
+    swu_api = sendwithus.api(
+        'TEST_API_KEY',
+        API_PROTO='http',
+        API_HOST='127.0.0.1',
+        API_PORT='1',
+        retry_policy=policy
+    )
+
+    with pytest.raises(requests.exceptions.ConnectionError):
+        swu_api.customer_create('test@example.com')
+    assert len(sleeps) == 2
+
+
+def test_retry_policy_backoff():
+    from sendwithus.retry import RetryPolicy
+    policy = RetryPolicy(backoff_factor=1, max_backoff=5, jitter=False)
+
+    assert [policy.get_backoff(n) for n in range(1, 5)] == [1, 2, 4, 5]
+    assert policy.get_backoff(1, retry_after='3') == 3
+    assert policy.get_retry_delay(4, 0, True, status_code=503) is None
+    assert policy.get_retry_delay(1, 0, False, status_code=503) is None
+    assert policy.get_retry_delay(1, 0, False, status_code=429) == 1
+
+    policy.budget = 2
+    assert policy.get_retry_delay(2, 1, True, status_code=503) is None
+
+
+def test_token_bucket():
+    from sendwithus.ratelimit import TokenBucket
+    bucket = TokenBucket(rate=100, capacity=2)
+
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert bucket.wait_time() > 0
+    assert 0 < bucket.reserve() <= 0.01
+    assert bucket.total_wait == bucket.last_wait
+
+
+def test_file_token_bucket_shared(tmp_path):
+    from sendwithus.ratelimit import FileTokenBucket
+    path = str(tmp_path / 'bucket')
+    first = FileTokenBucket(path, rate=1, capacity=2)
+    second = FileTokenBucket(path, rate=1, capacity=2)
+
+    assert first.reserve() == 0
+    assert second.reserve() == 0
+    assert second.wait_time() > 0.9
+    assert first.reserve() > 0.9
+    first.close()
+    second.close()
+
+
+def test_rate_limited_requests(mock_api_options):
+    from sendwithus.ratelimit import TokenBucket
+    bucket = TokenBucket(rate=20, capacity=1)
+    with sendwithus.api(
+        'TEST_API_KEY',
+        rate_limiter=bucket,
+        **mock_api_options
+    ) as swu_api:
+        start = time.time()
+        for _ in range(3):
+            swu_api.templates()
+        batch = swu_api.start_batch()
+        batch.customer_create('test@example.com')
+        batch.execute()
+
+    assert time.time() - start >= 0.14
+    assert bucket.total_wait > 0
+
+
+@pytest.fixture
+def cached_api(mock_api_options):
+    from sendwithus.cache import ResponseCache
+    with sendwithus.api(
+        'TEST_API_KEY',
+        cache=ResponseCache(ttl=60, maxsize=2),
+        **mock_api_options
+    ) as swu_api:
+        yield swu_api
+
+
+def test_cache_serves_lookups(cached_api, mock_server):
+    assert_success(cached_api.get_template('tem_1'))
+    assert_success(cached_api.get_template('tem_1'))
+    assert_success(cached_api.snippets())
+    assert_success(cached_api.snippets())
+    cached_api.customer_details('person@example.com')
+    cached_api.customer_details('person@example.com')
+
+    assert [r['path'] for r in mock_server.requests] == [
+        '/api/v1/templates/tem_1',
+        '/api/v1/snippets',
+        '/api/v1/customers/person@example.com',
+        '/api/v1/customers/person@example.com',
+    ]
+
+
+def test_cache_is_bounded(cached_api, mock_server):
+    for snippet_id in ('snp_1', 'snp_2', 'snp_3', 'snp_1'):
+        cached_api.get_snippet(snippet_id)
+    assert len(cached_api._cache) == 2
+    assert len(mock_server.requests) == 4
+
+
+def test_cache_invalidated_by_updates(cached_api, mock_server):
+    cached_api.templates()
+    cached_api.get_template('tem_1')
+    cached_api.get_template('tem_2')
+    cached_api.update_template_version('name', 'subject', 'tem_1', 'ver_1')
+    assert len(cached_api._cache) == 1
+
+    cached_api.get_snippet('snp_1')
+    batch = cached_api.start_batch()
+    batch.update_snippet('snp_1', 'name', 'body')
+    batch.execute()
+    cached_api.get_snippet('snp_1')
+
+    assert [r['path'] for r in mock_server.requests][-2:] == [
+        '/api/v1/batch',
+        '/api/v1/snippets/snp_1',
+    ]
+
+
+def test_cache_invalidate_related_paths():
+    from sendwithus.cache import ResponseCache
+    cache = ResponseCache(maxsize=3)
+    response = requests.Response()
+    for path in ('templates', 'templates/tem_1', 'snippets/snp_1'):
+        cache.set(path, 'TEMPLATES_ENDPOINT', response)
+
+    cache.invalidate('send')
+    cache.invalidate('customers/templates')
+    assert len(cache) == 3
+    cache.invalidate('templates/tem_1/versions/ver_1')
+    assert list(cache._entries) == ['snippets/snp_1']
+
+    for path in ('templates/tem_2', 'snippets/snp_2', 'snippets/snp_3'):
+        cache.set(path, 'TEMPLATES_ENDPOINT', response)
+    assert list(cache._entries) == [
+        'templates/tem_2',
+        'snippets/snp_2',
+        'snippets/snp_3',
+    ]
+    assert cache._segments == {
+        'templates': {'templates/tem_2'},
+        'snippets': {'snippets/snp_2', 'snippets/snp_3'},
+    }
+    cache.clear()
+    assert cache._segments == {}
+
+
+def test_cache_ttl_per_endpoint(mock_api_options, mock_server):
+    from sendwithus.cache import ResponseCache
+    cache = ResponseCache(ttl=60, ttls={'SNIPPETS_ENDPOINT': None})
+    swu_api = sendwithus.api(
+        'TEST_API_KEY',
+        cache=cache,
+        **mock_api_options
+    )
+    swu_api.snippets()
+    swu_api.snippets()
+    assert len(mock_server.requests) == 2
+
+    cache.ttls['SNIPPETS_ENDPOINT'] = 0.05
+    swu_api.snippets()
+    swu_api.snippets()
+    time.sleep(0.06)
+    swu_api.snippets()
+    assert len(mock_server.requests) == 4
+
+
+def test_endpoint_name(api_options):
+    swu_api = sendwithus.api('TEST_API_KEY', **api_options)
+    assert swu_api._endpoint_name('send', 'POST') == 'SEND_ENDPOINT'
+    assert swu_api._endpoint_name('templates/tem_1/versions/ver_1', 'PUT') \
+        == 'TEMPLATES_VERSION_ENDPOINT'
+    assert swu_api._endpoint_name('customers/a@example.com', 'GET') == \
+        'CUSTOMER_DETAILS_ENDPOINT'
+    assert swu_api._endpoint_name('customers/a@example.com', 'DELETE') == \
+        'CUSTOMER_DELETE_ENDPOINT'
+
+
+def test_conditional_requests(mock_api_options, mock_server):
+    from sendwithus.cache import ResponseCache
+    swu_api = sendwithus.api(
+        'TEST_API_KEY',
+        cache=ResponseCache(ttl=0),
+        **mock_api_options
+    )
+    mock_server.responses.extend([
+        (200, {'id': 'tem_1', 'html': '<html></html>'}, {'ETag': '"v1"'}),
+        (304, None, {'ETag': '"v1"'}),
+        (200, {'id': 'tem_1', 'html': '<p></p>'}, {'ETag': '"v2"'}),
+    ])
+
+    first = swu_api.get_template('tem_1')
+    second = swu_api.get_template('tem_1')
+    third = swu_api.get_template('tem_1')
+
+    assert second is first
+    assert second.json()['html'] == '<html></html>'
+    assert third.json()['html'] == '<p></p>'
+    headers = [r['headers'] for r in mock_server.requests]
+    assert 'If-None-Match' not in headers[0]
+    assert headers[1]['If-None-Match'] == '"v1"'
+    assert headers[2]['If-None-Match'] == '"v1"'
+
+    swu_api.get_template('tem_1')
+    assert mock_server.requests[3]['headers']['If-None-Match'] == '"v2"'
+
+
+def test_conditional_requests_last_modified(cached_api, mock_server):
+    last_modified = 'Wed, 21 Oct 2015 07:28:00 GMT'
+    mock_server.responses.extend([
+        (200, {'id': 'snp_1'}, {'Last-Modified': last_modified}),
+        (304, None),
+    ])
+    cached_api._cache.ttls['SNIPPET_ENDPOINT'] = 0
+
+    cached_api.get_snippet('snp_1')
+    assert cached_api.get_snippet('snp_1').json() == {'id': 'snp_1'}
+    assert mock_server.requests[1]['headers']['If-Modified-Since'] == \
+        last_modified
+
+
+def test_send_streams_attachments(mock_api, mock_server, recipient):
+    class RecordingFile(io.BytesIO):
+        name = 'report.pdf'
+        reads = []
+
+        def read(self, size=-1):
+            self.reads.append(size)
+            return io.BytesIO.read(self, size)
+
+    content = os.urandom(200 * 1024 + 1)
+    attachment = RecordingFile(content)
+
+    assert_success(mock_api.send(
+        'tem_1',
+        recipient,
+        files=[attachment],
+        inline={'file': io.BytesIO(b'img'), 'filename': 'logo.png'}
+    ))
+
+    request, = mock_server.requests
+    body = json.loads(request['body'].decode('utf-8'))
+    assert body['files'] == [{
+        'id': 'report.pdf',
+        'data': base64.b64encode(content).decode('ascii')
+    }]
+    assert body['inline']['data'] == base64.b64encode(b'img').decode('ascii')
+    assert int(request['headers']['Content-Length']) == len(request['body'])
+    # read in bounded chunks rather than all at once
+    assert all(0 < size <= 3 * 64 * 1024 for size in attachment.reads)
+
+
+def test_base64_file_chunks():
+    from sendwithus.streaming import Base64File
+
+    class Trickle(io.BytesIO):
+        def read(self, size=-1):
+            return io.BytesIO.read(self, min(size, 5))
+
+    content = b'0123456789abcdefghijklmnopqrstuvwxyz'
+    encoded = Base64File(Trickle(content), chunk_size=7)
+
+    assert encoded.read() == base64.b64encode(content).decode('ascii')
+    assert encoded.encoded_length() == len(encoded.read())
+
+
+def test_batch_send_with_attachment(mock_api, mock_server, recipient):
+    batch = mock_api.start_batch()
+    batch.send('tem_1', recipient, files=[{
+        'file': io.BytesIO(b'data'),
+        'filename': 'data.txt'
+    }])
+    batch.execute()
+
+    command, = json.loads(mock_server.requests[0]['body'].decode('utf-8'))
+    assert command['body']['files'][0]['data'] == 'ZGF0YQ=='
+
+
+def test_streamed_payloads(mock_api_options, mock_server, recipient):
+    swu_api = sendwithus.api(
+        'TEST_API_KEY',
+        stream_payloads=True,
+        **mock_api_options
+    )
+    attachment = io.BytesIO(b'attachment' * 50000)
+    attachment.name = 'data.txt'
+
+    assert_success(swu_api.send(
+        'tem_1',
+        recipient,
+        email_data={'price': decimal.Decimal('5.5'), 'rows': list(range(9))},
+        files=[attachment, {'file': io.BytesIO(b'x'), 'filename': 'x'}]
+    ))
+    html = '<p>%s</p>' % ('x' * 300000)
+    assert_success(swu_api.create_template('name', 'subject', html))
+
+    send, template = mock_server.requests
+    assert send['headers']['Transfer-Encoding'] == 'chunked'
+    body = json.loads(send['body'].decode('utf-8'))
+    assert body['email_data'] == {'price': 5.5, 'rows': list(range(9))}
+    assert [f['data'] for f in body['files']] == [
+        base64.b64encode(b'attachment' * 50000).decode('ascii'),
+        'eA==',
+    ]
+    assert json.loads(template['body'].decode('utf-8'))['html'] == html
+
+
+def test_batch_body_not_joined(mock_api, mock_server):
+    from sendwithus.streaming import JSONArrayBody
+    body = JSONArrayBody(['{"a": 1}', '"b"', '2'], chunk_size=4)
+    assert len(body) == len(body.getvalue()) == 16
+    assert json.loads(body.getvalue().decode('utf-8')) == [{'a': 1}, 'b', 2]
+
+    batch = mock_api.start_batch()
+    for x in range(3):
+        batch.customer_create('test+%s@example.com' % x)
+    batch.execute()
+
+    request, = mock_server.requests
+    assert 'Transfer-Encoding' not in request['headers']
+    assert len(json.loads(request['body'].decode('utf-8'))) == 3
+
+
+@pytest.mark.parametrize('backend', ['json', 'orjson', 'ujson'])
+def test_json_backend(mock_api_options, mock_server, recipient, backend):
+    if backend != 'json':
+        pytest.importorskip(backend)
+    swu_api = sendwithus.api(
+        'TEST_API_KEY',
+        json_backend=backend,
+        **mock_api_options
+    )
+    assert swu_api._json.name == backend
+    when = datetime.datetime(2020, 1, 2, 3, 4, 5)
+    attachment = io.BytesIO(b'attachment')
+    attachment.name = 'data.txt'
+    email_data = {
+        'when': when,
+        'price': decimal.Decimal('5.5'),
+        'name': u'J\xf6rg \U0001f600',
+        'url': 'http://example.com/a',
+        1: 'one',
+    }
+
+    assert_success(swu_api.send(
+        'tem_1',
+        recipient,
+        email_data=email_data,
+        files=[attachment]
+    ))
+    batch = swu_api.start_batch()
+    batch.send('tem_1', recipient, email_data=email_data)
+    assert batch.execute().ok
+
+    send, batch_request = mock_server.requests
+    expected = {
+        'when': int(time.mktime(when.timetuple())),
+        'price': 5.5,
+        'name': u'J\xf6rg \U0001f600',
+        'url': 'http://example.com/a',
+        '1': 'one',
+    }
+    send_body = send['body'].decode('ascii')
+    assert json.loads(send_body)['email_data'] == expected
+    assert json.loads(send_body)['files'][0]['data'] == 'YXR0YWNobWVudA=='
+    command, = json.loads(batch_request['body'].decode('ascii'))
+    assert command['body']['email_data'] == expected
+
+    with pytest.raises(TypeError):
+        swu_api.send('tem_1', recipient, email_data={'x': object()})
+
+
+def test_json_backend_orjson_fallback():
+    pytest.importorskip('orjson')
+    from sendwithus.jsonlib import OrjsonJSON
+    encoder = sendwithus.encoder.SendwithusJSONEncoder()
+    backend = OrjsonJSON()
+    data = {'big': 2 ** 70, 'name': u'J\xf6rg'}
+    assert backend.dumps(data, encoder) == encoder.encode(data)
+    with pytest.raises(TypeError):
+        backend.dumps({'x': object()}, encoder)
+
+
+def test_json_backend_selection():
+    from sendwithus.jsonlib import StdlibJSON, get_backend
+    assert isinstance(get_backend(), StdlibJSON)
+    assert get_backend('auto').name in ('orjson', 'ujson', 'json')
+    backend = StdlibJSON()
+    assert get_backend(backend) is backend
+    assert get_backend('json').loads(b'{"a": [1]}') == {'a': [1]}
+    with pytest.raises(ValueError):
+        get_backend('simplejson')
+
+
+@pytest.fixture
+def debug_records():
+    class Handler(logging.Handler):
+        def emit(self, record):
+            records.append(record.getMessage())
+
+    records = []
+    handler = Handler()
+    level = sendwithus.logger.level
+    sendwithus.logger.addHandler(handler)
+    yield records
+    sendwithus.logger.removeHandler(handler)
+    sendwithus.logger.setLevel(level)
+
+
+def test_debug_logging_is_lazy(mock_api, recipient, debug_records,
+                               monkeypatch):
+    def fail(self):
+        raise AssertionError('body formatted with debug logging off')
+
+    monkeypatch.setattr(sendwithus._LogBody, '__str__', fail)
+    sendwithus.logger.setLevel(logging.INFO)
+    assert_success(mock_api.send('tem_1', recipient))
+    batch = mock_api.start_batch()
+    batch.send('tem_1', recipient)
+    assert batch.execute().ok
+    assert debug_records == []
+
+
+def test_debug_logging_caps_bodies(mock_api, debug_records):
+    sendwithus.logger.setLevel(logging.DEBUG)
+    html = 'x' * 5000
+    assert_success(mock_api.create_template('name', 'subject', html))
+    data, = [m for m in debug_records if m.startswith('\tdata: ')]
+    assert len(data) < 1100
+    assert data.endswith(' characters)')
+    assert '\tresponse: {"success": true}' in debug_records
+
+    del debug_records[:]
+    mock_api.DEBUG_BODY_LIMIT = None
+    assert_success(mock_api.create_template('name', 'subject', html))
+    data, = [m for m in debug_records if m.startswith('\tdata: ')]
+    assert html in data
+
+
+def test_request_hooks(mock_api_options, mock_server, recipient):
+    from sendwithus.cache import ResponseCache
+    from sendwithus.retry import RetryPolicy
+    started = []
+    finished = []
+    swu_api = sendwithus.api(
+        'TEST_API_KEY',
+        retry_policy=RetryPolicy(max_retries=2, backoff_factor=0),
+        cache=ResponseCache(ttl=60),
+        on_request=started.append,
+        on_response=finished.append,
+        **mock_api_options
+    )
+
+    mock_server.responses.append((503, {}))
+    assert_success(swu_api.get_template('tem_1'))
+    assert_success(swu_api.get_template('tem_1'))
+    assert_success(swu_api.send('tem_1', recipient))
+
+    lookup, cached, send = finished
+    assert started == [lookup, send]
+    assert lookup.endpoint == 'TEMPLATES_SPECIFIC_ENDPOINT'
+    assert lookup.method == 'GET'
+    assert lookup.path.endswith('/templates/tem_1')
+    assert (lookup.status_code, lookup.retries) == (200, 1)
+    assert lookup.request_bytes == 0
+    assert lookup.response_bytes == len(b'{"success": true}')
+    assert set(lookup.timings) == {'encode', 'request', 'backoff', 'total'}
+    assert lookup.timings['total'] >= lookup.timings['request']
+    assert cached.cached and cached.endpoint == lookup.endpoint
+    assert send.endpoint == 'SEND_ENDPOINT'
+    assert send.request_bytes == len(mock_server.requests[-1]['body'])
+    assert (send.status_code, send.retries, send.error) == (200, 0, None)
+
+
+def test_request_hooks_batch(mock_api_options, mock_server, recipient):
+    finished = []
+    swu_api = sendwithus.api(
+        'TEST_API_KEY',
+        on_response=finished.append,
+        **mock_api_options
+    )
+    batch = swu_api.start_batch(max_commands=2, auto_flush=False)
+    for x in range(3):
+        batch.send('tem_1', recipient)
+    assert batch.execute(parallel=2).ok
+
+    assert sorted(e.commands for e in finished) == [1, 2]
+    for event in finished:
+        assert event.endpoint == 'BATCH_ENDPOINT'
+        assert event.status_code == 200
+        assert event.response_bytes > 0
+        assert 'parse' in event.timings
+    assert sum(e.request_bytes for e in finished) == sum(
+        len(r['body']) for r in mock_server.requests)
+
+
+def test_request_hooks_errors(recipient):
+    def broken(event):
+        raise RuntimeError('broken hook')
+
+    finished = []
+    swu_api = sendwithus.api(
+        'TEST_API_KEY',
+        API_PROTO='http',
+        API_HOST='127.0.0.1',
+        API_PORT='1',
+        on_request=broken,
+        on_response=finished.append
+    )
+    with pytest.raises(requests.exceptions.ConnectionError):
+        swu_api.send('tem_1', recipient)
+
+    event, = finished
+    assert event.status_code is None
+    assert isinstance(event.error, requests.exceptions.ConnectionError)
+
+
+@pytest.fixture
+def span_exporter():
+    pytest.importorskip('opentelemetry.sdk')
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+    from opentelemetry.sdk.trace.export.in_memory_span_exporter import (
+        InMemorySpanExporter)
+    exporter = InMemorySpanExporter()
+    provider = TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(exporter))
+    exporter.provider = provider
+    return exporter
+
+
+def test_tracing(mock_api_options, mock_server, recipient, span_exporter):
+    from sendwithus.tracing import Tracing
+    swu_api = sendwithus.api(
+        'TEST_API_KEY',
+        tracing=Tracing(span_exporter.provider),
+        **mock_api_options
+    )
+    mock_server.responses.append((400, {}))
+    swu_api.send('tem_1', recipient)
+    batch = swu_api.start_batch(max_commands=1, auto_flush=False)
+    batch.get_template('tem_2')
+    batch.get_template('tem_3')
+    assert batch.execute(parallel=2).ok
+
+    spans = span_exporter.get_finished_spans()
+    send = spans[0]
+    assert send.name == 'sendwithus.send'
+    assert send.kind.name == 'CLIENT'
+    assert send.attributes['sendwithus.endpoint'] == 'SEND_ENDPOINT'
+    assert send.attributes['sendwithus.template_id'] == 'tem_1'
+    assert send.attributes['http.response.status_code'] == 400
+    assert send.attributes['http.request.body.size'] > 0
+    assert send.status.status_code.name == 'ERROR'
+    traceparent = mock_server.requests[0]['headers']['traceparent']
+    assert traceparent.split('-')[1] == '%032x' % send.context.trace_id
+
+    execute = spans[-1]
+    assert execute.name == 'sendwithus.batch.execute'
+    assert execute.attributes['sendwithus.batch.size'] == 2
+    requests_spans = spans[1:-1]
+    assert [s.name for s in requests_spans] == ['sendwithus.batch'] * 2
+    for span in requests_spans:
+        assert span.parent.span_id == execute.context.span_id
+        assert span.attributes['sendwithus.batch.size'] == 1
+
+
+def test_tracing_disabled_without_opentelemetry(monkeypatch):
+    import sendwithus.tracing
+    monkeypatch.setattr(sendwithus.tracing, 'trace', None)
+    swu_api = sendwithus.api('TEST_API_KEY', tracing=True)
+    assert swu_api._tracing is None
+    assert swu_api._new_event('send', 'POST') is None
+
+
+def test_memory_transport(recipient):
+    from sendwithus.transport import MemoryTransport
+    transport = MemoryTransport()
+    swu_api = sendwithus.api('TEST_API_KEY', transport=transport)
+    attachment = io.BytesIO(b'attachment')
+    attachment.name = 'data.txt'
+
+    r = swu_api.send('tem_1', recipient, files=[attachment])
+    assert r.status_code == 200
+    assert r.json() == {'success': True, 'status': 'OK'}
+
+    transport.queue(404, {'error': 'not found'}, {'X-Request-Id': 'abc'})
+    r = swu_api.get_template('tem_missing')
+    assert (r.status_code, r.headers['x-request-id']) == (404, 'abc')
+
+    batch = swu_api.start_batch(max_commands=2)
+    for x in range(3):
+        batch.customer_create('test+%s@example.com' % x)
+    assert batch.execute().ok
+
+    send, lookup, first, second = transport.requests
+    assert send.method == 'POST' and send.path == '/api/v1/send'
+    assert send.json()['files'][0]['data'] == 'YXR0YWNobWVudA=='
+    assert lookup.method == 'GET' and lookup.body == b''
+    assert [len(first.json()), len(second.json())] == [2, 1]
+    assert transport.request_count == 4
+
+
+def test_memory_transport_simulation(recipient):
+    from sendwithus.retry import RetryPolicy
+    from sendwithus.transport import MemoryTransport
+    transport = MemoryTransport(
+        record=False,
+        latency=lambda request: 0.001,
+        error_rate=0.2,
+        failure_rate=0.2,
+        seed=1
+    )
+    swu_api = sendwithus.api(
+        'TEST_API_KEY',
+        transport=transport,
+        retry_policy=RetryPolicy(max_retries=20, backoff_factor=0)
+    )
+    for x in range(20):
+        r = swu_api.send('tem_1', recipient, idempotent=True)
+        assert r.status_code == 200
+        assert r.elapsed.total_seconds() >= 0.001
+    assert transport.request_count > 20
+    assert transport.requests == []
+
+    limited = MemoryTransport(rate_limit=2)
+    swu_api = sendwithus.api('TEST_API_KEY', transport=limited)
+    statuses = [swu_api.templates().status_code for x in range(3)]
+    assert statuses == [200, 200, 429]
+
+
+def test_outbox(recipient, tmpdir):
+    from sendwithus.outbox import SQLiteOutbox
+    from sendwithus.transport import MemoryTransport
+    path = str(tmpdir.join('outbox.db'))
+    transport = MemoryTransport()
+    swu_api = sendwithus.api(
+        'TEST_API_KEY',
+        transport=transport,
+        outbox=SQLiteOutbox(path),
+        outbox_worker=False
+    )
+
+    r = swu_api.send('tem_1', recipient, email_data={'x': 1})
+    assert r.status_code == 202
+    assert r.json()['status'] == 'queued'
+    swu_api.send('tem_2', recipient)
+    assert transport.requests == []
+
+    # queued sends survive the process, and are sent in one batch
+    reopened = sendwithus.api(
+        'TEST_API_KEY',
+        transport=transport,
+        outbox=SQLiteOutbox(path),
+        outbox_worker=False
+    )
+    assert len(reopened._outbox) == 2
+    reopened.flush_outbox()
+    request, = transport.requests
+    assert request.path == '/api/v1/batch'
+    first, second = request.json()
+    assert first['path'] == '/api/v1/send'
+    assert first['body']['email_id'] == 'tem_1'
+    assert first['body']['email_data'] == {'x': 1}
+    assert second['body']['email_id'] == 'tem_2'
+    assert len(reopened._outbox) == 0
+
+
+def test_outbox_retries_and_failures(recipient):
+    from sendwithus.outbox import OutboxWorker, SQLiteOutbox
+    from sendwithus.retry import RetryPolicy
+    from sendwithus.transport import MemoryTransport
+    transport = MemoryTransport()
+    outbox = SQLiteOutbox(':memory:')
+    swu_api = sendwithus.api(
+        'TEST_API_KEY',
+        transport=transport,
+        outbox=outbox,
+        outbox_worker=False
+    )
+    for x in range(3):
+        swu_api.send('tem_%s' % x, recipient)
+
+    worker = OutboxWorker(
+        swu_api,
+        outbox,
+        retry_policy=RetryPolicy(max_retries=1, backoff_factor=0, jitter=False)
+    )
+    transport.queue(200, [
+        {'status_code': 200, 'body': {'success': True}},
+        {'status_code': 503, 'body': {}},
+        {'status_code': 400, 'body': {'error': 'bad template'}},
+    ])
+    assert worker.drain_once() == 3
+    assert len(outbox) == 1
+    failed, = outbox.failed()
+    assert failed['status_code'] == 400
+    assert json.loads(failed['response']) == {'error': 'bad template'}
+
+    # the whole batch request failing counts as an attempt too
+    transport.queue(500, {})
+    assert worker.drain_once() == 1
+    assert len(outbox) == 0
+    retried, rejected = outbox.failed()
+    assert rejected['status_code'] == 400
+    assert retried['status_code'] == 500
+    assert retried['attempts'] == 2
+    assert json.loads(retried['command'])['body']['email_id'] == 'tem_1'
+
+
+def test_outbox_worker(recipient):
+    from sendwithus.outbox import SQLiteOutbox
+    from sendwithus.transport import MemoryTransport
+    transport = MemoryTransport()
+    outbox = SQLiteOutbox(':memory:')
+    with sendwithus.api(
+        'TEST_API_KEY',
+        transport=transport,
+        outbox=outbox
+    ) as swu_api:
+        swu_api.send('tem_1', recipient)
+        deadline = time.time() + 5
+        while len(outbox) and time.time() < deadline:
+            time.sleep(0.01)
+        assert len(outbox) == 0
+    assert swu_api._outbox_worker is None
+    request, = transport.requests
+    assert len(request.json()) == 1
+
+
+def test_idempotency_key(recipient):
+    from sendwithus.retry import RetryPolicy
+    from sendwithus.transport import MemoryTransport
+    transport = MemoryTransport()
+    swu_api = sendwithus.api(
+        'TEST_API_KEY',
+        transport=transport,
+        retry_policy=RetryPolicy(max_retries=2, backoff_factor=0)
+    )
+
+    # a keyed send is safe to retry after a server error
+    transport.queue(503, {})
+    r = swu_api.send('tem_1', recipient, idempotency_key='send-1')
+    assert r.status_code == 200
+    first, second = transport.requests
+    assert first.headers['Idempotency-Key'] == 'send-1'
+    assert second.headers['Idempotency-Key'] == 'send-1'
+
+    swu_api.send('tem_1', recipient)
+    assert 'Idempotency-Key' not in transport.requests[-1].headers
+
+
+def test_idempotency_keys_generated(recipient):
+    from sendwithus.transport import MemoryTransport
+    transport = MemoryTransport()
+    swu_api = sendwithus.api(
+        'TEST_API_KEY',
+        transport=transport,
+        idempotency_keys=True
+    )
+    swu_api.send('tem_1', recipient)
+    swu_api.send('tem_1', recipient)
+    keys = [r.headers['Idempotency-Key'] for r in transport.requests]
+    assert len(set(keys)) == 2
+
+    batch = swu_api.start_batch()
+    batch.send('tem_1', recipient)
+    batch.send('tem_1', recipient, idempotency_key='mine')
+    batch.customer_create('test@example.com')
+    batch.execute()
+    first, second, third = transport.requests[-1].json()
+    assert first['headers']['Idempotency-Key'] not in keys
+    assert second['headers'] == {'Idempotency-Key': 'mine'}
+    assert 'headers' not in third
+
+
+def test_dedupe_window(recipient):
+    from sendwithus.idempotency import DedupeWindow
+    from sendwithus.transport import MemoryTransport
+    transport = MemoryTransport()
+    window = DedupeWindow(maxsize=2)
+    swu_api = sendwithus.api(
+        'TEST_API_KEY',
+        transport=transport,
+        dedupe_window=window
+    )
+
+    # failures are not remembered, so the send can be made again
+    transport.queue(500, {})
+    assert swu_api.send('tem_1', recipient, idempotency_key='a').status_code \
+        == 500
+    first = swu_api.send('tem_1', recipient, idempotency_key='a')
+    again = swu_api.send('tem_1', recipient, idempotency_key='a')
+    assert again is first
+    assert transport.request_count == 2
+
+    swu_api.send('tem_1', recipient, idempotency_key='b')
+    swu_api.send('tem_1', recipient, idempotency_key='c')
+    assert 'a' not in window and len(window) == 2
+
+
+def test_dedupe_window_concurrent(recipient):
+    from sendwithus.idempotency import DedupeWindow
+    from sendwithus.transport import MemoryTransport
+    transport = MemoryTransport(latency=0.05)
+    swu_api = sendwithus.api(
+        'TEST_API_KEY',
+        transport=transport,
+        dedupe_window=DedupeWindow(),
+        pool_maxsize=4
+    )
+    sends = [
+        {'email_id': 'tem_1', 'recipient': recipient, 'idempotency_key': 'x'}
+    ] * 4
+    results = list(swu_api.send_many(sends, concurrency=4))
+    assert all(result.ok for result in results)
+    assert transport.request_count == 1
+
+
+def test_outbox_idempotency_keys(recipient):
+    from sendwithus.outbox import SQLiteOutbox
+    from sendwithus.transport import MemoryTransport
+    transport = MemoryTransport()
+    swu_api = sendwithus.api(
+        'TEST_API_KEY',
+        transport=transport,
+        outbox=SQLiteOutbox(':memory:'),
+        outbox_worker=False
+    )
+    swu_api.send('tem_1', recipient)
+    swu_api.send('tem_1', recipient, idempotency_key='mine')
+    swu_api.flush_outbox()
+    first, second = transport.requests[0].json()
+    assert first['headers']['Idempotency-Key']
+    assert second['headers'] == {'Idempotency-Key': 'mine'}
+
+
+def test_compression(recipient):
+    import zlib
+    from sendwithus.transport import MemoryTransport
+    transport = MemoryTransport()
+    swu_api = sendwithus.api(
+        'TEST_API_KEY',
+        transport=transport,
+        compression='gzip',
+        compression_threshold=512
+    )
+    email_data = {'items': ['item %s' % i for i in range(100)]}
+    swu_api.send('tem_1', recipient, email_data=email_data)
+    swu_api.send('tem_1', recipient)
+
+    large, small = transport.requests
+    assert large.headers['Content-Encoding'] == 'gzip'
+    assert large.headers['Accept-Encoding'] == 'gzip, deflate'
+    payload = json.loads(zlib.decompress(large.body, 16 + zlib.MAX_WBITS))
+    assert payload['email_data'] == email_data
+    assert large.json() == payload
+    assert 'Content-Encoding' not in small.headers
+    assert small.json()['email_id'] == 'tem_1'
+
+
+def test_compression_batch(recipient):
+    import zlib
+    from sendwithus.transport import MemoryTransport
+    transport = MemoryTransport()
+    swu_api = sendwithus.api(
+        'TEST_API_KEY',
+        transport=transport,
+        compression='deflate'
+    )
+    batch = swu_api.start_batch()
+    for _ in range(100):
+        batch.send('tem_1', recipient, email_data={'name': 'Jimmy'})
+    assert batch.execute().ok
+
+    request, = transport.requests
+    assert request.headers['Content-Encoding'] == 'deflate'
+    commands = json.loads(zlib.decompress(request.body))
+    assert len(commands) == 100
+    assert len(request.body) * 20 < len(json.dumps(commands))
+
+
+def test_compression_unknown():
+    with pytest.raises(ValueError):
+        sendwithus.api('TEST_API_KEY', compression='br')
+
+
+def test_prepare_send(recipient):
+    from sendwithus.transport import MemoryTransport
+    transport = MemoryTransport()
+    events = []
+    swu_api = sendwithus.api(
+        'TEST_API_KEY',
+        transport=transport,
+        on_request=events.append
+    )
+    options = dict(
+        sender={'address': 'company@example.com'},
+        tags=['password-reset'],
+        esp_account='esp_1',
+        email_version_name='v2'
+    )
+    prepared = swu_api.prepare_send('tem_1', **options)
+    prepared.send(recipient, {'code': 1234})
+    prepared.send(recipient)
+    swu_api.send('tem_1', recipient, email_data={'code': 1234}, **options)
+
+    first, second, plain = transport.requests
+    assert first.json() == plain.json()
+    assert second.json()['email_data'] == {}
+    assert second.json()['version_name'] == 'v2'
+    assert [event.template_id for event in events] == ['tem_1'] * 3
+
+
+def test_prepare_send_validates_once(recipient, caplog):
+    from sendwithus.transport import MemoryTransport
+    swu_api = sendwithus.api('TEST_API_KEY', transport=MemoryTransport())
+    prepared = swu_api.prepare_send('tem_1', tags='not-a-list')
+    assert 'kwarg tags must be type(list)' in caplog.text
+    caplog.clear()
+    prepared.send(recipient)
+    assert caplog.text == ''
+
+
+def test_prepare_send_batch_and_outbox(recipient):
+    from sendwithus.outbox import SQLiteOutbox
+    from sendwithus.transport import MemoryTransport
+    transport = MemoryTransport()
+    swu_api = sendwithus.api('TEST_API_KEY', transport=transport)
+    batch = swu_api.start_batch()
+    prepared = batch.prepare_send('tem_1', tags=['a'])
+    prepared.send(recipient, {'n': 1}, idempotency_key='k')
+    prepared.send(recipient, {'n': 2})
+    assert batch.execute().ok
+    first, second = transport.requests[0].json()
+    assert first['path'] == '/api/v1/send'
+    assert first['headers'] == {'Idempotency-Key': 'k'}
+    assert first['body'] == {
+        'email_id': 'tem_1',
+        'tags': ['a'],
+        'recipient': recipient,
+        'email_data': {'n': 1},
+    }
+    assert second['body']['email_data'] == {'n': 2}
+
+    queued = sendwithus.api(
+        'TEST_API_KEY',
+        transport=transport,
+        outbox=SQLiteOutbox(':memory:'),
+        outbox_worker=False
+    )
+    r = queued.prepare_send('tem_1').send(recipient)
+    assert r.status_code == 202
+    queued.flush_outbox()
+    command, = transport.requests[-1].json()
+    assert command['body']['email_id'] == 'tem_1'
+
+
+def test_prepare_send_string_recipient():
+    from sendwithus.outbox import SQLiteOutbox
+    from sendwithus.transport import MemoryTransport
+    transport = MemoryTransport()
+    swu_api = sendwithus.api('TEST_API_KEY', transport=transport)
+    with pytest.warns(DeprecationWarning):
+        swu_api.prepare_send('tem_1').send('a@example.com')
+    assert transport.requests[-1].json()['recipient'] == {
+        'address': 'a@example.com'
+    }
+
+    queued = sendwithus.api(
+        'TEST_API_KEY',
+        transport=transport,
+        outbox=SQLiteOutbox(':memory:'),
+        outbox_worker=False
+    )
+    with pytest.warns(DeprecationWarning):
+        queued.prepare_send('tem_1').send('b@example.com')
+    queued.flush_outbox()
+    command, = transport.requests[-1].json()
+    assert command['body']['recipient'] == {'address': 'b@example.com'}
+
+
+def _customer_responder(request):
+    # reject customers whose address contains 'bad'
+    return 200, [
+        {
+            'status_code': 400 if 'bad' in json.dumps(command) else 200,
+            'body': {'success': True},
+        }
+        for command in request.json()
+    ]
+
+
+def test_customers_bulk_upsert():
+    from sendwithus.transport import MemoryTransport
+    transport = MemoryTransport(responder=_customer_responder)
+    swu_api = sendwithus.api('TEST_API_KEY', transport=transport)
+
+    def customers():
+        for i in range(25):
+            email = 'bad%s@example.com' % i if i in (3, 17) \
+                else 'user%s@example.com' % i
+            yield {'email': email, 'data': {'n': i}, 'locale': 'en-US'}
+        yield 'plain@example.com'
+
+    progress = []
+    result = swu_api.customers_bulk_upsert(
+        customers(),
+        batch_size=10,
+        parallel=2,
+        on_progress=lambda r: progress.append(r.processed)
+    )
+    assert (result.succeeded, result.failed, result.batches) == (24, 2, 3)
+    assert not result.ok
+    assert sorted(f.index for f in result.failures) == [3, 17]
+    failure = min(result.failures, key=lambda f: f.index)
+    assert failure.status_code == 400
+    assert failure.command['body']['email'] == 'bad3@example.com'
+    assert len(progress) == 3 and progress[-1] == 26
+
+    assert len(transport.requests) == 3
+    commands = sum((r.json() for r in transport.requests), [])
+    assert all(c['path'] == '/api/v1/customers' for c in commands)
+    assert {'email': 'plain@example.com', 'data': {}} in \
+        [c['body'] for c in commands]
+
+
+def test_customers_bulk_delete():
+    from sendwithus.transport import MemoryTransport
+    transport = MemoryTransport(error_rate=1)
+    swu_api = sendwithus.api('TEST_API_KEY', transport=transport)
+    emails = ('user%s@example.com' % i for i in range(5))
+
+    result = swu_api.customers_bulk_delete(
+        emails,
+        batch_size=2,
+        max_failures=3
+    )
+    assert (result.succeeded, result.failed, result.batches) == (0, 5, 3)
+    assert len(result.errors) == 3
+    assert len(result.failures) == 3
+    assert all(f.status_code is None for f in result.failures)
+
+    transport.error_rate = 0
+    result = swu_api.customers_bulk_delete(['user1@example.com'])
+    assert result.ok
+    command, = transport.requests[-1].json()
+    assert command['method'] == 'DELETE'
+    assert command['path'] == '/api/v1/customers/user1@example.com'
+
+
+def test_drip_enroll_many(caplog):
+    from sendwithus.transport import MemoryTransport
+    transport = MemoryTransport(responder=_customer_responder)
+    swu_api = sendwithus.api('TEST_API_KEY', transport=transport)
+    recipients = [
+        'user0@example.com',
+        {'address': 'bad1@example.com', 'name': 'Bad'},
+        {'recipient': 'user2@example.com', 'email_data': {'plan': 'pro'}},
+    ] * 3
+
+    results = swu_api.drip_enroll_many(
+        'dc_1',
+        iter(recipients),
+        email_data={'plan': 'free', 'source': 'segment'},
+        tags='not-a-list',
+        esp_account='esp_1',
+        batch_size=2,
+        parallel=3
+    )
+    assert transport.requests == []
+    assert caplog.text.count('kwarg tags must be type(list)') == 1
+
+    results = list(results)
+    assert [r.index for r in results] == list(range(9))
+    assert [r.ok for r in results] == [True, False, True] * 3
+    assert len(transport.requests) == 5
+
+    first, second, third = [r.command for r in results[:3]]
+    assert first['path'] == '/api/v1/drip_campaigns/dc_1/activate'
+    assert first['body']['recipient'] == {'address': 'user0@example.com'}
+    assert first['body']['email_data'] == {'plan': 'free', 'source': 'segment'}
+    assert first['body']['esp_account'] == 'esp_1'
+    assert second['body']['recipient']['name'] == 'Bad'
+    assert third['body']['recipient'] == {'address': 'user2@example.com'}
+    assert third['body']['email_data'] == {'plan': 'pro', 'source': 'segment'}
+
+
+def test_drip_remove_many():
+    from sendwithus.transport import MemoryTransport
+    transport = MemoryTransport()
+    swu_api = sendwithus.api('TEST_API_KEY', transport=transport)
+    addresses = ['user%s@example.com' % i for i in range(5)]
+
+    transport.queue(503, {})
+    results = sorted(
+        swu_api.drip_remove_many(
+            'dc_1',
+            addresses,
+            batch_size=3,
+            parallel=1,
+            ordered=False
+        ),
+        key=lambda r: r.index
+    )
+    assert [r.status_code for r in results] == [503] * 3 + [200] * 2
+    command = results[4].command
+    assert command['path'] == '/api/v1/drip_campaigns/dc_1/deactivate'
+    assert command['body'] == {'recipient_address': 'user4@example.com'}
+
+
+def _paged_responder(total):
+    def respond(request):
+        from six.moves.urllib.parse import parse_qs, urlsplit
+        query = parse_qs(urlsplit(request.url).query)
+        count = int(query['count'][0])
+        offset = int(query['offset'][0])
+        customers = [
+            {'email': 'user%s@example.com' % i}
+            for i in range(offset, min(offset + count, total))
+        ]
+        return 200, {'id': 'dc_1', 'customers': customers}
+    return respond
+
+
+def test_iter_drip_campaign_customers():
+    from sendwithus.transport import MemoryTransport
+    transport = MemoryTransport(responder=_paged_responder(250))
+    swu_api = sendwithus.api('TEST_API_KEY', transport=transport)
+
+    customers = swu_api.iter_drip_campaign_customers('dc_1', page_size=100)
+    first = next(customers)
+    assert first == {'email': 'user0@example.com'}
+    # the second page is fetched while the first is consumed
+    deadline = time.time() + 5
+    while transport.request_count < 2 and time.time() < deadline:
+        time.sleep(0.01)
+    assert transport.request_count == 2
+
+    rest = list(customers)
+    assert len(rest) == 249
+    assert rest[-1] == {'email': 'user249@example.com'}
+    assert [r.url.split('?')[1] for r in transport.requests] == [
+        'count=100&offset=0',
+        'count=100&offset=100',
+        'count=100&offset=200',
+    ]
+    assert transport.requests[0].path == \
+        '/api/v1/drip_campaigns/dc_1/customers'
+
+
+def test_iter_drip_step_customers():
+    from sendwithus.transport import MemoryTransport
+    transport = MemoryTransport(responder=_paged_responder(4))
+    swu_api = sendwithus.api('TEST_API_KEY', transport=transport)
+
+    customers = list(swu_api.iter_drip_step_customers(
+        'dc_1',
+        'dcs_1',
+        page_size=2,
+        prefetch=False
+    ))
+    assert len(customers) == 4
+    # a full last page takes one more request to find the end
+    assert transport.request_count == 3
+    assert transport.requests[0].path == \
+        '/api/v1/drip_campaigns/dc_1/steps/dcs_1/customers'
+
+    transport.queue(404, {'error': 'not found'})
+    with pytest.raises(APIError):
+        list(swu_api.iter_drip_step_customers('dc_1', 'dcs_2'))
+    with pytest.raises(ValueError):
+        swu_api.iter_drip_campaign_customers('dc_1', page_size=0)
+
+
+def test_iter_drip_customers_cached():
+    from sendwithus.cache import ResponseCache
+    from sendwithus.transport import MemoryTransport
+    transport = MemoryTransport(responder=_paged_responder(5))
+    swu_api = sendwithus.api(
+        'TEST_API_KEY',
+        transport=transport,
+        cache=ResponseCache(ttls={'DRIP_CAMPAIGN_CUSTOMERS_ENDPOINT': 60})
+    )
+    customers = list(swu_api.iter_drip_campaign_customers(
+        'dc_1',
+        page_size=2,
+        prefetch=False
+    ))
+    assert [c['email'] for c in customers] == [
+        'user%s@example.com' % i for i in range(5)
+    ]
+    assert transport.request_count == 3
+    assert len(swu_api._cache) == 0
+
+
+def test_iter_drip_customers_unpaged_server():
+    from sendwithus.transport import MemoryTransport
+    customers = [{'email': 'user%s@example.com' % i} for i in range(150)]
+    transport = MemoryTransport(responder=lambda request: (200, customers))
+    swu_api = sendwithus.api('TEST_API_KEY', transport=transport)
+    assert list(swu_api.iter_drip_campaign_customers('dc_1')) == customers
+    assert transport.request_count == 1
+
+
+def test_customers_bulk_upsert_malformed_rows():
+    from sendwithus.transport import MemoryTransport
+    transport = MemoryTransport()
+    swu_api = sendwithus.api('TEST_API_KEY', transport=transport)
+    rows = [
+        {'email': 'user0@example.com'},
+        {'mail': 'oops'},
+        None,
+        {'mail': 'oops'},
+        {'email': 'user4@example.com'},
+        {'email': 'user5@example.com'},
+    ]
+
+    result = swu_api.customers_bulk_upsert(iter(rows), batch_size=2)
+    assert (result.succeeded, result.failed, result.batches) == (3, 3, 3)
+    assert result.errors == []
+    failures = sorted(result.failures, key=lambda f: f.index)
+    assert [f.index for f in failures] == [1, 2, 3]
+    assert isinstance(failures[0].error, KeyError)
+    assert failures[0].status_code is None and failures[0].command is None
+
+    # the batch of two bad rows sends no request
+    assert len(transport.requests) == 2
+    sent = [c['body']['email'] for r in transport.requests for c in r.json()]
+    assert sorted(sent) == [
+        'user0@example.com', 'user4@example.com', 'user5@example.com']
+
+
+def test_drip_many_invalid_recipients():
+    from sendwithus.transport import MemoryTransport
+    transport = MemoryTransport()
+    swu_api = sendwithus.api('TEST_API_KEY', transport=transport)
+
+    results = list(swu_api.drip_enroll_many(
+        'dc_1',
+        ['a@example.com', None, 'c@example.com'],
+        batch_size=1
+    ))
+    assert [r.index for r in results] == [0, 1, 2]
+    assert [r.ok for r in results] == [True, False, True]
+    assert isinstance(results[1].error, ValueError)
+    assert len(transport.requests) == 2
+
+    results = list(swu_api.drip_remove_many(
+        'dc_1',
+        ['a@example.com', 42, 'c@example.com'],
+        batch_size=3
+    ))
+    assert [r.ok for r in results] == [True, False, True]
+    assert results[2].command['body'] == {
+        'recipient_address': 'c@example.com'}
+
+
+class _Pipe(object):
+    """A readable file that cannot tell or seek, like a pipe"""
+
+    name = 'pipe.bin'
+
+    def __init__(self, data, read_size=5):
+        self._data = io.BytesIO(data)
+        self._read_size = read_size
+
+    def read(self, size=-1):
+        # pipes return short reads
+        return self._data.read(min(size, self._read_size))
+
+
+def test_attachment_from_pipe_retried(recipient):
+    from sendwithus.retry import RetryPolicy
+    from sendwithus.transport import MemoryTransport
+    transport = MemoryTransport()
+    swu_api = sendwithus.api(
+        'TEST_API_KEY',
+        transport=transport,
+        retry_policy=RetryPolicy(max_retries=1, backoff_factor=0)
+    )
+    data = b'attachment data from a pipe'
+
+    transport.queue(503, {})
+    r = swu_api.send('tem_1', recipient, files=[_Pipe(data)], idempotent=True)
+    assert r.status_code == 200
+    first, second = transport.requests
+    expected = [{'id': 'pipe.bin', 'data': base64.b64encode(data).decode()}]
+    assert first.json()['files'] == expected
+    assert second.json()['files'] == expected
+
+
+class _UnicodeEncoder(sendwithus.encoder.SendwithusJSONEncoder):
+    def __init__(self, *args, **kwargs):
+        kwargs['ensure_ascii'] = False
+        super(_UnicodeEncoder, self).__init__(*args, **kwargs)
+
+
+def test_batch_non_ascii_output(mock_api_options, mock_server):
+    swu_api = sendwithus.api(
+        'TEST_API_KEY',
+        json_encoder=_UnicodeEncoder,
+        **mock_api_options
+    )
+    batch = swu_api.start_batch(max_bytes=120)
+    batch.customer_create(u'caf\xe9@example.com')
+    batch.customer_create(u'\u65e5\u672c@example.com')
+    result = batch.execute()
+    assert result.ok
+
+    # both commands only fit in 120 bytes when counted as characters
+    assert len(mock_server.requests) == 2
+    for request in mock_server.requests:
+        assert int(request['headers']['Content-Length']) == \
+            len(request['body'])
+        assert len(request['body']) <= 120
+    command, = json.loads(mock_server.requests[0]['body'].decode('utf-8'))
+    assert command['body']['email'] == u'caf\xe9@example.com'
+    assert result[1].command['body']['email'] == u'\u65e5\u672c@example.com'
+
+
+def test_request_hooks_non_ascii_output(
+    mock_api_options,
+    mock_server,
+    recipient
+):
+    finished = []
+    swu_api = sendwithus.api(
+        'TEST_API_KEY',
+        json_encoder=_UnicodeEncoder,
+        on_response=finished.append,
+        **mock_api_options
+    )
+    assert_success(swu_api.send(
+        'tem_1',
+        recipient,
+        email_data={'name': u'J\xf6rg \u65e5\u672c'}
+    ))
+    send, = finished
+    body = mock_server.requests[-1]['body']
+    assert u'\xf6'.encode('utf-8') in body
+    assert send.request_bytes == len(body)